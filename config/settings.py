@@ -108,6 +108,16 @@ STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
 
+# Production (DEBUG = False): "manage.py collectstatic" writes fingerprinted & precompressed files here,
+# core.utils.files serves them with "immutable" caching
+STATIC_ROOT = BASE_DIR / "staticfiles"
+
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage" if DEBUG
+                    else "core.utils.storage.CompressedManifestStaticFilesStorage"},
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -134,6 +144,11 @@ CORS_ALLOW_ALL_ORIGINS = True  # Только для разработки, в п
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Who sends media bytes when DEBUG = False: "nginx" (X-Accel-Redirect), "apache" (X-Sendfile) or None - Django (FileResponse).
+# For nginx: location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+MEDIA_SENDFILE = os.environ.get("MEDIA_SENDFILE") or None
+MEDIA_SENDFILE_PREFIX = "/protected-media/"
+
 LOGIN_URL = "login"
 
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
@@ -1,10 +1,11 @@
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 
 from core.views import *
 from core import api
+from core.utils import files
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -21,8 +22,13 @@ urlpatterns = [
     # API
     path("api/get/products/", api.get_all_products),
     path("api/get/ingredients/", api.get_ingredients),
+    path("api/get/bootstrap/", api.get_bootstrap),
+    path("api/get/catalog/delta/", api.get_catalog_delta),
     path("api/get/ingredient/<int:pk>/", api.get_ingredient),
+    path("api/get/product/<int:pk>/calorie-grid/", api.get_product_calorie_grid),
+    path("api/custom-meal/solve/", api.solve_custom_meal),
     path("api/get/order/last/", api.get_order_last),
+    path("api/events/", api.get_events),
     path("api/check/promo/<str:promo_code>/", api.check_promo),
     path("api/checkout/", api.checkout, name="checkout"),
 
@@ -45,6 +51,7 @@ urlpatterns = [
     path("api/control/get/ingredients/", api.get_ingredients_control),
     path("api/control/get/ingredient/<int:pk>/", api.get_ingredient_control),
     path("api/control/update/ingredient/<int:pk>/", api.update_ingredient_control),
+    path("api/control/update/ingredients/availability/", api.update_ingredients_availability_control),
     path("api/control/create/ingredient/", api.create_ingredient_control),
 
     path("api/control/get/orders/", api.get_orders_control),
@@ -58,6 +65,8 @@ urlpatterns = [
     path("api/control/update/promo/<int:pk>/", api.update_promo),
     path("api/control/create/promo/", api.create_promo),
 
+    path("api/control/get/stats/cache/", api.get_cache_stats),
+
     path('api/control/get/purchases/', api.get_purchases),
     path('api/control/update/purchase/<int:pk>/', api.update_purchase),
     path('api/control/create/purchase/', api.create_purchase),
@@ -65,3 +74,8 @@ urlpatterns = [
 
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+else:
+    urlpatterns += [
+        re_path(rf"^{settings.STATIC_URL.lstrip('/')}(?P<path>.+)$", files.serve_static),
+        re_path(rf"^{settings.MEDIA_URL.lstrip('/')}(?P<path>.+)$", files.serve_media),
+    ]
@@ -2,30 +2,54 @@ import json
 import logging
 from datetime import timedelta
 
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
+from django.db.models import Prefetch, Case, When, Value, BooleanField
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils import timezone
 from django_ratelimit.decorators import ratelimit
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
-from .models import Ingredient, Product, Order, NutritionalValue, Promo, Setting, OrderHistory, Purchase
+from .models import Ingredient, Product, Order, OrderProduct, NutritionalValue, Promo, Setting, OrderHistory, Purchase, CatalogChange, \
+    StockMovement, get_recompute_stats
 from core.utils import utils_api
 from core.utils import utils
+from core.utils import catalog
+from core.utils import etags
+from core.utils import events
+from core.utils import responses
+from core.utils import solver
+from core.utils import stock
+from core.utils import substitutes
+from core.utils.nutrient_matrix import get_matrix
+from core.utils.nutrients import NutrientVector
 from .serializers import OrderSerializer, OrderHistorySerializer, PurchaseSerializer
 
 logger = logging.getLogger(__name__)
 
+BOOTSTRAP_ATTEMPTS = 3  # reads of menu & ingredients snapshots until both are of one catalog version
+
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
 def get_all_products(request):
-    products = Product.objects.filter(is_menu=True)
-    if products:
-        return Response({"products": utils_api.get_all_products(products)}, status=status.HTTP_200_OK)
+    """
+    Uses for Customers to choose from menu.
+    ?v=1 - legacy format, every product embeds full ingredients. Default - normalized format 2, see utils_api.get_menu
+    ?nutrients=calories,proteins,... or "macros" - only these nutrients, a snapshot of its own for every set
+    """
+    menu_format = 1 if request.GET.get("v") == "1" else 2
+    nutrients = utils_api.get_nutrients_param(request)
+    snapshot = catalog.get_snapshot(f"menu_v{menu_format}", nutrients)
+    if snapshot["count"]:
+        return catalog.snapshot_response(request, snapshot)
     return Response({"products": [], "messages": [{"level": "info", "message": "No products found."}]}, status=status.HTTP_404_NOT_FOUND)
 
 
@@ -34,6 +58,7 @@ def get_all_products(request):
 @utils.role_redirect(roles=["owner", "administrator", "manager"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.products_control_etag)
 def get_all_products_control(request):
     if request.user.role == "owner" or request.user.role == "administrator":
         products = Product.objects.all()
@@ -52,13 +77,13 @@ def get_all_products_control(request):
 @utils.role_redirect(roles=["owner", "administrator", "manager"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
 def get_product_control(request, pk=None):
     product = Product.objects.filter(pk=pk).first()
     if product:
-        if request.user.role == "owner" or request.user.role == "administrator":
-            return Response({"product": utils_api.get_products_data(product, is_full=True, is_admin=True)}, status=status.HTTP_200_OK)
-        else:
-            return Response({"product": utils_api.get_products_data(product, is_full=True)}, status=status.HTTP_200_OK)
+        is_admin = request.user.role == "owner" or request.user.role == "administrator"
+        product_data = substitutes.add_product_substitutes(utils_api.get_products_data(product, is_full=True, is_admin=is_admin))
+        return Response({"product": product_data}, status=status.HTTP_200_OK)
 
     return Response({"product": "", "messages": [
         {"level": "error", "message": f"Product #{pk} not found"}]}, status=status.HTTP_404_NOT_FOUND)
@@ -83,15 +108,19 @@ def update_product_control(request, pk=None):
 @permission_classes([IsAuthenticated])
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
 def get_ingredients(request):
     """
     Uses for Customers to choose from ingredients for custom meal
+    ?v=1 - legacy format with nutrition as dicts. Default - format 2, nutrition as arrays ordered by "nutrients"
+    ?nutrients=calories,proteins,... or "macros" - only these nutrients, a snapshot of its own for every set
     :return: All ingredients that are in the menu.
     """
-    ingredients = Ingredient.objects.filter(is_menu=True).select_related("nutritional_value")
-    if ingredients:
-        ingredients = [utils_api.get_ingredient_data(ingredient) for ingredient in ingredients]
-        return Response({"ingredients": ingredients}, status=status.HTTP_200_OK)
+    ingredients_format = 1 if request.GET.get("v") == "1" else 2
+    nutrients = utils_api.get_nutrients_param(request)
+    snapshot = catalog.get_snapshot(f"ingredients_v{ingredients_format}", nutrients)
+    if snapshot["count"]:
+        return catalog.snapshot_response(request, snapshot)
     return Response({"ingredients": [], "messages": [
         {"level": "info", "message": "No ingredients found."}]}, status=status.HTTP_404_NOT_FOUND)
 
@@ -100,16 +129,111 @@ def get_ingredients(request):
 @permission_classes([IsAuthenticated])
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+def get_bootstrap(request):
+    """
+    Uses for Customers (tablets) on a cold start: menu, ingredients, settings & the last order in 1 request.
+    Menu & ingredients are the same snapshots as in get_all_products & get_ingredients (format 2 with the version),
+    so the client continues with get_catalog_delta after it. They are of one catalog version unless it changes all
+    the time (a stale snapshot is served while another request rebuilds it) - each has its version, the client asks
+    the delta since it, so an older one only catches up. Settings & order are separate reads, not one DB snapshot.
+    :return: {"menu": {...}, "ingredients": {...}, "settings": {...}, "order": {...} or None}
+    """
+    for _ in range(BOOTSTRAP_ATTEMPTS):
+        menu = catalog.get_snapshot("menu_v2")
+        ingredients = catalog.get_snapshot("ingredients_v2")
+        if menu["version"] == ingredients["version"]:
+            break
+
+    settings = utils_api.get_settings_data()
+    order = Order.objects.filter(user=request.user).order_by("-created_at").select_related("nutritional_value") \
+        .prefetch_related("products__product").first()
+    order = utils_api.get_order_last(order) if order and order.show_public else None
+
+    # Snapshots are already serialized - they are put into the body as they are
+    rest = JSONRenderer().render({"settings": settings, "order": order})
+    body = b"".join((
+        b'{"menu":', menu["encodings"]["identity"],
+        b',"ingredients":', ingredients["encodings"]["identity"],
+        b",", rest[1:],
+    ))
+    return responses.dynamic_response(request, body)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@utils.handle_errors
+@ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
+def get_catalog_delta(request):
+    """
+    Uses for Customers to update menu & ingredients they already have (format 2).
+    :return: Products & ingredients changed since ?since=<version>, or "full": true if everything has to be loaded again.
+    """
+    try:
+        since = int(request.GET.get("since", 0))
+    except ValueError:
+        since = 0
+    return Response(catalog.get_catalog_delta(since), status=status.HTTP_200_OK)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@utils.handle_errors
+@ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
+def get_product_calorie_grid(request, pk=None):
+    """
+    Uses for Customers to choose calories of a dish: price, weight, macros & ingredients for every step, see
+    Product.build_calorie_grid. Checkout accepts only these points
+    """
+    calorie_grid = Product.objects.filter(pk=pk, is_menu=True).values_list("calorie_grid", flat=True).first()
+    if calorie_grid is None:
+        return Response({"messages": [{"level": "error", "message": "Not Found"}]}, status=status.HTTP_404_NOT_FOUND)
+    return Response({"calorie_grid": calorie_grid}, status=status.HTTP_200_OK)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@utils.handle_errors
+@ratelimit(key="user", rate="120/m", method=["POST"])
+def solve_custom_meal(request):
+    """
+    Uses for Customers to get weights of the chosen ingredients for their targets, called as the sliders move.
+    :param request: {"ingredients": [ids], "weights": [current grams, optional], "targets": {"calories": 600,
+                    "proteins": [40, null], ...}} - see solver.parse_targets
+    :return: weights in the ingredients order on their step grid, total weight & price, targeted nutrients & are they met
+    """
+    ingredient_ids, weights, targets = solver.parse_request(request.data)
+    # Only what a Customer can order, as checkout - the others are not shown, not even their nutrition
+    available = dict(Ingredient.objects.filter(id__in=ingredient_ids, is_menu=True).values_list("id", "is_available"))
+    matrix = get_matrix(ingredient_ids)
+    if not all(ingredient_id in available and ingredient_id in matrix for ingredient_id in ingredient_ids):
+        return Response({"messages": [{"level": "error", "message": "Solver - wrong ingredient id."}]},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not all(available.values()):
+        return Response({"messages": [{"level": "error", "message": "Solver - some of the ingredients are not available."}]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    max_weight = Setting.objects.values_list("maximum_order_weight", flat=True).first() or 0
+    return Response(solver.solve(matrix, ingredient_ids, targets, max_weight, weights), status=status.HTTP_200_OK)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@utils.handle_errors
+@ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
 def get_ingredient(request, pk=None):
     """
     Uses for Customers to build custom meal
     :return: Ingredient data by PK if it's menu.
     """
+    nutrients = utils_api.get_nutrients_param(request)
     try:
-        ingredient = Ingredient.objects.get(pk=pk, is_menu=True)
+        ingredient = utils_api.only_nutrients(Ingredient.objects.select_related("nutritional_value"), nutrients).get(pk=pk, is_menu=True)
     except Ingredient.DoesNotExist:
         return Response({"messages": [{"level": "error", "message": "Not Found"}]}, status=status.HTTP_404_NOT_FOUND)
-    return Response({"ingredient": utils_api.get_ingredient_data(ingredient)}, status=status.HTTP_200_OK)
+    return Response({"ingredient": utils_api.get_ingredient_data(ingredient, nutrients=nutrients)}, status=status.HTTP_200_OK)
 
 
 @api_view(["GET"])
@@ -117,19 +241,22 @@ def get_ingredient(request, pk=None):
 @utils.role_redirect(roles=["owner", "administrator", "manager", "kitchen"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
 def get_ingredient_control(request, pk=None):
     """
     Uses in Control Panel to manage ingredients.
     If Admin - ingredient with full info
     If not - ingredient if it's menu and basic info (name, type, img, is_available)
+    ?nutrients=... - see utils_api.get_nutrients_param
     :param request:
     :param pk:
     :return:
     """
     try:
         if request.user.role == "owner" or request.user.role == "administrator":
-            ingredient = Ingredient.objects.get(pk=pk)
-            ingredient_data = utils_api.get_ingredient_data_full(ingredient)
+            nutrients = utils_api.get_nutrients_param(request)
+            ingredient = utils_api.only_nutrients(Ingredient.objects.select_related("nutritional_value"), nutrients).get(pk=pk)
+            ingredient_data = utils_api.get_ingredient_data_full(ingredient, nutrients)
         else:
             ingredient = Ingredient.objects.get(pk=pk, is_menu=True)
             ingredient_data = utils_api.get_ingredient_data_lite(ingredient)
@@ -144,6 +271,7 @@ def get_ingredient_control(request, pk=None):
 @utils.role_redirect(roles=["owner", "administrator", "manager", "kitchen"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.catalog_etag)
 def get_ingredients_control(request):
     """
     Uses in Control Panel to manage ingredients.
@@ -153,27 +281,45 @@ def get_ingredients_control(request):
     :return:
     """
     if request.user.role == "owner" or request.user.role == "administrator":
-        ingredients = Ingredient.objects.all()
-        ingredients = [utils_api.get_ingredient_data_lite(ingredient, admin=True) for ingredient in ingredients]
+        snapshot = catalog.get_snapshot("ingredients_control_admin")
     else:
-        ingredients = Ingredient.objects.filter(is_menu=True)
-        ingredients = [utils_api.get_ingredient_data_lite(ingredient) for ingredient in ingredients]
+        snapshot = catalog.get_snapshot("ingredients_control")
 
-    if ingredients:
-        return Response({"ingredients": ingredients}, status=status.HTTP_200_OK)
+    if snapshot["count"]:
+        return catalog.snapshot_response(request, snapshot)
     return Response({"ingredients": [], "messages": [
         {"level": "info", "message": "No ingredients found."}]}, status=status.HTTP_404_NOT_FOUND)
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@utils.role_redirect(roles=["owner", "administrator"], redirect_url="home", do_redirect=False)
+@utils.handle_errors
+@ratelimit(key="user", rate="30/m", method=["GET"])
+def get_cache_stats(request):
+    """
+    Pre-serialized catalog responses: sizes per encoding, hit ratio, raw bytes vs bytes actually sent.
+    Product recomputes of this process: requested, recomputed & coalesced, see models.schedule_product_recompute
+    """
+    return Response({"snapshots": catalog.get_snapshots_stats(), "recompute": get_recompute_stats()}, status=status.HTTP_200_OK)
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 @utils.role_redirect(roles=["owner", "manager", "administrator"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.order_etag, last_modified_func=etags.order_modified)
 def get_order_control(request, pk):
-    order = Order.objects.filter(pk=pk).first()
+    """ ?nutrients=... - see utils_api.get_nutrients_param, "none" for screens that don't show nutrition """
+    nutrients = utils_api.get_nutrients_param(request)
+    order_products = utils_api.only_nutrients(OrderProduct.objects.select_related("product__nutritional_value"),
+                                              nutrients, prefix="product__nutritional_value__")
+    orders = utils_api.only_nutrients(Order.objects.filter(pk=pk).select_related("user", "nutritional_value", "promo_usage__promo"), nutrients)
+    order = orders.prefetch_related(Prefetch("products", queryset=order_products),
+                                    "products__product__productingredient_set__ingredient").first()
     if order:
-        return Response({"order": utils_api.get_order_full(order)}, status=status.HTTP_200_OK)
+        return Response({"order": utils_api.get_order_full(order, nutrients)}, status=status.HTTP_200_OK)
     return Response({"order": "", "messages": [
         {"level": "error", "message": f"Order #{pk} not found"}
     ]}, status=status.HTTP_404_NOT_FOUND)
@@ -184,6 +330,7 @@ def get_order_control(request, pk):
 @utils.role_redirect(roles=["owner", "manager", "administrator", "kitchen"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.orders_etag)
 def get_orders_control(request):
     if request.META.get("HTTP_REFERER").endswith("kitchen/orders/"):
         orders = Order.objects.filter(order_status__in=["cooking"]).order_by("paid_at")
@@ -220,6 +367,7 @@ def get_orders_control(request):
 @utils.role_redirect(roles=["owner"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.orders_etag)
 def get_orders_history(request):
     orders = Order.objects.all().order_by('-created_at')
     serializer = OrderSerializer(orders, many=True)
@@ -231,6 +379,7 @@ def get_orders_history(request):
 @utils.role_redirect(roles=["owner"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.order_history_etag)
 def get_order_history_detail(request, pk=None):
     history = OrderHistory.objects.filter(order_id=pk).order_by('created_at')
     serializer = OrderHistorySerializer(history, many=True)
@@ -241,6 +390,7 @@ def get_order_history_detail(request, pk=None):
 @permission_classes([IsAuthenticated])
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
+@etags.conditional(etag_func=etags.last_order_etag, last_modified_func=etags.last_order_modified)
 def get_order_last(request):
     order = Order.objects.filter(user=request.user).order_by("-created_at").first()
     if order and order.show_public:
@@ -251,6 +401,26 @@ def get_order_last(request):
     ]}, status=status.HTTP_200_OK)
 
 
+async def get_events(request):
+    """
+    Server-sent events for the tablet (text/event-stream, read with EventSource), see utils/events.py:
+    "availability" - {"version", "products": {id: is_available}, "ingredients": {id: is_available}} of the changed catalog,
+    "catalog" - {"version", "full": True} the catalog changed too much, load it again,
+    "order" - {"id", "order_status", "is_paid", "is_refunded", "created_at", "paid_at", "ready_at", "updated_at"} of the user's order,
+    "staff_order" - staff only, {"id", "order_status", "changes", "order": as in get_orders_control, "kitchen": as for
+    the kitchen or null if not cooking} of every changed order - the boards update without fetching the orders again.
+    Plain async view, not DRF - the connection stays open without holding a thread (ASGI)
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({"messages": [{"level": "error", "message": "Authentication required."}]}, status=401)
+
+    staff = user.role in events.STAFF_ROLES
+    stream = events.stream(user.id, staff) if isinstance(request, ASGIRequest) else events.stream_sync(user.id, staff)
+    return StreamingHttpResponse(stream, content_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @api_view(["PUT"])
 @permission_classes([IsAuthenticated])
 @utils.handle_errors
@@ -308,20 +478,64 @@ def update_ingredient_control(request, pk):
             nutritional_data = data.pop('nutritional_value')
             utils.validate_nutritional_summary(nutritional_data)
 
-            for field, value in nutritional_data.items():
-                setattr(ingredient.nutritional_value, field, value)
-            ingredient.nutritional_value.save()
+            old_nutrition = NutrientVector.from_model(ingredient.nutritional_value)
+            old_purchase_price = ingredient.purchase_price
+            with transaction.atomic():
+                for field, value in nutritional_data.items():
+                    setattr(ingredient.nutritional_value, field, value)
+                ingredient.nutritional_value.save()
 
-            for field, value in data.items():
-                setattr(ingredient, field, value)
+                for field, value in data.items():
+                    setattr(ingredient, field, value)
 
-            ingredient.save()
+                ingredient.save()
+
+                # Products that use the ingredient get the difference
+                product_ids = ingredient.update_products(NutrientVector.from_model(ingredient.nutritional_value) - old_nutrition,
+                                                         ingredient.purchase_price - old_purchase_price)
+                catalog.on_catalog_changes(CatalogChange.PRODUCT, product_ids)
 
         return Response({"messages": [{"level": "success", "message": f"{ingredient.name} updated."}]}, status=status.HTTP_200_OK)
     except Ingredient.DoesNotExist:
         return Response({"messages": [{"level": "error", "message": "Not Found"}]}, status=status.HTTP_404_NOT_FOUND)
 
 
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@utils.handle_errors
+@ratelimit(key="user", rate="30/m", method=["POST"])
+@utils.role_redirect(roles=["owner", "manager", "kitchen", "administrator"], redirect_url="home", do_redirect=False)
+@transaction.atomic
+def update_ingredients_availability_control(request):
+    """
+    Uses by Kitchen to turn many menu ingredients off / on at once, in one transaction.
+    :param request: {"ingredients": [ids], "is_available": bool} - without "is_available" every ingredient is toggled
+    :return: ingredients with their availability & menu products which availability changed
+    """
+    ingredient_ids, is_available = utils.validate_availability_data(request.data)
+    current = dict(Ingredient.objects.select_for_update().filter(id__in=ingredient_ids, is_menu=True).values_list("id", "is_available"))
+    if len(current) != len(ingredient_ids):
+        missing = ", ".join(str(ingredient_id) for ingredient_id in sorted(ingredient_ids - current.keys()))
+        return Response({"messages": [{"level": "error", "message": f"Ingredients not found: {missing}"}]},
+                        status=status.HTTP_404_NOT_FOUND)
+
+    availability = {ingredient_id: not available if is_available is None else is_available
+                    for ingredient_id, available in current.items()}
+    changed = {ingredient_id: available for ingredient_id, available in availability.items() if available != current[ingredient_id]}
+    if changed:
+        available_ids = [ingredient_id for ingredient_id, available in changed.items() if available]
+        Ingredient.objects.filter(id__in=changed).update(
+            is_available=Case(When(id__in=available_ids, then=Value(True)), default=Value(False), output_field=BooleanField()))
+        catalog.on_catalog_changes(CatalogChange.INGREDIENT, list(changed))
+    products = Ingredient.propagate_availability(changed)
+
+    return Response({
+        "ingredients": [{"id": ingredient_id, "is_available": available} for ingredient_id, available in sorted(availability.items())],
+        "products": list(Product.objects.filter(id__in=products).order_by("id").values("id", "name", "is_available")),
+        "messages": [{"level": "success", "message": f"{len(changed)} ingredients updated, {len(products)} products affected."}],
+    }, status=status.HTTP_200_OK)
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 @utils.handle_errors
@@ -349,6 +563,7 @@ def create_ingredient_control(request):
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
 @utils.role_redirect(roles=["owner", "administrator"], redirect_url="home", do_redirect=False)
+@etags.conditional(etag_func=etags.promos_etag)
 def get_promos(request):
     promos = Promo.objects.all()
     promos = [utils_api.get_promo_data(promo) for promo in promos]
@@ -364,6 +579,7 @@ def get_promos(request):
 @utils.handle_errors
 @ratelimit(key="user", rate="30/m", method=["GET"])
 @utils.role_redirect(roles=["owner", "administrator"], redirect_url="home", do_redirect=False)
+@etags.conditional(etag_func=etags.promo_etag)
 def get_promo(request, pk):
     promo = Promo.objects.filter(pk=pk).first()
     if promo:
@@ -422,6 +638,7 @@ def check_promo(request, promo_code):
 @utils.role_redirect(roles=["owner", "administrator"], redirect_url="home", do_redirect=False)
 @utils.handle_errors
 @ratelimit(key="user", rate="10/m", method=["POST"])
+@etags.conditional(etag_func=etags.purchases_etag)
 def get_purchases(request):
     purchases = Purchase.objects.all().order_by("-id")
     if not purchases:
@@ -469,9 +686,13 @@ def update_purchase(request, pk=None):
 @utils.handle_errors
 @ratelimit(key="user", rate="10/m", method=["POST"])
 def create_purchase(request):
+    """ "ingredients": [{"id", "grams"}] - optional, what was bought goes to stock """
+    grams = stock.parse_purchase_stock(request.data.get("ingredients"))
     serializer = PurchaseSerializer(data=request.data)
     if serializer.is_valid():
-        serializer.save()
+        with transaction.atomic():
+            purchase = serializer.save()
+            stock.add_stock(grams, StockMovement.PURCHASE, purchase=purchase)
         return Response({"purchase": serializer.data, "messages": [{"level": "success", "message": "Purchase created successfully."}]},
                         status=status.HTTP_201_CREATED)
 
@@ -487,15 +708,15 @@ def create_purchase(request):
 @transaction.atomic
 def checkout(request):
     settings = Setting.objects.values().first()
-    promo_usage = utils.order_validator(request.data, settings)
+    promo_usage, nutrition, grams = utils.order_validator(request.data, settings)
 
     official_meals = request.data.get("official_meals", [])
     custom_meals = request.data.get("custom_meals", [])
     price_base = round(request.data.get("base_price"))
     price_final = round(request.data.get("final_price"))
 
-    # Save nutrition info with 1 number after the decimal point
-    nutritional_value = NutritionalValue.objects.create(**{k: round(v, 1) for k, v in request.data["nutritional_value"].items()})
+    # Save nutrition info (calculated by backend) with 1 number after the decimal point
+    nutritional_value = NutritionalValue.objects.create(**nutrition.round(1).to_dict())
     order = Order.objects.create(user=request.user, user_last_update=request.user, payment_type=request.data["payment_type"],
                                  base_price=price_base, total_price=price_final, nutritional_value=nutritional_value,
                                  tax=settings.get("tax"), service=settings.get("service"))
@@ -513,5 +734,8 @@ def checkout(request):
     if custom_meals:
         utils.process_custom_meal(custom_meals, order)
 
+    # Last - the stock rows stay locked only until the commit
+    stock.take_stock(order, grams)
+
     return Response({"messages": [{"level": "success", "message": f"Order {order.id} has been created. Redirecting..."}],
                      "redirect_url": f"/last-order/"}, status=status.HTTP_200_OK)
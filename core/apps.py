@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "core"
+
+    def ready(self):
+        from core.utils import catalog, nutrient_matrix  # noqa: F401 - connects signal receivers
+        from core.models import backfill_calorie_grids
+        post_migrate.connect(backfill_calorie_grids, sender=self)
@@ -0,0 +1,71 @@
+import posixpath
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import Ingredient, Product, CatalogChange
+from core.utils import catalog, images
+from core.utils.storage import get_content_hash, get_hashed_name
+
+
+class Command(BaseCommand):
+    help = "Renames ingredient & product images to their content hash, removes duplicates and updates the references"
+
+    MODELS = ((Ingredient, CatalogChange.INGREDIENT), (Product, CatalogChange.PRODUCT))
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only show what would be done")
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        renames = {}  # old name -> hashed name
+        for model, _ in self.MODELS:
+            directory = model._meta.get_field("image").upload_to.rstrip("/")
+            for filename in default_storage.listdir(directory)[1]:
+                name = posixpath.join(directory, filename)
+                with default_storage.open(name, "rb") as file:
+                    hashed_name = get_hashed_name(name, get_content_hash(file))
+                if hashed_name != name:
+                    renames[name] = hashed_name
+
+        targets = set(renames.values())
+        duplicates = len(renames) - len({name for name in targets if not default_storage.exists(name)})
+        self.stdout.write(f"{len(renames)} files to rename, {duplicates} of them are duplicates")
+        if dry_run:
+            for name, hashed_name in sorted(renames.items()):
+                self.stdout.write(f"  {name} -> {hashed_name}")
+            return
+
+        for name, hashed_name in renames.items():
+            if not default_storage.exists(hashed_name):
+                with default_storage.open(name, "rb") as file:
+                    default_storage.save(hashed_name, file)
+
+        # References first, files are deleted only when nothing points to them
+        updated = 0
+        with transaction.atomic():
+            for model, catalog_model in self.MODELS:
+                for item_id, name in model.objects.filter(image__in=renames).values_list("id", "image"):
+                    model.objects.filter(id=item_id).update(image=renames[name])
+                    catalog.on_catalog_change(catalog_model, item_id)
+                    updated += 1
+
+        for name, hashed_name in renames.items():
+            self.delete_derivatives(name)
+            default_storage.delete(name)
+            if not images.get_built_widths(hashed_name):
+                images.build_derivatives(hashed_name)
+        for hashed_name in targets:
+            catalog.derivatives_built(hashed_name, images.get_built_widths(hashed_name))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(renames)} files renamed ({duplicates} duplicates removed), {updated} references updated"))
+
+    @staticmethod
+    def delete_derivatives(name):
+        for width in images.SIZES.values():
+            for image_format in images.FORMATS:
+                derivative_name = images.get_derivative_name(name, width, image_format)
+                if default_storage.exists(derivative_name):
+                    default_storage.delete(derivative_name)
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from core.models import Ingredient, Product
+from core.utils import catalog, images
+
+
+class Command(BaseCommand):
+    help = "Builds WebP/JPEG derivatives (thumb, card, full) for existing ingredient & product images"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Rebuild derivatives that already exist")
+        parser.add_argument("--workers", type=int, default=4)
+
+    def handle(self, *args, **options):
+        # Every file is built once, its items get the widths after
+        names, not_stored = set(), set()
+        for model in (Ingredient, Product):
+            for name, widths in model.objects.exclude(image="").exclude(image__isnull=True).values_list("image", "image_widths"):
+                names.add(name)
+                if widths is None:
+                    not_stored.add(name)
+
+        def build(name):
+            try:
+                return images.build_derivatives(name, force=options["force"])
+            except Exception as e:
+                self.stderr.write(f"{name}: {e}")
+                return 0
+
+        built = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for name, written in zip(names, executor.map(build, names)):
+                if written:
+                    built += 1
+                widths = images.get_built_widths(name)
+                if widths and (written or name in not_stored):
+                    catalog.derivatives_built(name, widths)  # menu & ingredients get the new srcset
+
+        self.stdout.write(self.style.SUCCESS(f"Derivatives built for {built} of {len(names)} images"))
@@ -1,10 +1,12 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from core.models import NutritionalValue, Ingredient, Product, ProductIngredient
 
 
 class Command(BaseCommand):
     help = 'Populates the database with ingredients and products'
 
+    @transaction.atomic  # products are recomputed once, on commit
     def handle(self, *args, **options):
         from django.core.files.uploadedfile import SimpleUploadedFile
 
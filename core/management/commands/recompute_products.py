@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Product, recompute_products
+
+
+class Command(BaseCommand):
+    help = "Recomputes nutrition, weight, base price & calorie grids of menu products from their ingredients"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Every product, not only the menu ones")
+
+    def handle(self, *args, **options):
+        products = Product.objects.all() if options["all"] else Product.objects.filter(is_menu=True)
+        product_ids = list(products.values_list("id", flat=True))
+        recompute_products(product_ids)
+        self.stdout.write(self.style.SUCCESS(f"{len(product_ids)} products recomputed"))
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promo',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='ingredient',
+            name='image',
+            field=models.ImageField(blank=True, null=True, upload_to='ingredients/'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['updated_at'], name='core_order_updated_1fb29b_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.2 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_promo_updated_at_order_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('product', 'Product'), ('ingredient', 'Ingredient'), ('nutritional_value', 'Nutritional Value')], max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='core_catalo_created_80c987_idx')],
+            },
+        ),
+    ]
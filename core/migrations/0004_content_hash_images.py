@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-18 11:53
+
+import core.utils.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_catalogchange'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ingredient',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=core.utils.storage.ContentHashStorage(), upload_to='ingredients/'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=core.utils.storage.ContentHashStorage(), upload_to='products/'),
+        ),
+    ]
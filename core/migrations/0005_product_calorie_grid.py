@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_content_hash_images'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='calorie_grid',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:07
+
+from django.db import migrations, models
+from django.db.models import Case, F, FloatField, Func, IntegerField, When
+
+
+def fill_effective_price(apps, schema_editor):
+    """ Same as Ingredient.get_selling_price / Product.get_selling_price """
+    Ingredient = apps.get_model("core", "Ingredient")
+    Product = apps.get_model("core", "Product")
+    Ingredient.objects.update(effective_price=Case(
+        When(selling_price__gt=0, then=F("selling_price")),
+        default=Func(F("purchase_price") * F("price_multiplier"), function="ROUND", output_field=FloatField()),
+        output_field=IntegerField()))
+    Product.objects.update(effective_price=Case(
+        When(selling_price__gt=0, then=F("selling_price")),
+        default=F("price") * F("price_multiplier"),
+        output_field=FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_product_calorie_grid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='effective_price',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=models.Index(fields=['effective_price'], name='core_ingred_effecti_e28ffa_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['effective_price'], name='core_produc_effecti_b30e66_idx'),
+        ),
+        migrations.RunPython(fill_effective_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:20
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_effective_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='stock',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grams', models.FloatField()),
+                ('reason', models.CharField(choices=[('checkout', 'Checkout'), ('restock', 'Restock'), ('purchase', 'Purchase')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='core.ingredient')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='core.order')),
+                ('purchase', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='core.purchase')),
+            ],
+        ),
+    ]
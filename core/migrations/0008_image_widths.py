@@ -0,0 +1,50 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:36
+
+import posixpath
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+# As images.get_derivative_name & images.SIZES were at the time of this migration
+SIZES = (160, 480, 1200)
+DERIVATIVES_DIR = "derivatives"
+
+
+def get_built_widths(name):
+    """ Widths of the existing WebP derivatives of the image """
+    directory, filename = posixpath.split(name)
+    stem = filename.replace(".", "_")
+    return [width for width in SIZES
+            if default_storage.exists(posixpath.join(directory, DERIVATIVES_DIR, f"{stem}-{width}.webp"))]
+
+
+def fill_image_widths(apps, schema_editor):
+    """ Derivatives built before - looked up in the storage once, per image """
+    widths = {}
+    for model_name in ("Ingredient", "Product"):
+        model = apps.get_model("core", model_name)
+        for name in model.objects.exclude(image="").exclude(image__isnull=True).values_list("image", flat=True).distinct():
+            if name not in widths:
+                widths[name] = get_built_widths(name) or None
+            model.objects.filter(image=name).update(image_widths=widths[name])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_ingredient_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='image_widths',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='image_widths',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_image_widths, migrations.RunPython.noop),
+    ]
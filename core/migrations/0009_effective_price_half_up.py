@@ -0,0 +1,25 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:02
+
+from django.db import migrations
+from django.db.models import Case, F, FloatField, IntegerField, Value, When
+from django.db.models.functions import Floor
+
+
+def fill_effective_price(apps, schema_editor):
+    """ x.5 goes up, as Ingredient.get_selling_price & sql_round - 0006 filled it with ROUND() """
+    Ingredient = apps.get_model("core", "Ingredient")
+    Ingredient.objects.update(effective_price=Case(
+        When(selling_price__gt=0, then=F("selling_price")),
+        default=Floor(F("purchase_price") * F("price_multiplier") + Value(0.5), output_field=FloatField()),
+        output_field=IntegerField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_image_widths'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_effective_price, migrations.RunPython.noop),
+    ]
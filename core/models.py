@@ -1,14 +1,27 @@
 # models.py
 
+import logging
+import math
+import threading
+import weakref
+from functools import partial
+
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator, MaxLengthValidator
-from django.db.models import Sum, F
-from django.db.models.signals import post_save, pre_delete
+from django.db.models import Count, Sum, F, FloatField, IntegerField, BooleanField, OuterRef, Subquery, Exists, Case, \
+    When, Value
+from django.db.models.functions import Floor
+from django.db.models.lookups import GreaterThan
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
+from core.utils.storage import ContentHashStorage
+
+logger = logging.getLogger(__name__)
+
 
 class User(AbstractUser):
     # login/pass, optional - first_name, last_names, email, is_staff, is_active, email
@@ -24,6 +37,62 @@ class User(AbstractUser):
     role = models.CharField(max_length=15, choices=ROLES, default="user")
 
 
+class DirtyFieldsMixin:
+    """
+    Remembers the field values as they were loaded from DB (or last saved) to know what has changed since:
+    save() writes only the changed columns (+ auto_now ones) and nothing at all - no query, no signals - if nothing
+    changed. Models run their expensive side effects of save() only when the fields they depend on are changed.
+    In-place changes of mutable values (JSONField) are not seen - assign a new value.
+    """
+    _loaded_values = None  # {attname: value}, None - not loaded from DB yet
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {attname: instance.__dict__[attname] for attname in field_names}
+        return instance
+
+    def get_dirty_fields(self):
+        """ :return: names of the changed fields, None if the instance is not in DB yet (everything is new) """
+        if self._state.adding or self._loaded_values is None:
+            return None
+        loaded = self._loaded_values
+        return {field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname in self.__dict__
+                and (field.attname not in loaded or loaded[field.attname] != self.__dict__[field.attname])}
+
+    def is_dirty(self, *fields):
+        """ Any of the fields is changed (or the instance is new) """
+        dirty_fields = self.get_dirty_fields()
+        return dirty_fields is None or not dirty_fields.isdisjoint(fields)
+
+    def get_unchanged_fields(self, dirty_fields):
+        """ full_clean(exclude=...) for a save of dirty_fields: unchanged values were validated when they were saved """
+        if dirty_fields is None:
+            return None
+        return [field.name for field in self._meta.concrete_fields if field.name not in dirty_fields]
+
+    def remember_values(self, fields=None):
+        attnames = {field.attname for field in self._meta.concrete_fields if fields is None or field.name in fields
+                    or field.attname in fields}
+        self._loaded_values = {**(self._loaded_values or {}),
+                               **{attname: self.__dict__[attname] for attname in attnames if attname in self.__dict__}}
+
+    def save(self, *args, **kwargs):
+        if kwargs.get("update_fields") is None and not args and not kwargs.get("force_insert"):
+            dirty_fields = self.get_dirty_fields()
+            if dirty_fields is not None:
+                if dirty_fields:
+                    dirty_fields.update(field.name for field in self._meta.concrete_fields if getattr(field, "auto_now", False))
+                kwargs["update_fields"] = dirty_fields
+        super().save(*args, **kwargs)
+        self.remember_values(kwargs.get("update_fields"))
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self.remember_values(fields)
+
+
 class NutritionalValue(models.Model):
     # Per 100 gram
 
@@ -60,7 +129,7 @@ class NutritionalValue(models.Model):
 
     def to_dict(self, exclude_fields=None):
         if exclude_fields is None:
-            exclude_fields = ["id"]
+            return {field: getattr(self, field) for field in NUTRIENT_FIELDS}
         return {
             field.name: getattr(self, field.name)
             for field in self._meta.fields
@@ -75,14 +144,57 @@ class NutritionalValue(models.Model):
         return f"Nutritional Value (ID: {self.id})"
 
 
-class Ingredient(models.Model):
+# Fixed order of nutrients, used when nutrition is sent as arrays
+NUTRIENT_FIELDS = tuple(field.name for field in NutritionalValue._meta.fields if field.name != "id")
+
+
+# Calorie grid of menu dishes, see Product.build_calorie_grid
+CALORIE_GRID_STEP = 10
+CALORIE_GRID_NUTRIENTS = ("proteins", "fats", "saturated_fats", "carbohydrates", "sugars", "fiber")
+
+
+def round_half_up(value):
+    """ x.5 goes up - the rule of sql_round, stored prices are the same whichever of them wrote them """
+    return math.floor(value + 0.5)
+
+
+def sql_round(expression):
+    """ round_half_up in SQL - ROUND() goes away from zero, Python's round() to the even one """
+    return Floor(expression + Value(0.5), output_field=FloatField())
+
+
+class EffectivePriceQuerySet(models.QuerySet):
+    """
+    effective_price = selling_price if it's set, else the price from the multiplier. Stored, so SQL can sort, filter &
+    sum by it. save() sets it, update() of any of PRICE_FIELDS sets it in the same UPDATE (from the new values)
+    """
+
+    def update(self, **kwargs):
+        if "effective_price" not in kwargs and not self.model.PRICE_FIELDS.isdisjoint(kwargs):
+            kwargs["effective_price"] = self.model.get_effective_price_expression(
+                **{field: kwargs[field] for field in self.model.PRICE_FIELDS if field in kwargs})
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+
+def as_expression(value):
+    return value if hasattr(value, "resolve_expression") else models.Value(value)
+
+
+class Ingredient(DirtyFieldsMixin, models.Model):
     class Meta:
         indexes = [
             models.Index(fields=["is_menu"]),
             models.Index(fields=["is_available"]),
             models.Index(fields=["is_menu", "is_available"]),
+            models.Index(fields=["effective_price"]),
         ]
 
+    objects = EffectivePriceQuerySet.as_manager()
+    PRICE_FIELDS = frozenset(("purchase_price", "price_multiplier", "selling_price"))
+    GRID_FIELDS = frozenset(("min_order", "max_order"))
+
     INGREDIENT_TYPES = (  # if update - update kitchen & manage/ingredients
         ("base", "Base"),
         ("protein", "Protein"),
@@ -94,7 +206,8 @@ class Ingredient(models.Model):
     )
     name = models.CharField(max_length=100)
     description = models.TextField()
-    image = models.ImageField(upload_to="ingredients/", null=True, blank=True)
+    image = models.ImageField(upload_to="ingredients/", storage=ContentHashStorage(), null=True, blank=True)
+    image_widths = models.JSONField(null=True, blank=True, editable=False)  # built derivatives, see images.get_srcset
     ingredient_type = models.CharField(max_length=10, choices=INGREDIENT_TYPES, default="other")
     step = models.FloatField(default=1, validators=[MinValueValidator(0.05), MaxValueValidator(5)])
     min_order = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(50)])
@@ -106,6 +219,8 @@ class Ingredient(models.Model):
     purchase_price = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(999)])
     price_multiplier = models.FloatField(default=3.00, validators=[MinValueValidator(0)])
     selling_price = models.IntegerField(null=True, blank=True, validators=[MinValueValidator(0)])
+    effective_price = models.IntegerField(default=0, editable=False)  # get_selling_price, kept by save() & update()
+    stock = models.FloatField(null=True, blank=True, validators=[MinValueValidator(0)])  # grams, None - not counted, see StockMovement
 
     # for 100g
     nutritional_value = models.OneToOneField(NutritionalValue, on_delete=models.PROTECT, related_name="ingredient")
@@ -119,7 +234,8 @@ class Ingredient(models.Model):
             raise ValidationError("Step must be between 0.1 and 5.")
         if self.selling_price is not None and self.selling_price < self.purchase_price:
             raise ValidationError("Selling price must be greater than or equal to the Purchase.")
-        self.check_official_products_usage()
+        if self.is_dirty("is_menu"):
+            self.check_official_products_usage()
 
     def check_official_products_usage(self):
         """
@@ -133,14 +249,32 @@ class Ingredient(models.Model):
                 products_list = ", ".join(official_products)
                 raise ValidationError(f"Cannot remove ingredient from menu as it is used in official products: {products_list}")
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
-        if not self.nutritional_value:
+        if not self.nutritional_value_id:
             self.nutritional_value = NutritionalValue.objects.create()
-        self.full_clean()
-        if self.is_menu:
-            self.recalculate_products_availability()
+        dirty_fields = self.get_dirty_fields()
+        if dirty_fields is None or dirty_fields:
+            self.full_clean(exclude=self.get_unchanged_fields(dirty_fields))
+        propagate_availability = self.is_menu and self.is_dirty("is_menu", "is_available")
+        if self.pk and self.is_dirty("image"):
+            self.image_widths = None  # stored again after the new image's build, see catalog.image_saved
+        self.effective_price = self.get_selling_price()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not self.PRICE_FIELDS.isdisjoint(update_fields):
+            kwargs["update_fields"] = {*update_fields, "effective_price"}
         super().save(*args, **kwargs)
 
+        # After the row - the products' change is logged after the ingredient's, both go or neither
+        if propagate_availability:
+            self.recalculate_products_availability()
+
+        # Calorie grids of the menu dishes are bounded by the weights allowed here
+        if dirty_fields and not self.GRID_FIELDS.isdisjoint(dirty_fields):
+            for product_id in Product.objects.filter(is_menu=True, productingredient__ingredient=self) \
+                    .values_list("id", flat=True).distinct():
+                schedule_product_recompute(product_id)
+
     def get_selling_price_for_weight(self, weight):
         price = self.get_selling_price() * weight
         return round(price)
@@ -148,41 +282,107 @@ class Ingredient(models.Model):
     def get_selling_price(self):
         if self.selling_price is not None and self.selling_price > 0:
             return self.selling_price
-        return round(self.purchase_price * self.price_multiplier)
-
-    def recalculate_products_availability(self):
-        # Get ALL products which MENU and have this ingredient
-        affected_products = Product.objects.filter(is_menu=True, ingredients=self).select_related('nutritional_value')
-
-        if not self.is_available:
-            # If not available - get ALL products that doesn't have this ingredient in lack_of_ingredients
-            products_to_update = affected_products.exclude(lack_of_ingredients=self)
-
-            # Add this ingredient to lack_of_ingredients & set product is_available to False
-            for product in products_to_update:
-                product.lack_of_ingredients.add(self)
-                if product.is_available:
-                    product.is_available = False
-                    product.save(update_fields=['is_available'])
+        return round_half_up(self.purchase_price * self.price_multiplier)
 
-        else:
-            # Get ALL products that have this ingredient in lack_of_ingredients
-            products_with_lack = affected_products.filter(lack_of_ingredients=self)
+    @staticmethod
+    def get_effective_price_expression(purchase_price=F("purchase_price"), price_multiplier=F("price_multiplier"),
+                                       selling_price=F("selling_price")):
+        """ get_selling_price in SQL, new values can be given instead of the columns """
+        selling_price = as_expression(selling_price)
+        return Case(When(GreaterThan(selling_price, 0), then=selling_price),
+                    default=sql_round(as_expression(purchase_price) * as_expression(price_multiplier)), output_field=IntegerField())
 
-            # delete from lack_of_ingredients
-            for product in products_with_lack:
-                product.lack_of_ingredients.remove(self)
+    def recalculate_products_availability(self):
+        if self.pk:
+            Ingredient.propagate_availability({self.pk: self.is_available})
 
-                # If lack_of_ingredients is empty and product is_enabled, change product is_available to True
-                if not product.lack_of_ingredients.exists() and product.is_enabled:
-                    product.is_available = True
-                    product.save(update_fields=['is_available'])
+    @staticmethod
+    def propagate_availability(availability):
+        """
+        Applies availability of ingredients to the menu products that use them, set-based:
+        lack_of_ingredients rows are inserted / deleted in bulk, then products' is_available (enabled & nothing lacking,
+        as Product.save) is written with one UPDATE - only for the products where it changes.
+        :param availability: {ingredient id: is_available}, new values - they can be not saved yet
+        :return: {product id: is_available} of the changed products
+        """
+        from core.utils import catalog  # catalog.py imports this module
+
+        lacking = Product.lack_of_ingredients.through
+        unavailable = {ingredient_id for ingredient_id, is_available in availability.items() if not is_available}
+        uses = set(ProductIngredient.objects.filter(product__is_menu=True, ingredient_id__in=availability)
+                   .values_list("product_id", "ingredient_id"))
+        product_ids = {product_id for product_id, _ in uses}
+        if not product_ids:
+            return {}
+
+        lacking.objects.bulk_create([lacking(product_id=product_id, ingredient_id=ingredient_id)
+                                     for product_id, ingredient_id in uses if ingredient_id in unavailable], ignore_conflicts=True)
+        lacking.objects.filter(product_id__in=product_ids, ingredient_id__in=availability.keys() - unavailable).delete()
+
+        products = Product.objects.filter(id__in=product_ids).annotate(
+            lacks=Exists(lacking.objects.filter(product_id=OuterRef("pk")))).values_list("id", "is_enabled", "is_available", "lacks")
+        changed = {product_id: is_enabled and not lacks for product_id, is_enabled, is_available, lacks in products
+                   if (is_enabled and not lacks) != is_available}
+        if changed:
+            available_ids = [product_id for product_id, is_available in changed.items() if is_available]
+            Product.objects.filter(id__in=changed).update(
+                is_available=Case(When(id__in=available_ids, then=Value(True)), default=Value(False), output_field=BooleanField()))
+            catalog.on_catalog_changes(CatalogChange.PRODUCT, list(changed))
+        return changed
+
+    def update_products(self, nutrition_delta, purchase_price_delta):
+        """
+        Applies a change of this ingredient to every product that uses it, set-based, products are not loaded or saved.
+        Not menu products ("N kCal" copies, custom meals) get the changed totals summed again from their ProductIngredient
+        rows in the same UPDATE, as Product.calculate_composition - nothing drifts however many edits there were.
+        Menu products are recomputed as a whole after the commit (their calorie grids too).
+        Not menu products are logged as CatalogChange here - products control lists them, its ETag has to change too.
+        :param nutrition_delta: NutrientVector, new - old nutrition for 100g - only the changed nutrients are summed
+        :param purchase_price_delta: new - old purchase price
+        :return: ids of the menu products that changed
+        """
+        from core.utils import catalog  # catalog.py imports this module
+
+        changed_nutrients = [field for field, value in nutrition_delta.to_dict().items() if value]
+        if not changed_nutrients and not purchase_price_delta:
+            return []
+
+        def get_total(product_path, expression):
+            """ Sum over the ProductIngredient rows of the product of the outer row """
+            return Subquery(ProductIngredient.objects.filter(**{product_path: OuterRef("pk")}).values(product_path)
+                            .annotate(total=Sum(expression)).values("total"), output_field=FloatField())
+
+        if changed_nutrients:
+            # Products keep 1 decimal, as Product.calculate_composition
+            NutritionalValue.objects.filter(product__productingredient__ingredient=self, product__is_menu=False).update(**{
+                field: sql_round(get_total("product__nutritional_value", F(f"ingredient__nutritional_value__{field}")
+                                           * F("weight_grams")) / 10) / 10
+                for field in changed_nutrients})
+        if purchase_price_delta:
+            Product.objects.filter(productingredient__ingredient=self, is_menu=False).update(
+                price=sql_round(get_total("product", F("ingredient__purchase_price") * F("weight_grams"))))
+        catalog.on_catalog_changes(CatalogChange.PRODUCT, list(
+            Product.objects.filter(productingredient__ingredient=self, is_menu=False).values_list("id", flat=True).distinct()))
+
+        menu_product_ids = list(Product.objects.filter(is_menu=True, productingredient__ingredient=self)
+                                .values_list("id", flat=True).distinct())
+        for product_id in menu_product_ids:
+            schedule_product_recompute(product_id)
+        return menu_product_ids
 
     def __str__(self):
         return f"Ingredient ({self.id}): {self.name}"
 
 
-class Product(models.Model):
+class Product(DirtyFieldsMixin, models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=["effective_price"]),
+        ]
+
+    objects = EffectivePriceQuerySet.as_manager()
+    PRICE_FIELDS = frozenset(("price", "price_multiplier", "selling_price"))
+
     PRODUCT_TYPES = (
         ("dish", "Dish"),
         ("drink", "Drink"),
@@ -192,7 +392,8 @@ class Product(models.Model):
 
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
-    image = models.ImageField(upload_to="products/", null=True, blank=True)
+    image = models.ImageField(upload_to="products/", storage=ContentHashStorage(), null=True, blank=True)
+    image_widths = models.JSONField(null=True, blank=True, editable=False)  # built derivatives, see images.get_srcset
     is_menu = models.BooleanField(default=False)  # for Menu
     is_official = models.BooleanField()  # True - copy of Menu w/ different kCal, False - custom meal
     is_available = models.BooleanField(default=False)  # for Menu if there's no Ingredients
@@ -201,12 +402,26 @@ class Product(models.Model):
     price = models.IntegerField(null=True, blank=True, validators=[MinValueValidator(0)])
     price_multiplier = models.FloatField(default=3.0, validators=[MinValueValidator(0)])
     selling_price = models.IntegerField(null=True, blank=True, validators=[MinValueValidator(0)])
+    effective_price = models.FloatField(null=True, editable=False)  # get_selling_price, kept by save() & update()
     weight = models.IntegerField(blank=True, null=True, validators=[MinValueValidator(0)])
+    calorie_grid = models.JSONField(null=True, blank=True, editable=False)  # menu dishes, see build_calorie_grid
 
     ingredients = models.ManyToManyField("Ingredient", through="ProductIngredient")
     lack_of_ingredients = models.ManyToManyField("Ingredient", related_name="products_lacking", blank=True)
     nutritional_value = models.OneToOneField(NutritionalValue, on_delete=models.PROTECT, related_name="product")
 
+    # update_from_ingredients results depend on them (besides the ingredients)
+    RECOMPUTE_FIELDS = frozenset(("is_menu", "product_type", "price_multiplier", "selling_price"))
+
+    was_menu = False  # is_menu as it was loaded from DB
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "is_menu" in field_names:
+            instance.was_menu = instance.is_menu
+        return instance
+
     def clean(self):
         super().clean()
         if self.is_menu and (not self.image or not self.name or not self.description):
@@ -217,14 +432,15 @@ class Product(models.Model):
 
     @transaction.atomic
     def save(self, *args, **kwargs):
-        try:
-            self.nutritional_value
-        except AttributeError:
+        if not self.nutritional_value_id:
             self.nutritional_value = NutritionalValue.objects.create()
 
-        self.full_clean()
+        dirty_fields = self.get_dirty_fields()
+        if dirty_fields is None or dirty_fields:
+            self.full_clean(exclude=self.get_unchanged_fields(dirty_fields))
 
-        if self.pk:
+        # Lack of ingredients is kept by Ingredient.propagate_availability, here only is_menu & is_enabled matter
+        if self.pk and self.is_dirty("is_menu", "is_enabled"):
             # if Menu & but not Enabled = than it's not available
             if self.is_menu and not self.is_enabled:
                 self.is_available = False
@@ -232,47 +448,138 @@ class Product(models.Model):
             if self.is_menu and self.is_enabled and self.lack_of_ingredients.exists() == 0:
                 self.is_available = True
 
+        if self.pk and self.is_dirty("image"):
+            self.image_widths = None  # stored again after the new image's build, see catalog.image_saved
+        self.effective_price = self.calculate_effective_price()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not self.PRICE_FIELDS.isdisjoint(update_fields):
+            kwargs["update_fields"] = {*update_fields, "effective_price"}
+        saved_fields = update_fields if update_fields is not None else dirty_fields
         super().save(*args, **kwargs)
 
-        if Product.objects.get(pk=self.pk).productingredient_set.exists():
-            new_nutritional_value, total_weight = self.calculate_nutritional_value()
-            NutritionalValue.objects.filter(id=self.nutritional_value.id).update(**new_nutritional_value.to_dict())
-
-            self.weight = round(total_weight) if total_weight > 0 else None
-            self.price = self.calculate_base_price()
-            Product.objects.filter(pk=self.pk).update(weight=self.weight, price=self.price)
-
-    def calculate_nutritional_value(self):
-        nutritional_value = NutritionalValue()
-        product_ingredients = self.productingredient_set.select_related('ingredient__nutritional_value').all()
-
-        if not product_ingredients.exists():
-            return nutritional_value, 0
-
-        total_weight = product_ingredients.aggregate(total=Sum("weight_grams"))["total"] or 0
+        # The ingredients are watched by ProductIngredient receivers, here - fields the composition & the grid depend on
+        if saved_fields is None or not self.RECOMPUTE_FIELDS.isdisjoint(saved_fields):
+            schedule_product_recompute(self.pk)
+
+    def update_from_ingredients(self):
+        """ Nutrition, weight, base price & calorie grid from the ingredients: one aggregate query + two updates """
+        composition = self.calculate_composition()
+        if composition is None:
+            return
+        nutritional_value, total_weight, self.price = composition
+        self.effective_price = self.calculate_effective_price()  # the update() below writes the same in SQL
+        self.weight = round(total_weight) if total_weight > 0 else None
+        self.calorie_grid = None
+        if self.is_menu and self.is_dish():
+            ingredients = self.productingredient_set.order_by("id").values_list(
+                "ingredient_id", "weight_grams", "ingredient__min_order", "ingredient__max_order")  # id order, as checkout sums them
+            self.calorie_grid = self.build_calorie_grid(nutritional_value, list(ingredients))
+
+        NutritionalValue.objects.filter(id=self.nutritional_value_id).update(**nutritional_value.to_dict())
+        Product.objects.filter(pk=self.pk).update(weight=self.weight, price=self.price, calorie_grid=self.calorie_grid)
+
+    def build_calorie_grid(self, nutritional_value, ingredients):
+        """
+        Customers pick the calories of a dish - everything for every CALORIE_GRID_STEP kCal is calculated here once:
+        {"step", "min", "max", "nutrients": [names], "composition": {"<ingredient id>": grams},
+         "points": {"<kCal>": {"price", "weight", "nutrients": [values], "ingredients": {"<ingredient id>": grams}}}}
+        The dish is scaled as a whole, so its range is where every ingredient stays in its min_order - max_order.
+        A dish that can't be scaled at all (its own weights are out of them) has the one point of its calories.
+        :param nutritional_value: NutrientVector of the dish
+        :param ingredients: [(ingredient_id, weight_grams, min_order, max_order)]
+        :return: None if the dish has no calories
+        """
+        base_calories = nutritional_value["calories"]
+        if not base_calories or not self.weight:
+            return None
+
+        composition = self.get_grid_composition((ingredient_id, weight_grams) for ingredient_id, weight_grams, _, _ in ingredients)
+        limits = {str(ingredient_id): (min_order, max_order) for ingredient_id, _, min_order, max_order in ingredients}
+        weighted = [(grams, *limits[key]) for key, grams in composition.items() if grams > 0]
+        low = max((min_order / grams for grams, min_order, _ in weighted), default=0)
+        high = min((max_order / grams for grams, _, max_order in weighted), default=0)
+        min_calories = max(math.ceil(base_calories * low / CALORIE_GRID_STEP), 1) * CALORIE_GRID_STEP
+        max_calories = math.floor(base_calories * high / CALORIE_GRID_STEP) * CALORIE_GRID_STEP
+        if min_calories > max_calories:
+            min_calories = max_calories = max(round(base_calories / CALORIE_GRID_STEP), 1) * CALORIE_GRID_STEP
+
+        selling_price = self.get_selling_price()
+        points = {}
+        for calories in range(min_calories, max_calories + 1, CALORIE_GRID_STEP):
+            factor = calories / base_calories
+            points[str(calories)] = {
+                "price": round(selling_price * factor),
+                "weight": round(self.weight * factor, 1),
+                "nutrients": [round(nutritional_value[field] * factor, 1) for field in CALORIE_GRID_NUTRIENTS],
+                "ingredients": {key: round(grams * factor, 1) for key, grams in composition.items()},
+            }
+        return {"step": CALORIE_GRID_STEP, "min": min_calories, "max": max_calories, "nutrients": CALORIE_GRID_NUTRIENTS,
+                "composition": composition, "points": points}
 
-        for product_ingredient in product_ingredients:
-            ingredient = product_ingredient.ingredient
-            weight_ratio = product_ingredient.weight_grams / 100
+    @staticmethod
+    def get_grid_composition(ingredients):
+        """
+        What a calorie grid is built from - the grid is used only while the dish still has exactly that
+        :param ingredients: [(ingredient_id, weight_grams)]
+        :return: {"<ingredient id>": grams} (keys as JSON keeps them), an ingredient that is in the dish twice - summed
+        """
+        composition = {}
+        for ingredient_id, weight_grams in ingredients:
+            composition[str(ingredient_id)] = composition.get(str(ingredient_id), 0) + weight_grams
+        return composition
 
-            for field in NutritionalValue._meta.fields:
-                if field.name != "id":
-                    current_value = getattr(nutritional_value, field.name) or 0
-                    ingredient_value = getattr(ingredient.nutritional_value, field.name) or 0
-                    new_value = current_value + (ingredient_value * weight_ratio)
-                    setattr(nutritional_value, field.name, round(new_value, 1))
+    def get_calorie_point(self, calories, composition):
+        """
+        :param composition: the dish's current one, see get_grid_composition
+        :return: point of the calorie grid, None if there's no grid or the calories are not on it
+        :raises ValidationError: the grid is built from another composition (the dish has just changed)
+        """
+        if not self.calorie_grid:
+            return None
+        if self.calorie_grid.get("composition") != composition:
+            raise ValidationError(message=f"Official Meal - {self.name} has just changed, please reload the menu.")
+        if not isinstance(calories, int):
+            return None
+        return self.calorie_grid["points"].get(str(calories))
+
+    def calculate_composition(self):
+        """
+        Sums over ProductIngredient joined to Ingredient & NutritionalValue, in one query
+        :return: NutrientVector rounded to 1 decimal, total weight, base price. None if there are no ingredients
+        """
+        from core.utils.nutrients import NutrientVector  # nutrients.py imports this module
 
-        return nutritional_value, total_weight
+        totals = self.productingredient_set.aggregate(
+            count=Count("id"),
+            total_weight=Sum("weight_grams"),
+            total_price=Sum(F("ingredient__purchase_price") * F("weight_grams")),
+            **{field: Sum(F(f"ingredient__nutritional_value__{field}") * F("weight_grams")) for field in NUTRIENT_FIELDS},
+        )
+        if not totals["count"]:
+            return None
 
-    def calculate_base_price(self):
-        total_price = self.productingredient_set.aggregate(total=Sum(F("ingredient__purchase_price") * F("weight_grams")))["total"] or 0
-        return round(total_price)
+        # Rounded as Ingredient.update_products does it in SQL
+        nutritional_value = NutrientVector(round_half_up((totals[field] or 0) / 10) / 10 for field in NUTRIENT_FIELDS)
+        return nutritional_value, totals["total_weight"] or 0, round_half_up(totals["total_price"] or 0)
 
     def get_selling_price(self):
         if self.selling_price is not None and self.selling_price > 0:
             return self.selling_price
         return self.price * self.price_multiplier
 
+    def calculate_effective_price(self):
+        """ get_selling_price, None while there's no price yet (new product before its ingredients) """
+        if self.price is None and not self.selling_price:
+            return None
+        return self.get_selling_price()
+
+    @staticmethod
+    def get_effective_price_expression(price=F("price"), price_multiplier=F("price_multiplier"), selling_price=F("selling_price")):
+        """ get_selling_price in SQL, new values can be given instead of the columns """
+        selling_price = as_expression(selling_price)
+        return Case(When(GreaterThan(selling_price, 0), then=selling_price),
+                    default=as_expression(price) * as_expression(price_multiplier), output_field=FloatField())
+
     def get_price_for_calories(self, calories):
         price_factor = calories / self.nutritional_value.calories
         return self.get_selling_price() * price_factor
@@ -305,7 +612,126 @@ class ProductIngredient(models.Model):
         super().save(*args, **kwargs)
 
 
-class Order(models.Model):
+# Product nutrition, weight & price are recomputed once per product when the transaction is committed,
+# however many ProductIngredient rows & Product.save() calls there were. Pending ids are per thread (per connection)
+_recompute = threading.local()
+_recompute_stats_lock = threading.Lock()
+RECOMPUTE_STATS = {"requested": 0, "recomputed": 0}
+
+
+class PendingRecompute:
+    """
+    Products marked in one transaction. Its flush is the transaction's on_commit callback, registered once.
+    Django drops the callbacks of a rolled back transaction (or savepoint) - the dropped one forgets the ids with it.
+    """
+
+    def __init__(self):
+        self.product_ids = set()
+        self.requested = 0
+        self.registered = False  # flush is waiting for the commit
+
+    def register(self):
+        self.registered = True
+        callback = partial(self.flush)  # an object of its own - nothing but the transaction keeps it
+        weakref.finalize(callback, self.discard)
+        transaction.on_commit(callback, robust=True)  # out of a transaction - right now
+
+    def discard(self):
+        if self.registered:  # dropped, not called - rolled back
+            self.registered = False
+            self.product_ids = set()
+            self.requested = 0
+
+    def flush(self):
+        self.registered = False
+        if getattr(_recompute, "pending", None) is self:
+            _recompute.pending = None
+        with _recompute_stats_lock:
+            RECOMPUTE_STATS["requested"] += self.requested
+        try:
+            recompute_products(self.product_ids)
+        except Exception:  # the transaction is committed already (f.e. a paid order) - its request must not fail
+            logger.exception("Products recompute failed: %s", sorted(self.product_ids))
+
+
+def schedule_product_recompute(product_id):
+    pending = getattr(_recompute, "pending", None)
+    if pending is None:
+        pending = _recompute.pending = PendingRecompute()
+    pending.product_ids.add(product_id)
+    pending.requested += 1
+    if not pending.registered:
+        pending.register()
+
+
+def recompute_products(product_ids):
+    from core.utils import catalog  # catalog.py imports this module
+
+    with transaction.atomic():
+        products = list(Product.objects.filter(id__in=product_ids).only(
+            "id", "is_menu", "product_type", "selling_price", "price_multiplier", "nutritional_value_id"))
+        for product in products:
+            product.update_from_ingredients()
+        # Already committed with the old values - the menu has to see one more change
+        catalog.on_catalog_changes(CatalogChange.PRODUCT, [product.id for product in products if product.is_menu])
+
+    with _recompute_stats_lock:
+        RECOMPUTE_STATS["recomputed"] += len(products)
+
+
+def backfill_calorie_grids(**kwargs):
+    """
+    post_migrate - menu dishes without a calorie grid of the current format (saved before it) get one,
+    checkout doesn't fall back to scaling the whole dish for them. See Product.build_calorie_grid
+    """
+    grids = Product.objects.filter(is_menu=True, product_type="dish").values_list("id", "calorie_grid")
+    product_ids = [product_id for product_id, calorie_grid in grids if not calorie_grid or "composition" not in calorie_grid]
+    if product_ids:
+        recompute_products(product_ids)
+
+
+def get_recompute_stats():
+    """
+    Of the committed transactions: requested - how many times products were marked, recomputed - how many recomputes
+    ran, coalesced - saved ones. See api.get_cache_stats
+    """
+    with _recompute_stats_lock:
+        return {**RECOMPUTE_STATS, "coalesced": RECOMPUTE_STATS["requested"] - RECOMPUTE_STATS["recomputed"]}
+
+
+@receiver([post_save, post_delete], sender=ProductIngredient)
+def product_ingredient_changed(sender, instance, **kwargs):
+    schedule_product_recompute(instance.product_id)
+
+
+class CatalogChange(models.Model):
+    """
+    Log of writes to the catalog (Product, ProductIngredient, Ingredient, NutritionalValue).
+    id of the last row is the catalog version, clients use it to ask for changes since their version.
+    """
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at"]),
+        ]
+
+    PRODUCT = "product"
+    INGREDIENT = "ingredient"
+    NUTRITIONAL_VALUE = "nutritional_value"
+
+    MODELS = (
+        (PRODUCT, "Product"),
+        (INGREDIENT, "Ingredient"),
+        (NUTRITIONAL_VALUE, "Nutritional Value"),  # resolved to its Product/Ingredient when the delta is built
+    )
+    model = models.CharField(max_length=20, choices=MODELS)
+    object_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Catalog v{self.id}: {self.model} #{self.object_id}"
+
+
+class Order(DirtyFieldsMixin, models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['order_status']),
@@ -317,6 +743,7 @@ class Order(models.Model):
             models.Index(fields=['user_id']),
             models.Index(fields=['created_at', 'user_id']),
             models.Index(fields=['order_status', 'paid_at']),
+            models.Index(fields=['updated_at']),
         ]
 
     PENDING = "pending"
@@ -401,7 +828,15 @@ class Order(models.Model):
             raise ValidationError("Please specify the user making the update.")
 
     def save(self, *args, **kwargs):
-        super().full_clean()
+        from core.utils import events, stock  # both import this module
+
+        dirty_fields = self.get_dirty_fields()
+        if dirty_fields is not None and not dirty_fields and kwargs.get("update_fields") is None:
+            return  # nothing changed - no write, no OrderHistory row
+        super().full_clean(exclude=self.get_unchanged_fields(dirty_fields))
+        # Cancelled or refunded - the ingredients go back to stock (once, see stock.restock_order)
+        restock = self.pk and self.is_dirty("order_status", "is_refunded") \
+            and (self.order_status == self.CANCELLED or self.is_refunded)
         if self.is_refunded and self.refunded_at is None:
             self.refunded_at = timezone.now()
 
@@ -412,6 +847,9 @@ class Order(models.Model):
             self.ready_at = timezone.now()
 
         super().save(*args, **kwargs)
+        if restock:
+            stock.restock_order(self)
+        transaction.on_commit(events.notify)  # the Customer's tablet gets the new status
 
     def __str__(self):
         return f"Order {self.id}"
@@ -545,6 +983,7 @@ class Promo(models.Model):
     usage_limit = models.IntegerField(validators=[MinValueValidator(0)])
     used_count = models.IntegerField(default=0, validators=[MinValueValidator(0)])
     creator = models.ForeignKey(User, on_delete=models.PROTECT, related_name="creator")
+    updated_at = models.DateTimeField(auto_now=True)
 
     def clean(self):
         super().clean()
@@ -609,3 +1048,28 @@ class Purchase(models.Model):
     creator = models.ForeignKey(User, on_delete=models.PROTECT, related_name="purchase_creator")
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
+
+
+class StockMovement(models.Model):
+    """
+    Ledger of Ingredient.stock, grams: + came in, - went out. Checkout writes "-" rows of the order,
+    a cancel / refund reverses what is left of them, purchases write "+" rows. See utils/stock.py
+    """
+    CHECKOUT = "checkout"
+    RESTOCK = "restock"
+    PURCHASE = "purchase"
+
+    REASONS = (
+        (CHECKOUT, "Checkout"),
+        (RESTOCK, "Restock"),  # order cancelled or refunded
+        (PURCHASE, "Purchase"),
+    )
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name="stock_movements")
+    grams = models.FloatField()
+    reason = models.CharField(max_length=20, choices=REASONS)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name="stock_movements")
+    purchase = models.ForeignKey(Purchase, on_delete=models.SET_NULL, null=True, blank=True, related_name="stock_movements")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.ingredient_id}: {self.grams:+}g ({self.reason})"
@@ -0,0 +1,329 @@
+# catalog.py
+
+import logging
+import threading
+import time
+import weakref
+from datetime import timedelta
+from functools import partial
+
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Prefetch, Max, Min
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from core.models import Product, ProductIngredient, Ingredient, NutritionalValue, CatalogChange, NUTRIENT_FIELDS
+from core.utils import utils_api, responses, images
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = "catalog_version"
+LAST_CATALOG_VERSION_KEY = "catalog_version:last"  # the last one read from DB, kept while DB is not readable
+SNAPSHOT_KEY = "catalog_snapshot:{}"
+SNAPSHOT_BUILD_LOCK_KEY = "catalog_snapshot:{}:lock"
+
+CATALOG_VERSION_TIMEOUT = 5  # seconds, re-read from DB - for processes that don't share the cache
+CATALOG_CHANGES_KEEP = timedelta(days=7)  # older clients get the full catalog instead of a delta
+DELTA_MAX_CHANGES = 200  # more changed items than that - it's cheaper to send the full catalog
+
+BUILD_LOCK_TIMEOUT = 30  # seconds, the lock expires by itself if the builder dies
+NUTRIENTS_SNAPSHOT_TIMEOUT = 60 * 60  # seconds, snapshots of some nutrients - any set can be asked, unused ones go away
+COLD_START_WAIT = 5  # seconds, how long to wait for another builder when there's no snapshot yet
+
+_catalog_commit = threading.local()  # callback - weak reference to on_commit_catalog_change registered by this thread
+
+
+def get_catalog_version():
+    """
+    Version of everything the menu is built from (Product, ProductIngredient, Ingredient, NutritionalValue),
+    id of the last CatalogChange. Kept in the cache, dropped from it when a change is committed.
+    Read in a transaction it can count the transaction's own changes - then it's not cached for the others.
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is not None:
+        return version
+
+    try:
+        version = CatalogChange.objects.aggregate(version=Max("id"))["version"] or 0
+    except DatabaseError:  # f.e. "database is locked"
+        version = cache.get(LAST_CATALOG_VERSION_KEY)
+        if version is None:
+            raise
+        logger.exception("Catalog version read failed, using version %s", version)
+        return version
+
+    if not connection.in_atomic_block:
+        cache.set(CATALOG_VERSION_KEY, version, timeout=CATALOG_VERSION_TIMEOUT)
+        cache.set(LAST_CATALOG_VERSION_KEY, version, timeout=None)
+    return version
+
+
+def on_commit_catalog_change():
+    from core.utils import events  # events.py imports this module
+    _catalog_commit.callback = None
+    cache.delete(CATALOG_VERSION_KEY)
+    events.notify()
+    # The last change is always kept, otherwise the version would go back to 0
+    last_id = CatalogChange.objects.aggregate(last_id=Max("id"))["last_id"]
+    CatalogChange.objects.filter(created_at__lt=timezone.now() - CATALOG_CHANGES_KEEP, id__lt=last_id).delete()
+
+
+def build_menu(menu_format=2, nutrients=NUTRIENT_FIELDS):
+    """ Format 1 - every product embeds its ingredients, format 2 - normalized, see utils_api.get_menu """
+    products = Product.objects.filter(is_menu=True)
+    if menu_format == 1:
+        product_ingredients = utils_api.only_nutrients(ProductIngredient.objects.select_related("ingredient__nutritional_value"),
+                                                       nutrients, prefix="ingredient__nutritional_value__")
+        products = utils_api.only_nutrients(products.select_related("nutritional_value"), nutrients).prefetch_related(
+            Prefetch("productingredient_set", queryset=product_ingredients))
+        return {"products": utils_api.get_all_products(products, nutrients)}
+    from core.utils import similarity  # similarity.py imports this module
+    return {**utils_api.get_menu(products, nutrients=nutrients), "similar": similarity.get_similar()}
+
+
+def build_ingredients(ingredients_format=2, nutrients=NUTRIENT_FIELDS):
+    ingredients = utils_api.only_nutrients(Ingredient.objects.filter(is_menu=True).select_related("nutritional_value"), nutrients)
+    if ingredients_format == 1:
+        return {"ingredients": [utils_api.get_ingredient_data(ingredient, nutrients=nutrients) for ingredient in ingredients]}
+    return utils_api.get_ingredients_catalog(ingredients, nutrients)
+
+
+def build_ingredients_control(admin=False):
+    if admin:
+        return {"ingredients": [utils_api.get_ingredient_data_lite(ingredient, admin=True) for ingredient in Ingredient.objects.all()]}
+    return {"ingredients": [utils_api.get_ingredient_data_lite(ingredient) for ingredient in Ingredient.objects.filter(is_menu=True)]}
+
+
+# name -> (builder, key of the list in the built data)
+SNAPSHOTS = {
+    "menu_v1": (partial(build_menu, 1), "products"),
+    "menu_v2": (partial(build_menu, 2), "products"),
+    "ingredients_v1": (partial(build_ingredients, 1), "ingredients"),
+    "ingredients_v2": (partial(build_ingredients, 2), "ingredients"),
+    "ingredients_control": (partial(build_ingredients_control, admin=False), "ingredients"),
+    "ingredients_control_admin": (partial(build_ingredients_control, admin=True), "ingredients"),
+}
+
+
+def get_snapshot(name, nutrients=NUTRIENT_FIELDS):
+    """
+    Returns pre-serialized & pre-compressed catalog data:
+    {"name": str, "version": int, "count": int, "encodings": {"identity": bytes, "gzip": bytes, ["br": bytes]}}
+    Only one request rebuilds an outdated snapshot, the others get the last good one (stale-while-revalidate).
+    "hit" key is added for the current request - True if nothing was built for it.
+    :param nutrients: menu & ingredients only - a snapshot of its own for every set, see utils_api.get_nutrients_param
+    """
+    variant = get_snapshot_variant(name, nutrients)
+    snapshot_key = SNAPSHOT_KEY.format(variant)
+    lock_key = SNAPSHOT_BUILD_LOCK_KEY.format(variant)
+
+    version = get_catalog_version()
+    snapshot = cache.get(snapshot_key)
+    if snapshot and snapshot["version"] == version:
+        return {**snapshot, "hit": True}
+
+    if cache.add(lock_key, True, timeout=BUILD_LOCK_TIMEOUT):
+        try:
+            return {**build_snapshot(name, version, nutrients), "hit": False}
+        except DatabaseError:  # f.e. "database is locked"
+            if snapshot:
+                logger.exception("Snapshot %s rebuild failed, serving version %s", name, snapshot["version"])
+                return {**snapshot, "hit": True}
+            raise
+        finally:
+            cache.delete(lock_key)
+
+    if snapshot:
+        return {**snapshot, "hit": True}
+
+    # Cold start & somebody is building already - wait for him instead of building the same data again
+    deadline = time.monotonic() + COLD_START_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        snapshot = cache.get(snapshot_key)
+        if snapshot:
+            return {**snapshot, "hit": True}
+    return {**build_snapshot(name, version, nutrients), "hit": False}
+
+
+def get_snapshot_variant(name, nutrients=NUTRIENT_FIELDS):
+    """ "menu_v2" for all the nutrients, "menu_v2:calories,proteins" for some - they come in NUTRIENT_FIELDS order """
+    if nutrients == NUTRIENT_FIELDS:
+        return name
+    return f"{name}:{','.join(nutrients) or 'none'}"
+
+
+def build_snapshot(name, version, nutrients=NUTRIENT_FIELDS):
+    builder, list_key = SNAPSHOTS[name]
+    data = builder() if nutrients == NUTRIENT_FIELDS else builder(nutrients=nutrients)
+    if data.get("format") == 2:
+        data["version"] = version  # clients ask for changes since this version, see get_catalog_delta
+
+    snapshot = {
+        "name": name,
+        "version": version,
+        "count": len(data[list_key]),
+        "encodings": responses.compress(JSONRenderer().render(data)),
+    }
+    variant = get_snapshot_variant(name, nutrients)
+    cache.set(SNAPSHOT_KEY.format(variant), snapshot, timeout=None if variant == name else NUTRIENTS_SNAPSHOT_TIMEOUT)
+    logger.info("Snapshot %s v%s built: %s items, %s", variant, version, snapshot["count"],
+                ", ".join(f"{encoding} {len(body)} bytes" for encoding, body in snapshot["encodings"].items()))
+    return snapshot
+
+
+def snapshot_response(request, snapshot):
+    response = responses.encoded_response(request, snapshot["encodings"])
+    responses.count_stats(snapshot["name"], snapshot["hit"], len(snapshot["encodings"]["identity"]), len(response.content))
+    return response
+
+
+def get_snapshots_stats():
+    stats = []
+    snapshots = cache.get_many([SNAPSHOT_KEY.format(name) for name in SNAPSHOTS])
+    for name in SNAPSHOTS:
+        snapshot = snapshots.get(SNAPSHOT_KEY.format(name))
+        stats.append({
+            "name": name,
+            "version": snapshot["version"] if snapshot else None,
+            "sizes": {encoding: len(body) for encoding, body in snapshot["encodings"].items()} if snapshot else {},
+            **responses.get_stats(name),
+        })
+    return stats
+
+
+def get_changes(since: int, version: int):
+    """
+    Ids of Products & Ingredients changed after version "since" up to "version": {CatalogChange.PRODUCT: set, CatalogChange.INGREDIENT: set},
+    NutritionalValue changes are resolved to their Product/Ingredient. None if the log doesn't go back to "since".
+    """
+    oldest = CatalogChange.objects.aggregate(version=Min("id"))["version"]
+    if since <= 0 or since > version or (oldest is not None and since < oldest - 1):
+        return None
+
+    changes = CatalogChange.objects.filter(id__gt=since, id__lte=version).values_list("model", "object_id").distinct()
+    changed = {model: set() for model, _ in CatalogChange.MODELS}
+    for model, object_id in changes:
+        changed[model].add(object_id)
+
+    nutritional_values = changed.pop(CatalogChange.NUTRITIONAL_VALUE)
+    if nutritional_values:
+        changed[CatalogChange.PRODUCT].update(
+            Product.objects.filter(nutritional_value_id__in=nutritional_values).values_list("id", flat=True))
+        changed[CatalogChange.INGREDIENT].update(
+            Ingredient.objects.filter(nutritional_value_id__in=nutritional_values).values_list("id", flat=True))
+    return changed
+
+
+def get_catalog_delta(since: int):
+    """
+    Menu & ingredients changed since the given catalog version, in format 2 (see utils_api.get_menu):
+    {"version", "full": False, "nutrients", "menu": {"products", "ingredients"}, "ingredients", "removed": {"products", "ingredients"}}
+    "full": True - the version is too old (or unknown), the client has to load everything again.
+    """
+    from core.utils import similarity  # similarity.py imports this module
+    version = get_catalog_version()
+    changed = get_changes(since, version)
+    if changed is None:
+        return {"format": 2, "version": version, "full": True}
+
+    if len(changed[CatalogChange.PRODUCT]) + len(changed[CatalogChange.INGREDIENT]) > DELTA_MAX_CHANGES:
+        return {"format": 2, "version": version, "full": True}
+
+    products = Product.objects.filter(id__in=changed[CatalogChange.PRODUCT], is_menu=True)
+    ingredients = Ingredient.objects.filter(id__in=changed[CatalogChange.INGREDIENT], is_menu=True).select_related("nutritional_value")
+    # Changed ingredients are updated in the menu lookup too, if any menu product uses them
+    menu_ingredients = ProductIngredient.objects.filter(ingredient_id__in=changed[CatalogChange.INGREDIENT], product__is_menu=True)
+    menu = utils_api.get_menu(products, extra_ingredient_ids=menu_ingredients.values_list("ingredient_id", flat=True))
+    ingredients = utils_api.get_ingredients_catalog(ingredients)
+
+    return {
+        "format": 2,
+        "version": version,
+        "full": False,
+        "nutrients": NUTRIENT_FIELDS,
+        "menu": {"products": menu["products"], "ingredients": menu["ingredients"], "similar": similarity.get_similar()},
+        "ingredients": ingredients["ingredients"],
+        "removed": {
+            "products": sorted(changed[CatalogChange.PRODUCT] - {product["id"] for product in menu["products"]}),
+            "ingredients": sorted(changed[CatalogChange.INGREDIENT] - {ingredient["id"] for ingredient in ingredients["ingredients"]}),
+        },
+    }
+
+
+def schedule_catalog_commit():
+    """
+    on_commit_catalog_change once per transaction, however many changes it logs. The callback is kept alive only by
+    the transaction (a rolled back one drops it) - a dead reference means nothing is registered in this thread
+    """
+    registered = getattr(_catalog_commit, "callback", None)
+    if registered is not None and registered() is not None:
+        return
+    callback = partial(on_commit_catalog_change)
+    _catalog_commit.callback = weakref.ref(callback)
+    transaction.on_commit(callback)  # out of a transaction - right now
+
+
+def on_catalog_change(model, object_id):
+    """ The change is logged in the same transaction, readers see the new version only after commit """
+    CatalogChange.objects.create(model=model, object_id=object_id)
+    schedule_catalog_commit()
+
+
+def on_catalog_changes(model, object_ids):
+    """ on_catalog_change for many objects (set-based updates don't send signals), one insert """
+    if object_ids:
+        CatalogChange.objects.bulk_create(CatalogChange(model=model, object_id=object_id) for object_id in object_ids)
+        schedule_catalog_commit()
+
+
+@receiver([post_save, post_delete], sender=Ingredient)
+def ingredient_changed(sender, instance, **kwargs):
+    on_catalog_change(CatalogChange.INGREDIENT, instance.id)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    # Custom meals & "N kCal" copies are created on every checkout, they are not a part of the menu
+    if instance.is_menu or instance.was_menu:
+        on_catalog_change(CatalogChange.PRODUCT, instance.id)
+
+
+@receiver([post_save, post_delete], sender=ProductIngredient)
+def product_ingredient_changed(sender, instance, **kwargs):
+    if instance.product.is_menu:
+        on_catalog_change(CatalogChange.PRODUCT, instance.product_id)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Product)
+def image_saved(sender, instance, created=False, **kwargs):
+    """
+    New upload (create/update API, admin) - derivatives are built in background, then stored with the item.
+    Other saves don't touch the storage, "N kCal" copies are created with the widths of their dish.
+    """
+    # The same content uploaded again keeps the name - it's seen by the widths dropped in save()
+    if instance.image and instance.image_widths is None and (created or instance.is_dirty("image", "image_widths")):
+        images.schedule_derivatives(instance.image.name, callback=partial(derivatives_built, instance.image.name))
+
+
+def derivatives_built(name, widths):
+    """ Stores the widths with every item of the image (content-hashed names are shared), they count as changed """
+    with transaction.atomic():
+        for model, catalog_model in ((Ingredient, CatalogChange.INGREDIENT), (Product, CatalogChange.PRODUCT)):
+            items = model.objects.filter(image=name)
+            if model is Product:
+                items = items.filter(is_menu=True)  # custom meals & "N kCal" copies are not a part of the menu
+            item_ids = list(items.values_list("id", flat=True))
+            model.objects.filter(image=name).update(image_widths=widths)
+            on_catalog_changes(catalog_model, item_ids)
+
+
+@receiver([post_save, post_delete], sender=NutritionalValue)
+def nutritional_value_changed(sender, instance, created=False, **kwargs):
+    # New rows (orders, new products) are not linked to the menu yet
+    if not created:
+        on_catalog_change(CatalogChange.NUTRITIONAL_VALUE, instance.id)
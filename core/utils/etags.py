@@ -0,0 +1,111 @@
+# etags.py
+"""
+Validators for conditional GET (ETag / Last-Modified), used with django.views.decorators.http.condition.
+Each one costs a cache read or a single aggregate query - much less than building the response it validates.
+Responses can differ per role, so the role is always a part of the ETag.
+"""
+
+import hashlib
+from functools import wraps
+
+from django.db.models import Max, Count, Sum
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from core.models import Product, Order, OrderHistory, Promo, Purchase
+from core.utils import catalog, utils
+
+
+def conditional(etag_func, last_modified_func=None):
+    """
+    condition() + "Cache-Control: private, no-cache": browsers keep the response, but always revalidate it.
+    Without it Last-Modified lets them reuse f.e. an old order status without asking.
+    """
+    def decorator(view_func):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view_func)
+
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapped_view
+    return decorator
+
+
+def make_etag(request, *parts):
+    """ Weak ETag, the same data can be sent in different encodings """
+    key = "-".join(str(part) for part in (getattr(request.user, "role", None), *parts))
+    return f'W/"{hashlib.md5(key.encode()).hexdigest()}"'
+
+
+def catalog_etag(request, *args, **kwargs):
+    """ Menu, ingredients & everything else built from Product, ProductIngredient, Ingredient, NutritionalValue """
+    return make_etag(request, "catalog", catalog.get_catalog_version())
+
+
+def products_control_etag(request, *args, **kwargs):
+    # Custom meals & "N kCal" copies are listed for owner & administrator: new ones don't change the catalog version
+    # (changed by an ingredient they do, see Ingredient.update_products)
+    products = Product.objects.aggregate(last_id=Max("id"), count=Count("id"))
+    return make_etag(request, "products", catalog.get_catalog_version(), products["last_id"], products["count"])
+
+
+def get_last_order(request):
+    return Order.objects.filter(user=request.user).order_by("-created_at").values("id", "updated_at", "show_public").first()
+
+
+def last_order_etag(request, *args, **kwargs):
+    order = get_last_order(request)
+    if not order:
+        return make_etag(request, "order_last", None)
+    return make_etag(request, "order_last", order["id"], order["updated_at"].timestamp(), order["show_public"])
+
+
+def last_order_modified(request, *args, **kwargs):
+    order = get_last_order(request)
+    return order["updated_at"] if order else None
+
+
+def order_etag(request, pk=None, *args, **kwargs):
+    updated_at = order_modified(request, pk)
+    return make_etag(request, "order", pk, updated_at.timestamp() if updated_at else None)
+
+
+def order_modified(request, pk=None, *args, **kwargs):
+    return Order.objects.filter(pk=pk).values_list("updated_at", flat=True).first()
+
+
+def orders_etag(request, *args, **kwargs):
+    """ Orders list depends on role, kitchen/control page & "today" for managers """
+    is_kitchen = (request.META.get("HTTP_REFERER") or "").endswith("kitchen/orders/")
+    today = utils.get_timezone_dates()[0].date() if getattr(request.user, "role", None) == "manager" else None
+    orders = Order.objects.aggregate(updated_at=Max("updated_at"), count=Count("id"))
+    updated_at = orders["updated_at"].timestamp() if orders["updated_at"] else None
+    return make_etag(request, "orders", is_kitchen, today, updated_at, orders["count"])
+
+
+def order_history_etag(request, pk=None, *args, **kwargs):
+    history = OrderHistory.objects.filter(order_id=pk).aggregate(last_id=Max("id"), count=Count("id"))
+    return make_etag(request, "order_history", pk, history["last_id"], history["count"])
+
+
+def promos_etag(request, *args, **kwargs):
+    """ Counters + active promos count: promo stops being active with time, without any update """
+    promos = Promo.objects.aggregate(updated_at=Max("updated_at"), count=Count("id"), used=Sum("used_count"))
+    updated_at = promos["updated_at"].timestamp() if promos["updated_at"] else None
+    return make_etag(request, "promos", updated_at, promos["count"], promos["used"], Promo.get_active_promos().count())
+
+
+def promo_etag(request, pk=None, *args, **kwargs):
+    promo = Promo.objects.filter(pk=pk).first()
+    if not promo:
+        return make_etag(request, "promo", pk, None)
+    return make_etag(request, "promo", pk, promo.updated_at.timestamp(), promo.used_count, promo.is_active())
+
+
+def purchases_etag(request, *args, **kwargs):
+    purchases = Purchase.objects.aggregate(updated_at=Max("updated_at"), count=Count("id"))
+    updated_at = purchases["updated_at"].timestamp() if purchases["updated_at"] else None
+    return make_etag(request, "purchases", updated_at, purchases["count"])
+
@@ -0,0 +1,269 @@
+# events.py
+"""
+Server-sent events: availability of the menu (products & ingredients) for everyone, status changes of an order
+for its Customer, every order change for the staff boards (control & kitchen). See api.get_events.
+
+One publisher per process - the Broker's watcher thread, started by the first subscriber & stopped BROKER_IDLE_TIMEOUT
+after the last one: a WSGI long poll reconnects every LONG_POLL_TIMEOUT, the watcher & what it has sent outlive that.
+Every EVENTS_POLL_INTERVAL it reads the catalog version & the orders updated since its last look - the same couple of
+queries however many tablets are connected - and puts the events into the subscribers' queues.
+Commits in this process wake it up right away (notify), changes of other processes are seen at the next tick.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from core.models import Product, Ingredient, Order, OrderProduct, CatalogChange
+from core.utils import catalog, utils_api
+
+logger = logging.getLogger(__name__)
+
+EVENTS_POLL_INTERVAL = 2  # seconds
+ORDERS_LAG = timedelta(seconds=10)  # orders are read again for that long - a transaction can commit after its updated_at
+KEEPALIVE_INTERVAL = 15  # seconds, a comment line - proxies don't drop an idle connection
+LONG_POLL_TIMEOUT = 25  # seconds, WSGI only - the stream ends & EventSource reconnects
+RECONNECT_DELAY = 3000  # ms, "retry" for EventSource
+BROKER_IDLE_TIMEOUT = 60  # seconds without subscribers before the watcher thread stops
+SUBSCRIBER_BACKLOG = 100  # events not read by a slow client, older ones are dropped
+
+ORDER_FIELDS = ("id", "user_id", "order_status", "is_paid", "is_refunded", "created_at", "paid_at", "ready_at", "updated_at")
+STAFF_ROLES = ("owner", "manager", "administrator", "kitchen")
+
+
+class Subscriber:
+    """ One connection. Events are put by the watcher thread, read by the connection's event loop (or thread, WSGI) """
+
+    def __init__(self, user_id, staff=False, loop=None):
+        self.user_id = user_id
+        self.staff = staff
+        self.loop = loop
+        self.events = deque(maxlen=SUBSCRIBER_BACKLOG)
+        self.ready = asyncio.Event() if loop else threading.Event()
+
+    def wants(self, name, data):
+        if name == "order":
+            return data["user_id"] == self.user_id
+        if name == "staff_order":
+            return self.staff
+        return True
+
+    def put(self, name, data):
+        self.events.append((name, data))
+        if self.loop:
+            try:
+                self.loop.call_soon_threadsafe(self.ready.set)
+            except RuntimeError:  # the loop is closed - the connection is gone, unsubscribe comes with it
+                pass
+        else:
+            self.ready.set()
+
+    def take(self):
+        self.ready.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
+class Broker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.subscribers = set()
+        self.thread = None
+        self.version = None
+        self.orders_since = None
+        self.sent_orders = {}  # order id -> the last event's order, orders are read again for ORDERS_LAG
+
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="events-broker", daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def notify(self):
+        """ Something was committed - look now, not at the next tick """
+        self.wake.set()
+
+    def run(self):
+        try:
+            self.version = catalog.get_catalog_version()
+            self.orders_since = timezone.now()
+            self.sent_orders = {}
+            idle_since = None
+            while True:
+                self.wake.wait(EVENTS_POLL_INTERVAL)
+                self.wake.clear()
+                with self.lock:
+                    subscribers = list(self.subscribers)
+                    if not subscribers:
+                        # no poll while nobody listens - who reconnects gets what changed meanwhile
+                        idle_since = idle_since or time.monotonic()
+                        if time.monotonic() - idle_since > BROKER_IDLE_TIMEOUT:
+                            self.thread = None
+                            return
+                        continue
+                    idle_since = None
+
+                try:
+                    events = self.poll(staff=any(subscriber.staff for subscriber in subscribers))
+                except DatabaseError:  # f.e. "database is locked" - the next tick tries again
+                    logger.exception("Events poll failed")
+                    connection.close()
+                    continue
+                for name, data in events:
+                    for subscriber in subscribers:
+                        if subscriber.wants(name, data):
+                            subscriber.put(name, data)
+        except Exception:
+            logger.exception("Events broker stopped")
+            with self.lock:
+                self.thread = None  # the next subscriber starts it again
+        finally:
+            connection.close()
+
+    def poll(self, staff=False):
+        """
+        :param staff: staff boards are connected - their events are built too
+        :return: [(event name, data)] since the last poll
+        """
+        return self.poll_catalog() + self.poll_orders(staff)
+
+    def poll_catalog(self):
+        version = catalog.get_catalog_version()
+        if version == self.version:
+            return []
+
+        changed = catalog.get_changes(self.version, version)
+        self.version = version
+        if changed is None:  # the log doesn't go back that far - the clients load the catalog again
+            return [("catalog", {"version": version, "full": True})]
+
+        products = dict.fromkeys(changed[CatalogChange.PRODUCT], False)  # deleted & not in the menu - not available
+        products.update(Product.objects.filter(id__in=products, is_menu=True).values_list("id", "is_available"))
+        ingredients = dict.fromkeys(changed[CatalogChange.INGREDIENT], False)
+        ingredients.update(Ingredient.objects.filter(id__in=ingredients, is_menu=True).values_list("id", "is_available"))
+        return [("availability", {"version": version, "products": products, "ingredients": ingredients})]
+
+    def poll_orders(self, staff=False):
+        now = timezone.now()
+        since = self.orders_since - ORDERS_LAG
+        orders = Order.objects.filter(updated_at__gt=since).values(*ORDER_FIELDS)
+        self.orders_since = now
+
+        events = []
+        changes = {}  # order id -> what changed, for the staff
+        for order in orders:
+            sent = self.sent_orders.get(order["id"])
+            if sent is not None and sent["updated_at"] == order["updated_at"]:
+                continue
+            self.sent_orders[order["id"]] = order
+            events.append(("order", order))
+            changes[order["id"]] = get_order_changes(sent, order, since)
+        self.sent_orders = {order_id: order for order_id, order in self.sent_orders.items()
+                            if order["updated_at"] > now - 2 * ORDERS_LAG}
+
+        if staff and changes:
+            events.extend(get_staff_events(changes))
+        return events
+
+
+def get_order_changes(sent, order, since):
+    """
+    :param sent: the order of the last event, None - no event since the broker started
+    :return: ["created", "status", "paid", "ready"] - what happened since the last event, ["updated"] if nothing of them
+    """
+    if sent is None:  # the old status is not known - an order updated since then could have changed it
+        if order["created_at"] > since:
+            return ["created"]
+        changes = ["status"] if order["updated_at"] > since else []
+        changes += [change for change, at in (("paid", order["paid_at"]), ("ready", order["ready_at"])) if at and at > since]
+        return changes or ["updated"]
+    changes = []
+    if sent["order_status"] != order["order_status"]:
+        changes.append("status")
+        if order["order_status"] == Order.READY:
+            changes.append("ready")
+    if order["is_paid"] and not sent["is_paid"]:
+        changes.append("paid")
+    return changes or ["updated"]
+
+
+def get_staff_events(changes):
+    """
+    Board data of the changed orders, built once for every connected board: one query for the orders,
+    the kitchen's products & ingredients only for the orders in cooking
+    :param changes: {order id: changes}, see get_order_changes
+    """
+    orders = list(Order.objects.filter(id__in=changes).select_related("user"))
+    cooking = [order.id for order in orders if order.order_status == Order.COOKING]
+    kitchen = {}
+    if cooking:
+        products = OrderProduct.objects.select_related("product").prefetch_related("product__productingredient_set__ingredient")
+        for order in Order.objects.filter(id__in=cooking).prefetch_related(Prefetch("products", queryset=products)):
+            kitchen[order.id] = utils_api.get_order_for_kitchen(order)
+
+    return [("staff_order", {"id": order.id, "order_status": order.order_status, "changes": changes[order.id],
+                             "order": utils_api.get_order_general(order), "kitchen": kitchen.get(order.id)})
+            for order in orders]
+
+
+broker = Broker()
+
+
+def notify():
+    broker.notify()
+
+
+def format_event(name, data):
+    if name == "order":
+        data = {key: value for key, value in data.items() if key != "user_id"}
+    return f"event: {name}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def stream(user_id, staff=False):
+    """ ASGI - events of the user until the client disconnects (the server cancels the generator) """
+    subscriber = Subscriber(user_id, staff, loop=asyncio.get_running_loop())
+    broker.subscribe(subscriber)
+    try:
+        yield f"retry: {RECONNECT_DELAY}\n\n"
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.ready.wait(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            for name, data in subscriber.take():
+                yield format_event(name, data)
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+def stream_sync(user_id, staff=False):
+    """ WSGI (runserver) - a long poll: events for LONG_POLL_TIMEOUT, then the stream ends & EventSource reconnects """
+    subscriber = Subscriber(user_id, staff)
+    broker.subscribe(subscriber)
+    try:
+        yield f"retry: {RECONNECT_DELAY}\n\n"
+        deadline = time.monotonic() + LONG_POLL_TIMEOUT
+        while (timeout := deadline - time.monotonic()) > 0:
+            if subscriber.ready.wait(timeout):
+                for name, data in subscriber.take():
+                    yield format_event(name, data)
+    finally:
+        broker.unsubscribe(subscriber)
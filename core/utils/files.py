@@ -0,0 +1,92 @@
+# files.py
+"""
+Static & media serving when DEBUG is off (with DEBUG on django.conf.urls.static serves them).
+Static: fingerprinted names from the manifest never change - "immutable"; precompressed .br/.gz copies are sent as they are.
+Media: content-hashed names (see storage.ContentHashStorage) are immutable too. The bytes are sent by the web server
+(settings.MEDIA_SENDFILE = "nginx" / "apache") or by FileResponse - the WSGI server's file_wrapper (sendfile).
+"""
+
+import mimetypes
+import os
+import posixpath
+from functools import lru_cache
+from urllib.parse import quote
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from core.utils import responses
+from core.utils.storage import COMPRESSED_EXTENSIONS, is_hashed_media
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "public, no-cache"
+
+
+def get_file_path(root, path):
+    full_path = safe_join(root, path)  # SuspiciousFileOperation (400) if it's outside of the root
+    if not os.path.isfile(full_path):
+        raise Http404
+    return full_path
+
+
+@lru_cache(maxsize=1)
+def get_hashed_static_names():
+    """ Names with the hash, from the manifest written by collectstatic """
+    return frozenset(getattr(staticfiles_storage, "hashed_files", {}).values())
+
+
+def not_modified(request, full_path):
+    """ Not fingerprinted files are revalidated by Last-Modified """
+    return not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), os.stat(full_path).st_mtime)
+
+
+def serve_static(request, path):
+    full_path = get_file_path(settings.STATIC_ROOT, path)
+    immutable = posixpath.normpath(path) in get_hashed_static_names()
+    if not immutable and not_modified(request, full_path):
+        return HttpResponseNotModified()
+
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    accepted = responses.get_accepted_encodings(request)
+    encoding = None
+    for option in ("br", "gzip"):
+        if option in accepted and os.path.isfile(full_path + COMPRESSED_EXTENSIONS[option]):
+            encoding = option
+            break
+
+    response = FileResponse(open(full_path + COMPRESSED_EXTENSIONS[encoding] if encoding else full_path, "rb"),
+                            content_type=content_type)
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if not immutable:
+        response["Last-Modified"] = http_date(os.stat(full_path).st_mtime)
+    response["Cache-Control"] = CACHE_IMMUTABLE if immutable else CACHE_REVALIDATE
+    return response
+
+
+def serve_media(request, path):
+    full_path = get_file_path(settings.MEDIA_ROOT, path)
+    immutable = is_hashed_media(path)
+    if not immutable and not_modified(request, full_path):
+        return HttpResponseNotModified()
+
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    if settings.MEDIA_SENDFILE == "nginx":
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = quote(settings.MEDIA_SENDFILE_PREFIX + path)
+    elif settings.MEDIA_SENDFILE == "apache":
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = full_path
+    else:
+        response = FileResponse(open(full_path, "rb"), content_type=content_type)
+
+    if not immutable:
+        response["Last-Modified"] = http_date(os.stat(full_path).st_mtime)
+    response["Cache-Control"] = CACHE_IMMUTABLE if immutable else CACHE_REVALIDATE
+    return response
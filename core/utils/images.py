@@ -0,0 +1,110 @@
+# images.py
+"""
+Resized copies (derivatives) of uploaded Ingredient & Product images, in WebP and JPEG:
+"ingredients/chicken.png" -> "ingredients/derivatives/chicken_png-160.webp", "...-480.jpeg", ...
+They are built in a worker thread after the upload is committed, the original image is never changed.
+"""
+
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+SIZES = {"thumb": 160, "card": 480, "full": 1200}  # max width in px
+FORMATS = {"webp": {"format": "WEBP", "quality": 80, "method": 6}, "jpeg": {"format": "JPEG", "quality": 82, "optimize": True, "progressive": True}}
+DERIVATIVES_DIR = "derivatives"
+
+# One worker: builds of the same file (f.e. 2 items with the same content-hashed image) never overlap
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-derivatives")
+failed = set()  # images whose build failed in this process - not tried again on every save, see image_derivatives command
+
+
+def get_derivative_name(name, width, image_format):
+    directory, filename = posixpath.split(name)
+    stem = filename.replace(".", "_")  # "a.png" & "a.jpg" are different images
+    return posixpath.join(directory, DERIVATIVES_DIR, f"{stem}-{width}.{image_format}")
+
+
+def get_srcset(name, widths):
+    """
+    :param widths: built widths stored with the item (Ingredient/Product.image_widths), see get_built_widths
+    :return: {"webp": "url 160w, url 480w", "jpeg": "..."} or None if derivatives are not built (yet)
+    The names are derived from the image name - no storage calls while the catalog is built.
+    """
+    if not name or not widths:
+        return None
+    return {image_format: ", ".join(f"{default_storage.url(get_derivative_name(name, width, image_format))} {width}w" for width in widths)
+            for image_format in FORMATS}
+
+
+def get_built_widths(name):
+    """ :return: widths of the existing derivatives - sizes larger than the original are not built """
+    return [width for width in SIZES.values() if default_storage.exists(get_derivative_name(name, width, "webp"))]
+
+
+def build_derivatives(name, force=False):
+    """ Builds all derivatives of the image synchronously. :return: number of files written """
+    with default_storage.open(name, "rb") as file:
+        original = ImageOps.exif_transpose(Image.open(file))
+        original.load()
+
+    smallest = min(SIZES.values())
+    written = 0
+    for width in sorted(SIZES.values()):
+        if width > original.width and width != smallest:
+            break  # no upscaling, the smallest one is always there
+        resized = original.copy()
+        resized.thumbnail((width, width * 10), Image.Resampling.LANCZOS)
+        for image_format, options in FORMATS.items():
+            derivative_name = get_derivative_name(name, width, image_format)
+            if not force and default_storage.exists(derivative_name):
+                continue
+            buffer = BytesIO()
+            to_rgb(resized, keep_alpha=image_format == "webp").save(buffer, **options)
+            if default_storage.exists(derivative_name):
+                default_storage.delete(derivative_name)
+            default_storage.save(derivative_name, ContentFile(buffer.getvalue()))
+            written += 1
+    return written
+
+
+def to_rgb(image, keep_alpha=False):
+    """ JPEG has no transparency - it becomes white instead of black """
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        if keep_alpha:
+            return image
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def schedule_derivatives(name, callback=None):
+    """
+    Builds derivatives in the worker thread once the current transaction is committed, then calls callback(widths).
+    An image that failed is not scheduled again.
+    """
+    if name in failed:
+        return
+    transaction.on_commit(lambda: executor.submit(run_build, name, callback))
+
+
+def run_build(name, callback=None):
+    try:
+        written = build_derivatives(name)
+        logger.info("Image %s: %s derivatives built", name, written)
+        if callback is not None:
+            callback(get_built_widths(name))
+    except Exception:
+        failed.add(name)
+        logger.exception("Image %s: derivatives failed", name)
+    finally:
+        connections.close_all()  # the worker thread's own DB connections
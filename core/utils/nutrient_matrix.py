@@ -0,0 +1,132 @@
+# nutrient_matrix.py
+"""
+IngredientMatrix - the whole ingredient catalog in memory as NumPy arrays, one per process:
+nutrients (ingredients x NUTRIENT_FIELDS, for 100g), selling price, min/max order & step, row by ingredient id.
+Nutrition of any composition (product, custom meal, whole cart) is one product of its weights and the matrix.
+
+The matrix is rebuilt with one query when Ingredient / NutritionalValue rows change:
+ - in this process - right away, by the receivers below;
+ - in other processes - when the catalog version changes (see catalog.get_catalog_version).
+"""
+
+import threading
+import weakref
+from functools import partial
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from core.models import Ingredient, NutritionalValue, NUTRIENT_FIELDS
+from core.utils import catalog
+from core.utils.nutrients import NutrientVector
+
+_lock = threading.Lock()
+_matrix = None  # built from committed rows, shared by the threads
+# Per thread (per connection): callback - weak reference to on_commit_ingredients_change of the transaction that
+# changed ingredients & is not committed yet (dropped with a rollback), matrix - built with those changes, only for it
+_pending = threading.local()
+
+
+class IngredientMatrix:
+    __slots__ = ("version", "committed", "index", "nutrients", "price", "min_order", "max_order", "step")
+
+    def __init__(self, rows, version, committed=True):
+        """ :param rows: (id, effective_price, min_order, max_order, step, *nutrients in NUTRIENT_FIELDS order) """
+        self.version = version
+        self.committed = committed
+        self.index = {row[0]: i for i, row in enumerate(rows)}
+
+        data = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), 4 + len(NUTRIENT_FIELDS))
+        self.price = data[:, 0]
+        self.min_order = data[:, 1]
+        self.max_order = data[:, 2]
+        self.step = data[:, 3]
+        self.nutrients = np.ascontiguousarray(data[:, 4:])
+
+    @classmethod
+    def build(cls, version, committed=True):
+        rows = Ingredient.objects.values_list("id", "effective_price", "min_order", "max_order", "step",
+                                              *(f"nutritional_value__{field}" for field in NUTRIENT_FIELDS))
+        return cls(list(rows), version, committed)
+
+    def __contains__(self, ingredient_id):
+        return ingredient_id in self.index
+
+    def get_rows(self, ingredient_ids):
+        """ :raises KeyError: an ingredient is not in the matrix """
+        index = self.index
+        return np.fromiter((index[ingredient_id] for ingredient_id in ingredient_ids), dtype=np.intp, count=len(ingredient_ids))
+
+    def get_nutrition(self, rows, grams) -> NutrientVector:
+        """ Nutrition of the ingredients (matrix rows) with the given weights, repeated rows are summed """
+        return NutrientVector((np.asarray(grams, dtype=np.float64) @ self.nutrients[rows] / 100).tolist())
+
+    def get_wrong_weights(self, rows, grams):
+        """ :return: positions (in rows) of the weights out of ingredients' min_order - max_order """
+        rows = np.asarray(rows, dtype=np.intp)
+        grams = np.asarray(grams, dtype=np.float64)
+        return np.flatnonzero((grams < self.min_order[rows]) | (grams > self.max_order[rows])).tolist()
+
+    def get_prices(self, rows, grams):
+        """ Price of every ingredient for its weight, as Ingredient.get_selling_price_for_weight """
+        return np.round(self.price[rows] * np.asarray(grams, dtype=np.float64))
+
+
+def get_matrix(ingredient_ids=()) -> IngredientMatrix:
+    """
+    Matrix of the current catalog version. Built again if one of ingredient_ids is not in it yet
+    (created in another process, that process' version bump is not seen yet).
+    A transaction that changed ingredients gets a matrix of its own, the other threads go on with the shared one
+    """
+    global _matrix
+    version = catalog.get_catalog_version()
+    pending = has_pending_changes()
+    matrix = getattr(_pending, "matrix", None) if pending else _matrix
+    if matrix is not None and matrix.version == version and all(ingredient_id in matrix for ingredient_id in ingredient_ids):
+        return matrix
+
+    matrix = IngredientMatrix.build(version, committed=not pending)
+    if pending:
+        _pending.matrix = matrix
+    else:
+        with _lock:
+            _matrix = matrix
+    return matrix
+
+
+def has_pending_changes():
+    callback = getattr(_pending, "callback", None)
+    return callback is not None and callback() is not None
+
+
+def on_commit_ingredients_change():
+    global _matrix
+    _pending.callback = None
+    _pending.matrix = None
+    _matrix = None
+
+
+def on_ingredients_change():
+    """ Out of a transaction - committed already, in one - the matrix of this thread only, till the commit """
+    if not connection.in_atomic_block:
+        on_commit_ingredients_change()
+        return
+    _pending.matrix = None
+    if not has_pending_changes():
+        callback = partial(on_commit_ingredients_change)  # kept alive only by the transaction
+        _pending.callback = weakref.ref(callback)
+        transaction.on_commit(callback)
+
+
+@receiver([post_save, post_delete], sender=Ingredient)
+def ingredient_changed(sender, instance, **kwargs):
+    on_ingredients_change()
+
+
+@receiver([post_save, post_delete], sender=NutritionalValue)
+def nutritional_value_changed(sender, instance, created=False, **kwargs):
+    # New rows (orders, new products) are not linked to ingredients yet, Ingredient.save comes after
+    if not created:
+        on_ingredients_change()
@@ -0,0 +1,95 @@
+# nutrients.py
+"""
+NutrientVector - nutrition as a flat array of floats in NUTRIENT_FIELDS order, for all the math on the server.
+Hot loops work with the array: no NutritionalValue instances, no _meta.fields, no dicts in between.
+"""
+
+from array import array
+from operator import attrgetter
+
+from core.models import NutritionalValue, NUTRIENT_FIELDS
+
+SIZE = len(NUTRIENT_FIELDS)
+FIELD_INDEX = {field: index for index, field in enumerate(NUTRIENT_FIELDS)}
+
+_ZEROS = array("d", [0.0]) * SIZE
+_get_model_values = attrgetter(*NUTRIENT_FIELDS)
+
+
+class NutrientVector:
+    __slots__ = ("values",)
+
+    def __init__(self, values=None):
+        if values is None:
+            self.values = array("d", _ZEROS)
+        else:
+            self.values = array("d", values)
+            if len(self.values) != SIZE:
+                raise ValueError(f"NutrientVector needs {SIZE} values, got {len(self.values)}")
+
+    @classmethod
+    def from_model(cls, nutritional_value: NutritionalValue):
+        return cls(_get_model_values(nutritional_value))
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """ Missing nutrients are 0, unknown keys are ignored """
+        return cls(data.get(field, 0) for field in NUTRIENT_FIELDS)
+
+    @classmethod
+    def sum(cls, vectors):
+        total = cls()
+        for vector in vectors:
+            total.add_scaled(vector, 1)
+        return total
+
+    def add_scaled(self, other, factor):
+        """ self += other * factor, in place. other - NutrientVector or a sequence in NUTRIENT_FIELDS order """
+        values = self.values
+        for index, value in enumerate(other.values if isinstance(other, NutrientVector) else other):
+            values[index] += value * factor
+        return self
+
+    def scale(self, factor):
+        return NutrientVector(value * factor for value in self.values)
+
+    def round(self, ndigits=1):
+        return NutrientVector(round(value, ndigits) for value in self.values)
+
+    def __add__(self, other):
+        return NutrientVector(self.values).add_scaled(other, 1)
+
+    def __iadd__(self, other):
+        return self.add_scaled(other, 1)
+
+    def __sub__(self, other):
+        return NutrientVector(self.values).add_scaled(other, -1)
+
+    def __mul__(self, factor):
+        return self.scale(factor)
+
+    __rmul__ = __mul__
+
+    def __getitem__(self, field):
+        return self.values[FIELD_INDEX[field]]
+
+    def __eq__(self, other):
+        return isinstance(other, NutrientVector) and self.values == other.values
+
+    def __repr__(self):
+        return f"NutrientVector(calories={self['calories']}, proteins={self['proteins']}, fats={self['fats']}, " \
+               f"carbohydrates={self['carbohydrates']}, ...)"
+
+    def to_dict(self):
+        return dict(zip(NUTRIENT_FIELDS, self.values))
+
+    def to_list(self):
+        return self.values.tolist()
+
+    def to_model(self, nutritional_value: NutritionalValue = None):
+        """ Fills the given (or a new, unsaved) NutritionalValue """
+        if nutritional_value is None:
+            return NutritionalValue(**self.to_dict())
+        for field, value in zip(NUTRIENT_FIELDS, self.values):
+            setattr(nutritional_value, field, value)
+        return nutritional_value
@@ -0,0 +1,89 @@
+# responses.py
+
+import gzip
+import logging
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+logger = logging.getLogger(__name__)
+
+try:  # in requirements.txt, without it the clients that accept br get gzip
+    import brotli
+except ImportError:
+    brotli = None
+    logger.warning("brotli is not installed - responses are not compressed with br, see requirements.txt")
+
+GZIP_LEVEL = 9  # compression is done once per representation, so we can afford the best level
+GZIP_LEVEL_DYNAMIC = 6  # bodies built per request
+BROTLI_QUALITY = 11
+
+STATS_KEY = "response_stats:{}:{}"
+STATS_METRICS = ("hits", "misses", "bytes_raw", "bytes_sent")
+
+
+def compress(body: bytes):
+    """ :return: dict encoding -> bytes, "identity" is always there """
+    encodings = {"identity": body, "gzip": gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return encodings
+
+
+def get_accepted_encodings(request):
+    accepted = set()
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        encoding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def encoded_response(request, encodings: dict, status=200):
+    """ Sends the smallest representation the client accepts, nothing is compressed here """
+    accepted = get_accepted_encodings(request)
+    encoding = "identity"
+    for option in ("br", "gzip"):
+        if option in encodings and option in accepted and len(encodings[option]) < len(encodings[encoding]):
+            encoding = option
+
+    response = HttpResponse(encodings[encoding], content_type="application/json", status=status)
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    response["Content-Length"] = len(encodings[encoding])
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def dynamic_response(request, body: bytes, status=200):
+    """ For bodies built per request - gzip only (if accepted), with a faster level """
+    encodings = {"identity": body}
+    if "gzip" in get_accepted_encodings(request):
+        encodings["gzip"] = gzip.compress(body, compresslevel=GZIP_LEVEL_DYNAMIC, mtime=0)
+    return encoded_response(request, encodings, status)
+
+
+def count_stats(name, hit: bool, bytes_raw: int, bytes_sent: int):
+    for metric, value in (("hits" if hit else "misses", 1), ("bytes_raw", bytes_raw), ("bytes_sent", bytes_sent)):
+        key = STATS_KEY.format(name, metric)
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key, value)
+        except ValueError:  # evicted in between, skip it
+            pass
+
+
+def get_stats(name):
+    stats = cache.get_many([STATS_KEY.format(name, metric) for metric in STATS_METRICS])
+    stats = {metric: stats.get(STATS_KEY.format(name, metric), 0) for metric in STATS_METRICS}
+    requests = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / requests, 3) if requests else None
+    stats["saved_ratio"] = round(1 - stats["bytes_sent"] / stats["bytes_raw"], 3) if stats["bytes_raw"] else None
+    return stats
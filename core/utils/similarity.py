@@ -0,0 +1,176 @@
+# similarity.py
+"""
+SimilarityIndex - top similar dishes of every menu product, sent with the menu ("similar dishes",
+"if this is unavailable, try ..."). Only available products of the same product_type are offered.
+
+Similarity of two products is a mix of cosines:
+ - of their nutrient profiles, every nutrient scaled by its menu mean;
+ - of their compositions (grams of every ingredient), i.e. the ingredient overlap from ProductIngredient.
+The whole products x products matrix is kept: a change of some products recomputes only their rows & columns
+(one matrix product), then top-k of every row is taken again in one vectorized pass.
+
+Like substitutes.SubstituteIndex, the index follows the catalog version by the CatalogChange log.
+"""
+
+import threading
+
+import numpy as np
+
+from core.models import Product, ProductIngredient, CatalogChange
+from core.utils import catalog
+
+SIMILARITY_NUTRIENTS = ("calories", "proteins", "fats", "saturated_fats", "carbohydrates", "sugars", "fiber")
+SIMILAR_LIMIT = 4
+NUTRITION_WEIGHT = 0.5  # the rest is the ingredient overlap
+CATCH_UP_MAX_CHANGES = 200  # more changed products than that - build again
+
+_lock = threading.Lock()
+_index = None
+
+
+def load_products(product_ids=None):
+    """ :return: [(id, product_type, is_available, *nutrients)], {product id: {ingredient id: grams}} - menu products only """
+    products = Product.objects.filter(is_menu=True)
+    if product_ids is not None:
+        products = products.filter(id__in=product_ids)
+    rows = list(products.values_list("id", "product_type", "is_available",
+                                     *(f"nutritional_value__{field}" for field in SIMILARITY_NUTRIENTS)))
+
+    compositions = {row[0]: {} for row in rows}
+    for product_id, ingredient_id, weight_grams in ProductIngredient.objects.filter(product_id__in=compositions) \
+            .values_list("product_id", "ingredient_id", "weight_grams"):
+        compositions[product_id][ingredient_id] = compositions[product_id].get(ingredient_id, 0) + weight_grams
+    return rows, compositions
+
+
+def unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+class SimilarityIndex:
+    def __init__(self, rows, compositions, version):
+        self.version = version
+        self.ids = []  # matrix row -> product id
+        self.positions = {}  # product id -> matrix row
+        self.types = {}  # product_type -> code
+        self.columns = {}  # ingredient id -> column of the compositions
+
+        self.product_types = np.empty(0, dtype=np.intp)
+        self.available = np.empty(0, dtype=bool)
+        self.profiles = np.empty((0, len(SIMILARITY_NUTRIENTS)))
+        self.compositions = np.empty((0, 0))
+        self.similarity = np.empty((0, 0))
+        self.similar = {}  # product id -> similar product ids, replaced as a whole
+
+        nutrients = np.array([row[3:] for row in rows], dtype=np.float64).reshape(-1, len(SIMILARITY_NUTRIENTS))
+        mean = nutrients.mean(axis=0) if len(nutrients) else np.ones(len(SIMILARITY_NUTRIENTS))
+        self.scale = np.where(mean > 0, mean, 1.0)  # kept for catch-ups, changed products are scaled the same way
+
+        self.update(rows, compositions)
+
+    @classmethod
+    def build(cls, version):
+        return cls(*load_products(), version)
+
+    def remove(self, product_ids):
+        drop = [self.positions[product_id] for product_id in product_ids if product_id in self.positions]
+        if not drop:
+            return
+        dropped = set(drop)
+        self.ids = [product_id for position, product_id in enumerate(self.ids) if position not in dropped]
+        self.positions = {product_id: position for position, product_id in enumerate(self.ids)}
+        self.product_types = np.delete(self.product_types, drop)
+        self.available = np.delete(self.available, drop)
+        self.profiles = np.delete(self.profiles, drop, axis=0)
+        self.compositions = np.delete(self.compositions, drop, axis=0)
+        self.similarity = np.delete(np.delete(self.similarity, drop, axis=0), drop, axis=1)
+
+    def update(self, rows, compositions):
+        """ Puts the given products (new or changed) into the matrices & recomputes their similarity to all the others """
+        new_ids = [row[0] for row in rows if row[0] not in self.positions]
+        for product_id in new_ids:
+            self.positions[product_id] = len(self.ids)
+            self.ids.append(product_id)
+        count = len(new_ids)
+        self.product_types = np.concatenate((self.product_types, np.zeros(count, dtype=np.intp)))
+        self.available = np.concatenate((self.available, np.zeros(count, dtype=bool)))
+        self.profiles = np.vstack((self.profiles, np.zeros((count, len(SIMILARITY_NUTRIENTS)))))
+        self.similarity = np.pad(self.similarity, ((0, count), (0, count)))
+
+        new_columns = {ingredient_id for composition in compositions.values() for ingredient_id in composition} - self.columns.keys()
+        for ingredient_id in new_columns:
+            self.columns[ingredient_id] = len(self.columns)
+        self.compositions = np.pad(self.compositions, ((0, count), (0, len(self.columns) - self.compositions.shape[1])))
+
+        changed = np.fromiter((self.positions[row[0]] for row in rows), dtype=np.intp, count=len(rows))
+        if len(changed):
+            self.product_types[changed] = [self.types.setdefault(row[1], len(self.types)) for row in rows]
+            self.available[changed] = [row[2] for row in rows]
+            self.profiles[changed] = unit_rows(np.array([row[3:] for row in rows], dtype=np.float64) / self.scale)
+
+            grams = np.zeros((len(rows), len(self.columns)))
+            for index, row in enumerate(rows):
+                for ingredient_id, weight_grams in compositions[row[0]].items():
+                    grams[index, self.columns[ingredient_id]] = weight_grams
+            self.compositions[changed] = unit_rows(grams)
+
+            similarity = NUTRITION_WEIGHT * self.profiles[changed] @ self.profiles.T \
+                + (1 - NUTRITION_WEIGHT) * self.compositions[changed] @ self.compositions.T
+            self.similarity[changed, :] = similarity
+            self.similarity[:, changed] = similarity.T
+        self.refresh_similar()
+
+    def refresh_similar(self):
+        """ Top SIMILAR_LIMIT available products of the same type for every product, best first """
+        size = len(self.ids)
+        if size < 2:
+            self.similar = {product_id: [] for product_id in self.ids}
+            return
+
+        allowed = (self.product_types[:, None] == self.product_types[None, :]) & self.available[None, :]
+        np.fill_diagonal(allowed, False)
+        scores = np.where(allowed, self.similarity, -np.inf)
+
+        limit = min(SIMILAR_LIMIT, size - 1)
+        best = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+        best = np.take_along_axis(best, np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1), axis=1)
+        found = np.isfinite(np.take_along_axis(scores, best, axis=1))
+
+        ids = self.ids
+        self.similar = {ids[row]: [ids[column] for column, ok in zip(columns, oks) if ok]
+                        for row, (columns, oks) in enumerate(zip(best.tolist(), found.tolist()))}
+
+    def catch_up(self, version):
+        """ Reads again the products changed since self.version. :return: False if it's cheaper to build again """
+        changed = catalog.get_changes(self.version, version)
+        if changed is None or len(changed[CatalogChange.PRODUCT]) > CATCH_UP_MAX_CHANGES:
+            return False
+
+        changed_ids = changed[CatalogChange.PRODUCT]
+        if changed_ids:
+            rows, compositions = load_products(changed_ids)
+            self.remove(changed_ids - compositions.keys())  # deleted or not in the menu anymore
+            self.update(rows, compositions)
+        self.version = version
+        return True
+
+
+def get_index() -> SimilarityIndex:
+    global _index
+    version = catalog.get_catalog_version()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+
+    with _lock:
+        index = _index
+        if index is None or index.version > version or not index.catch_up(version):
+            index = SimilarityIndex.build(version)
+        _index = index
+    return index
+
+
+def get_similar():
+    """ {product id: [similar available product ids]} of the menu """
+    return get_index().similar
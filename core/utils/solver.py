@@ -0,0 +1,150 @@
+# solver.py
+"""
+Custom meal solver - weights of the chosen ingredients that hit the nutrition targets of a Customer
+(calories, proteins, fats, carbohydrates, ... - any of NUTRIENT_FIELDS, exact or min - max).
+
+Bounded least squares over the IngredientMatrix: distance of the meal's nutrition to the target ranges is minimized
+with projected gradient (FISTA), the weights are kept in min_order - max_order of every ingredient and
+the meal in Setting.maximum_order_weight. Then the weights are put on the step grid of the sliders.
+A few ingredients x a few targets - a couple hundred tiny matrix products, about a millisecond.
+"""
+
+import numpy as np
+from django.core.exceptions import ValidationError
+
+from core.models import NUTRIENT_FIELDS
+from core.utils.nutrient_matrix import IngredientMatrix
+
+MAX_ITERATIONS = 500
+TOLERANCE = 1e-6        # of the (normalized) objective, to stop early
+MET_TOLERANCE = 0.02    # the target is met if the nutrient is within its range +- 2% after the weights are snapped
+
+
+def parse_targets(targets):
+    """
+    :param targets: {"calories": 600, "proteins": [40, null], ...} - exact value or [min, max], null - no bound
+    :return: {field: (min or None, max or None)}
+    """
+    if not isinstance(targets, dict) or not targets:
+        raise ValidationError(message="Solver - targets are required.")
+
+    parsed = {}
+    for field, target in targets.items():
+        if field not in NUTRIENT_FIELDS:
+            raise ValidationError(message=f"Solver - unknown nutrient {field}.")
+        bounds = [target, target] if isinstance(target, (int, float)) else target
+        if not isinstance(bounds, list) or len(bounds) != 2 \
+                or not all(bound is None or (isinstance(bound, (int, float)) and bound >= 0) for bound in bounds):
+            raise ValidationError(message=f"Solver - wrong target for {field}, expected a number or [min, max].")
+        low, high = bounds
+        if low is not None and high is not None and low > high:
+            raise ValidationError(message=f"Solver - wrong target for {field}, min is greater than max.")
+        if low is None and high is None:
+            continue
+        parsed[field] = (low, high)
+
+    if not parsed:
+        raise ValidationError(message="Solver - targets are required.")
+    return parsed
+
+
+def parse_request(data):
+    """
+    :param data: {"ingredients": [ids], "weights": [current grams, optional], "targets": {...}}
+    :return: ingredient ids, weights or None, targets (see parse_targets)
+    """
+    ingredient_ids = data.get("ingredients")
+    weights = data.get("weights")
+
+    if not isinstance(ingredient_ids, list) or not ingredient_ids \
+            or not all(isinstance(ingredient_id, int) for ingredient_id in ingredient_ids):
+        raise ValidationError(message="Solver - ingredients are required.")
+    if len(set(ingredient_ids)) != len(ingredient_ids):
+        raise ValidationError(message="Solver - ingredients are repeated.")
+    if weights is not None and (not isinstance(weights, list) or len(weights) != len(ingredient_ids)
+                                or not all(isinstance(weight, (int, float)) for weight in weights)):
+        raise ValidationError(message="Solver - weights don't match the ingredients.")
+
+    return ingredient_ids, weights, parse_targets(data.get("targets"))
+
+
+def project(y, lower, upper, max_total):
+    """ Closest point to y with lower <= x <= upper and sum(x) <= max_total: clip(y - t) for the smallest t >= 0 """
+    x = np.clip(y, lower, upper)
+    if x.sum() <= max_total:
+        return x
+
+    # sum(clip(y - t)) goes down with t - bisection
+    t_low, t_high = 0.0, float(np.max(y - lower))
+    for _ in range(60):
+        t = (t_low + t_high) / 2
+        if np.clip(y - t, lower, upper).sum() > max_total:
+            t_low = t
+        else:
+            t_high = t
+    return np.clip(y - t_high, lower, upper)
+
+
+def snap(x, lower, upper, step, max_total):
+    """ Weights on the sliders' grid: min_order + k * step, not over max_order. Rounded down if the meal gets too heavy """
+    k = np.where(step > 0, (x - lower) / np.where(step > 0, step, 1), 0)
+    snapped = np.minimum(lower + np.round(k) * step, upper)
+    if snapped.sum() > max_total:
+        snapped = np.minimum(lower + np.floor(k + 1e-9) * step, upper)
+    return np.round(snapped, 2)
+
+
+def solve(matrix: IngredientMatrix, ingredient_ids, targets, max_weight, weights=None):
+    """
+    :param ingredient_ids: chosen ingredients, every one in the matrix
+    :param targets: see parse_targets
+    :param max_weight: Setting.maximum_order_weight
+    :param weights: current weights of the ingredients - the solution is searched from them, so sliders don't jump
+    :return: {"weights": [grams in ingredient_ids order], "weight", "price", "nutrition": {target: value},
+              "met": {target: bool}}
+    """
+    rows = matrix.get_rows(ingredient_ids)
+    lower = matrix.min_order[rows]
+    upper = matrix.max_order[rows]
+    step = matrix.step[rows]
+    if lower.sum() > max_weight:
+        raise ValidationError(message=f"Solver - minimum weight of the ingredients is over {max_weight}g.")
+
+    fields = list(targets)
+    columns = [NUTRIENT_FIELDS.index(field) for field in fields]
+    low = np.array([-np.inf if targets[field][0] is None else targets[field][0] for field in fields])
+    high = np.array([np.inf if targets[field][1] is None else targets[field][1] for field in fields])
+
+    # Every target in its own units - 1 kcal off is not as bad as 1g of fiber off
+    scale = np.maximum(np.where(np.isfinite(high), high, low), 1.0)
+    a = matrix.nutrients[rows][:, columns].T / 100 / scale[:, None]
+    low, high = low / scale, high / scale
+
+    lipschitz = max(float(np.linalg.norm(a, 2)) ** 2, 1e-12)
+    x = project(lower if weights is None else np.asarray(weights, dtype=np.float64), lower, upper, max_weight)
+    y, momentum, objective = x, 1.0, np.inf
+    for _ in range(MAX_ITERATIONS):
+        nutrition = a @ y
+        x_next = project(y - a.T @ (nutrition - np.clip(nutrition, low, high)) / lipschitz, lower, upper, max_weight)
+        momentum_next = (1 + np.sqrt(1 + 4 * momentum * momentum)) / 2
+        y = x_next + (momentum - 1) / momentum_next * (x_next - x)
+        x, momentum = x_next, momentum_next
+
+        nutrition = a @ x
+        objective_next = float(np.sum((nutrition - np.clip(nutrition, low, high)) ** 2))
+        if objective_next < TOLERANCE or abs(objective - objective_next) < TOLERANCE * TOLERANCE:
+            break
+        objective = objective_next
+
+    grams = snap(x, lower, upper, step, max_weight)
+    nutrition = grams @ matrix.nutrients[rows][:, columns] / 100
+    slack = MET_TOLERANCE * scale
+    met = ((nutrition >= low * scale - slack) & (nutrition <= high * scale + slack)).tolist()
+
+    return {
+        "weights": grams.tolist(),
+        "weight": round(float(grams.sum()), 2),
+        "price": float(matrix.get_prices(rows, grams).sum()),
+        "nutrition": {field: round(float(value), 1) for field, value in zip(fields, nutrition.tolist())},
+        "met": dict(zip(fields, met)),
+    }
@@ -0,0 +1,113 @@
+# stock.py
+"""
+Ingredient stock in grams (Ingredient.stock, None - not counted) & its ledger StockMovement.
+
+Checkout takes the grams of the order with one conditional UPDATE - stock = stock - need WHERE stock >= need, the last
+statement of its transaction: no row is locked while the order is validated & saved, two checkouts can't both take
+the last grams (the second UPDATE waits for the first commit and sees its result). An ingredient that drops below
+its min_order is made unavailable after the commit. Cancellations & refunds put back what the order took,
+purchases add to the stock.
+"""
+
+from functools import partial
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q, Sum, Case, When, Value, FloatField
+from django.db.models.functions import Coalesce
+
+from core.models import Ingredient, CatalogChange, StockMovement
+from core.utils import catalog
+
+
+def get_grams_case(grams: dict):
+    """ {ingredient id: grams} as an SQL expression of the row's id """
+    return Case(*(When(id=ingredient_id, then=Value(float(weight))) for ingredient_id, weight in grams.items()),
+                default=Value(0.0), output_field=FloatField())
+
+
+def take_stock(order, grams: dict):
+    """
+    Takes the grams of the order from stock, call it in the checkout transaction, after everything else.
+    :param grams: {ingredient id: grams}, see utils.order_validator
+    :raises ValidationError: not enough of some ingredient - nothing is taken (the transaction is rolled back)
+    """
+    grams = {ingredient_id: weight for ingredient_id, weight in grams.items() if weight > 0}
+    if not grams:
+        return
+
+    need = get_grams_case(grams)
+    taken = Ingredient.objects.filter(id__in=grams).filter(Q(stock__isnull=True) | Q(stock__gte=need)) \
+        .update(stock=F("stock") - need)
+    if taken != len(grams):
+        lack = Ingredient.objects.filter(id__in=grams, stock__lt=need).values_list("name", flat=True)
+        raise ValidationError(message=f"Not enough in stock: {', '.join(lack)}. "
+                                      f"Please reduce the weight or choose another ingredient.")
+
+    counted = Ingredient.objects.filter(id__in=grams, stock__isnull=False).values_list("id", "stock", "min_order")
+    StockMovement.objects.bulk_create([StockMovement(ingredient_id=ingredient_id, order=order, grams=-grams[ingredient_id],
+                                                     reason=StockMovement.CHECKOUT) for ingredient_id, _, _ in counted])
+    out_of_stock = [ingredient_id for ingredient_id, stock, min_order in counted if stock < min_order]
+    if out_of_stock:
+        transaction.on_commit(partial(mark_out_of_stock, out_of_stock))
+
+
+def mark_out_of_stock(ingredient_ids):
+    """ Available ingredients with stock under min_order (a Customer can't order even the minimum) become unavailable """
+    with transaction.atomic():
+        out_of_stock = list(Ingredient.objects.filter(id__in=ingredient_ids, is_available=True, stock__lt=F("min_order"))
+                            .values_list("id", flat=True))
+        if not out_of_stock:
+            return
+        Ingredient.objects.filter(id__in=out_of_stock).update(is_available=False)
+        catalog.on_catalog_changes(CatalogChange.INGREDIENT, out_of_stock)
+        Ingredient.propagate_availability(dict.fromkeys(out_of_stock, False))
+
+
+def add_stock(grams: dict, reason, order=None, purchase=None):
+    """
+    Adds grams to stock, one UPDATE & the ledger rows. A not counted ingredient starts to be counted from them.
+    Ingredients are not made available again here - it's the kitchen's decision.
+    :param grams: {ingredient id: grams}
+    """
+    grams = {ingredient_id: weight for ingredient_id, weight in grams.items() if weight > 0}
+    if not grams:
+        return
+    Ingredient.objects.filter(id__in=grams).update(stock=Coalesce(F("stock"), Value(0.0)) + get_grams_case(grams))
+    StockMovement.objects.bulk_create([StockMovement(ingredient_id=ingredient_id, grams=weight, reason=reason, order=order,
+                                                     purchase=purchase) for ingredient_id, weight in grams.items()])
+
+
+def restock_order(order):
+    """
+    Puts back what the order took and is not put back yet (net of its ledger rows) - repeated calls don't add twice.
+    Call it when the order is cancelled or refunded.
+    """
+    with transaction.atomic():
+        taken = StockMovement.objects.filter(order=order).values("ingredient_id").annotate(net=Sum("grams")).filter(net__lt=0)
+        add_stock({row["ingredient_id"]: -row["net"] for row in taken}, StockMovement.RESTOCK, order=order)
+
+
+def parse_purchase_stock(data):
+    """
+    :param data: [{"id": ingredient id, "grams": grams}] - what was bought, optional
+    :return: {ingredient id: grams}
+    """
+    if data is None:
+        return {}
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        raise ValidationError(message="Purchase - ingredients should be a list of {id, grams}.")
+
+    grams = {}
+    for item in data:
+        ingredient_id, weight = item.get("id"), item.get("grams")
+        if not isinstance(ingredient_id, int):
+            raise ValidationError(message="Purchase - wrong type for ingredient id.")
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise ValidationError(message="Purchase - grams should be a positive number.")
+        grams[ingredient_id] = grams.get(ingredient_id, 0) + weight
+
+    missing = grams.keys() - set(Ingredient.objects.filter(id__in=grams).values_list("id", flat=True))
+    if missing:
+        raise ValidationError(message=f"Purchase - wrong ingredient id {min(missing)}.")
+    return grams
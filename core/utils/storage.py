@@ -0,0 +1,79 @@
+# storage.py
+"""
+ContentHashStorage - media storage that names files by the SHA-256 of their content: "ingredients/<hash>.png".
+The same bytes are stored only once, and a URL never changes its content - it can be cached forever.
+
+CompressedManifestStaticFilesStorage - static files with the content hash in the name + precompressed .gz/.br copies.
+"""
+
+import hashlib
+import posixpath
+import re
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from core.utils import responses
+
+HASH_LENGTH = 32  # hex chars of the SHA-256, 128 bits are more than enough for media
+HASHED_NAME_RE = re.compile(rf"^[0-9a-f]{{{HASH_LENGTH}}}[._]")  # "<hash>.png" & its derivatives "<hash>_png-160.webp"
+
+COMPRESSIBLE_EXTENSIONS = (".js", ".mjs", ".css", ".svg", ".html", ".json", ".txt", ".map", ".ico")
+COMPRESSED_EXTENSIONS = {"gzip": ".gz", "br": ".br"}
+
+
+def get_content_hash(content):
+    sha = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        sha.update(chunk)
+    content.seek(0)
+    return sha.hexdigest()[:HASH_LENGTH]
+
+
+def get_hashed_name(name, content_hash):
+    """ "ingredients/IMG_2231.PNG" -> "ingredients/<hash>.png" """
+    directory, filename = posixpath.split(name)
+    return posixpath.join(directory, content_hash + posixpath.splitext(filename)[1].lower())
+
+
+@deconstructible
+class ContentHashStorage(FileSystemStorage):
+    def _save(self, name, content):
+        name = get_hashed_name(name, get_content_hash(content))
+        if self.exists(name):  # already uploaded - nothing to write
+            return name
+        return super()._save(name, content)
+
+
+def is_hashed_media(name):
+    return bool(HASHED_NAME_RE.match(posixpath.basename(name)))
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ collectstatic writes "name.<hash>.js" + "name.<hash>.js.gz" & ".br" (if smaller), served by core.utils.files """
+    # import ... from "./utils.js" -> "./utils.<hash>.js", only in our modules - bundled libraries are not parsed
+    patterns = ManifestStaticFilesStorage.patterns + (
+        ("js/*.js", ManifestStaticFilesStorage._js_module_import_aggregation_patterns[1]),
+    )
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for name in {*paths, *self.hashed_files.values()}:
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self.save_compressed(name)
+
+    def save_compressed(self, name):
+        with self.open(name) as file:
+            body = file.read()
+        for encoding, compressed in responses.compress(body).items():
+            if encoding not in COMPRESSED_EXTENSIONS or len(compressed) >= len(body):
+                continue
+            compressed_name = name + COMPRESSED_EXTENSIONS[encoding]
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+            self.save(compressed_name, ContentFile(compressed))
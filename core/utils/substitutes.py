@@ -0,0 +1,175 @@
+# substitutes.py
+"""
+SubstituteIndex - nearest neighbours of menu ingredients by nutrition, to offer a replacement for an unavailable one.
+Candidates are available menu ingredients of the same ingredient_type, one NumPy array of unit vectors per type:
+closeness is the cosine of the nutrient profiles (every nutrient scaled by its catalog mean, so grams of fats don't
+outweigh milligrams of fiber), the weight of a substitute is adjusted to give the same calories.
+
+The index follows the catalog version by the CatalogChange log: only the ingredients changed since its version are
+read again (an availability toggle moves one row between the groups), it's built from scratch only when the log is
+too far behind.
+"""
+
+import threading
+
+import numpy as np
+
+from core.models import Ingredient, CatalogChange
+from core.utils import catalog
+
+SUBSTITUTE_NUTRIENTS = ("calories", "proteins", "fats", "saturated_fats", "carbohydrates", "sugars", "fiber")
+SUBSTITUTES_LIMIT = 3
+CATCH_UP_MAX_CHANGES = 200  # more changed ingredients than that - build again
+
+_lock = threading.Lock()
+_index = None
+
+_FIELDS = ("id", "name", "ingredient_type", "is_menu", "is_available", "min_order", "max_order", "step", "effective_price",
+           *(f"nutritional_value__{field}" for field in SUBSTITUTE_NUTRIENTS))
+_CALORIES = SUBSTITUTE_NUTRIENTS.index("calories")
+
+
+class TypeGroup:
+    """ Available ingredients of one ingredient_type. Not changed in place - readers never see ids & vectors out of step """
+    __slots__ = ("ids", "vectors")
+
+    def __init__(self, ids=(), vectors=None):
+        self.ids = ids
+        self.vectors = np.empty((0, len(SUBSTITUTE_NUTRIENTS))) if vectors is None else vectors
+
+    def added(self, ingredient_id, vector):
+        return TypeGroup(self.ids + (ingredient_id,), np.vstack((self.vectors, vector)))
+
+    def removed(self, ingredient_id):
+        position = self.ids.index(ingredient_id)
+        return TypeGroup(self.ids[:position] + self.ids[position + 1:], np.delete(self.vectors, position, axis=0))
+
+
+class SubstituteIndex:
+    def __init__(self, rows, version):
+        """ :param rows: values of _FIELDS """
+        self.version = version
+        self.ingredients = {}  # id -> row, menu ingredients only
+        self.groups = {}  # ingredient_type -> TypeGroup
+
+        nutrients = np.array([row[9:] for row in rows if row[3]], dtype=np.float64).reshape(-1, len(SUBSTITUTE_NUTRIENTS))
+        mean = nutrients.mean(axis=0) if len(nutrients) else np.ones(len(SUBSTITUTE_NUTRIENTS))
+        self.scale = np.where(mean > 0, mean, 1.0)  # kept for catch-ups, new rows are scaled the same way
+
+        for row in rows:
+            self.put(row)
+
+    @classmethod
+    def build(cls, version):
+        return cls(list(Ingredient.objects.values_list(*_FIELDS)), version)
+
+    def get_vector(self, row):
+        vector = np.array(row[9:], dtype=np.float64) / self.scale
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def put(self, row):
+        """ Adds the ingredient or moves it to its current group (type & availability can change) """
+        self.discard(row[0])
+        if not row[3]:  # not in the menu - can't be ordered, can't be suggested
+            return
+        self.ingredients[row[0]] = row
+        if row[4]:
+            self.groups[row[2]] = self.groups.get(row[2], TypeGroup()).added(row[0], self.get_vector(row))
+
+    def discard(self, ingredient_id):
+        row = self.ingredients.pop(ingredient_id, None)
+        if row is not None and row[4]:
+            self.groups[row[2]] = self.groups[row[2]].removed(ingredient_id)
+
+    def catch_up(self, version):
+        """ Reads again the ingredients changed since self.version. :return: False if it's cheaper to build again """
+        changed = catalog.get_changes(self.version, version)
+        if changed is None or len(changed[CatalogChange.INGREDIENT]) > CATCH_UP_MAX_CHANGES:
+            return False
+
+        changed_ids = changed[CatalogChange.INGREDIENT]
+        if changed_ids:
+            rows = list(Ingredient.objects.filter(id__in=changed_ids).values_list(*_FIELDS))
+            for ingredient_id in changed_ids - {row[0] for row in rows}:
+                self.discard(ingredient_id)  # deleted
+            for row in rows:
+                self.put(row)
+        self.version = version
+        return True
+
+    def suggest(self, ingredient_id, weight=None, limit=SUBSTITUTES_LIMIT):
+        """
+        Closest available ingredients of the same type.
+        :param weight: grams of the original ingredient - the substitute's weight gives the same calories
+        :return: [{"id", "name", "similarity", "ratio", "weight", "price"}], ratio - grams of the substitute for 1g
+        """
+        row = self.ingredients.get(ingredient_id)
+        group = self.groups.get(row[2]) if row else None
+        if group is None or not group.ids:
+            return []
+
+        similarity = group.vectors @ self.get_vector(row)
+        if ingredient_id in group.ids:
+            similarity[group.ids.index(ingredient_id)] = -np.inf
+        count = min(limit, len(group.ids) - (ingredient_id in group.ids))
+        if count <= 0:
+            return []
+        best = np.argpartition(-similarity, count - 1)[:count]
+        best = best[np.argsort(-similarity[best])]
+
+        calories = row[9 + _CALORIES]
+        suggestions = []
+        for position in best.tolist():
+            substitute = self.ingredients.get(group.ids[position])
+            if substitute is None:  # removed by a catch-up right now
+                continue
+            substitute_calories = substitute[9 + _CALORIES]
+            ratio = calories / substitute_calories if calories > 0 and substitute_calories > 0 else 1
+            suggestion = {"id": substitute[0], "name": substitute[1],
+                          "similarity": round(float(similarity[position]), 3), "ratio": round(ratio, 3)}
+            if weight is not None:
+                substitute_weight = get_step_weight(weight * ratio, *substitute[5:8])
+                suggestion["weight"] = substitute_weight
+                suggestion["price"] = round(substitute[8] * substitute_weight)
+            suggestions.append(suggestion)
+        return suggestions
+
+
+def get_step_weight(weight, min_order, max_order, step):
+    """ The closest weight a Customer can choose: min_order + k * step, not over max_order """
+    weight = min(max(weight, min_order), max_order)
+    return round(min(min_order + round((weight - min_order) / step) * step, max_order), 2)
+
+
+def get_index() -> SubstituteIndex:
+    global _index
+    version = catalog.get_catalog_version()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+
+    with _lock:
+        index = _index
+        if index is None or index.version > version or not index.catch_up(version):
+            index = SubstituteIndex.build(version)
+        _index = index
+    return index
+
+
+def get_substitutes(ingredient_ids, weights=None):
+    """ :return: {ingredient id: suggestions} for every given ingredient, weights - {ingredient id: grams} """
+    index = get_index()
+    weights = weights or {}
+    return {ingredient_id: index.suggest(ingredient_id, weights.get(ingredient_id)) for ingredient_id in ingredient_ids}
+
+
+def add_product_substitutes(product_data):
+    """ Substitutes for lack_of_ingredients of utils_api.get_products_data(is_full=True), for their weights in the product """
+    lack_of_ingredients = product_data.get("lack_of_ingredients")
+    if lack_of_ingredients:
+        weights = {ingredient["id"]: ingredient["weight_grams"] for ingredient in product_data["ingredients"]}
+        substitutes = get_substitutes([ingredient["id"] for ingredient in lack_of_ingredients], weights)
+        for ingredient in lack_of_ingredients:
+            ingredient["substitutes"] = substitutes[ingredient["id"]]
+    return product_data
@@ -8,16 +8,24 @@ import pytz
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.models import F
+from django.db.models import F, Prefetch
 from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.utils import timezone
 from django_ratelimit.exceptions import Ratelimited
 
-from core.models import Product, Ingredient, Order, ProductIngredient, OrderProduct, NutritionalValue, DaySetting, Setting, Promo, \
-    PromoUsage
+from core.models import Product, Ingredient, Order, ProductIngredient, OrderProduct, DaySetting, Setting, Promo, PromoUsage, \
+    NUTRIENT_FIELDS
+from core.utils.nutrient_matrix import get_matrix
+from core.utils.nutrients import NutrientVector
+from core.utils.substitutes import get_substitutes
 
-NUTRITIONAL_VALUE_FIELDS = None
+
+class UnavailableIngredientsError(ValidationError):
+    """ ValidationError with the closest available substitutes: {ingredient id: suggestions}, see SubstituteIndex.suggest """
+    def __init__(self, message, substitutes):
+        super().__init__(message)
+        self.substitutes = substitutes
 
 
 def role_redirect(roles, redirect_url, do_redirect=True):
@@ -47,6 +55,9 @@ def handle_errors(view_func):
         except Ratelimited:
             return JsonResponse({"messages": [
                 {"level": "error", "message": "Too many requests. Please try again in a minute."}]}, status=429)
+        except UnavailableIngredientsError as e:
+            return JsonResponse({"messages": [{"level": "warning", "message": e.messages}], "substitutes": e.substitutes},
+                                status=400)
         except ValidationError as e:
             return JsonResponse({"messages": [{"level": "warning", "message": e.messages}]}, status=400)
         except Exception as e:
@@ -78,7 +89,8 @@ def get_timezone_dates():
 
 def order_validator(data: json, settings: dict):
     """ We return, save & use frontend price - if it's less than 0.1% different of official. Customer oriented
-    :return: price
+    Nutrition of the order is calculated here from DB values, the one sent by frontend is only validated
+    :return: PromoUsage or None, NutrientVector of the whole order, {ingredient id: grams} the order takes from stock
     """
     # Check ordering is On and it's working time
     if not settings.get("can_order"):
@@ -146,7 +158,7 @@ def order_validator(data: json, settings: dict):
 
     # Check all ingredients available
     all_ingredients = validation_result_official.get("ingredients").union(validation_result_custom.get("ingredients"))
-    validate_ingredient_availability(all_ingredients)
+    validate_ingredient_availability(all_ingredients, validation_result_custom.get("weights"))
 
     # Get and check base & finale price calculated on backend
     back_price_base = validation_result_official.get("total_price") + validation_result_custom.get("total_price")
@@ -159,10 +171,15 @@ def order_validator(data: json, settings: dict):
     if not validate_price_difference(back_price_base, front_price_base) or not validate_price_difference(back_price_final, front_price_final):
         raise ValidationError(message=f"Wrong calculated Price. Please review your order details.")
 
+    nutrition = validation_result_official.get("nutrition") + validation_result_custom.get("nutrition")
+    grams = validation_result_official.get("grams")
+    for ingredient_id, weight in validation_result_custom.get("grams").items():
+        grams[ingredient_id] = grams.get(ingredient_id, 0) + weight
+
     # Check promo
     if promo:
-        return PromoUsage.objects.create(promo=promo, discounted=round(discount), user=None, order=None)
-    return None
+        return PromoUsage.objects.create(promo=promo, discounted=round(discount), user=None, order=None), nutrition, grams
+    return None, nutrition, grams
 
 
 def validate_working_time(close_kitchen_before: int = 30):
@@ -188,14 +205,16 @@ def validate_working_time(close_kitchen_before: int = 30):
 
 def validate_official_meal(official_meals, min_blend=0):
     if not official_meals:
-        return {"total_price": 0, "ingredients": set(), "weight": 0}
+        return {"total_price": 0, "ingredients": set(), "grams": {}, "weight": 0, "nutrition": NutrientVector()}
 
     meal_ids = {meal["id"] for meal in official_meals}
-    products = {product.id: product for product in Product.objects.filter(id__in=meal_ids).prefetch_related('ingredients')}
+    products = {product.id: product for product in Product.objects.filter(id__in=meal_ids).select_related('nutritional_value')
+                .prefetch_related(Prefetch('productingredient_set', queryset=ProductIngredient.objects.order_by('id')))}
 
     total_price = 0
     total_weight = 0
-    ingredients_set = set()
+    total_nutrition = NutrientVector()
+    total_grams = {}  # ingredient id -> grams of all the meals, as process_official_meal puts them
 
     for meal in official_meals:
         meal_id = meal.get("id")
@@ -223,39 +242,55 @@ def validate_official_meal(official_meals, min_blend=0):
         if not product.is_available:
             raise ValidationError(message="Official Meal - product is not available.")
 
-        official_price = product.get_price_for_calories(calories)
+        calories_factor = calories / product.nutritional_value.calories
+        composition = Product.get_grid_composition((product_ingredient.ingredient_id, product_ingredient.weight_grams)
+                                                   for product_ingredient in product.productingredient_set.all())
+        point = product.get_calorie_point(calories, composition)
+        if point is not None:
+            official_price = point["price"]
+            weight = point["weight"]
+        elif product.calorie_grid:
+            grid = product.calorie_grid
+            raise ValidationError(message=f"Official Meal - {calories} kCal is not available, "
+                                          f"choose from {grid['min']} to {grid['max']} with step {grid['step']}.")
+        else:  # drinks & dishes the grid is not built for yet
+            official_price = product.get_price_for_calories(calories)
+            weight = product.weight * calories_factor
+
         if not validate_price_difference(official_price, price):
             raise ValidationError(message="Official Meal - wrong calculated price on web-site.")
 
-        weight = product.weight * (calories / product.nutritional_value.calories)
-
         if do_blend and weight < min_blend:
             raise ValidationError(message=f"Official Meal - weight is less than minimum allowed for blend, min is {min_blend}g.")
 
-        ingredients_set.update(product.ingredients.all())
+        for ingredient_key, grams in composition.items():
+            weight_grams = point["ingredients"][ingredient_key] if point else grams * calories_factor
+            ingredient_id = int(ingredient_key)
+            total_grams[ingredient_id] = total_grams.get(ingredient_id, 0) + weight_grams * amount
         total_price += official_price * amount
         total_weight += weight * amount
+        total_nutrition.add_scaled(NutrientVector.from_model(product.nutritional_value), calories_factor * amount)
 
-    return {"total_price": total_price, "ingredients": ingredients_set, "weight": total_weight}
+    return {"total_price": total_price, "ingredients": set(total_grams), "grams": total_grams, "weight": total_weight,
+            "nutrition": total_nutrition}
 
 
 def validate_custom_meal(custom_meals, min_blend=0):
     if not custom_meals:
-        return {"total_price": 0, "ingredients": set(), "weight": 0}
+        return {"total_price": 0, "ingredients": set(), "weights": {}, "grams": {}, "weight": 0, "nutrition": NutrientVector()}
 
     ingredient_ids = set()
     for meal in custom_meals:
         ingredient_ids.update(ing["id"] for ing in meal.get("ingredients", []))
-
-    all_ingredients_map = {ingredient.id: ingredient for ingredient in Ingredient.objects.filter(id__in=ingredient_ids)}
+    matrix = get_matrix(ingredient_id for ingredient_id in ingredient_ids if isinstance(ingredient_id, int))
 
     total_price = 0
     total_weight = 0
-    ingredients_set = set()
+    cart_rows = []  # ingredients of all meals & their weight * amount - nutrition of the cart in one go
+    cart_grams = []
+    total_grams = {}  # ingredient id -> grams of all the meals
 
     for meal in custom_meals:
-        product_price = 0
-        meal_weight = 0
         ingredients = meal.get("ingredients", [])
         amount = meal.get("amount")
         price = meal.get("price")
@@ -268,6 +303,8 @@ def validate_custom_meal(custom_meals, min_blend=0):
         if not isinstance(price, (int, float)):
             raise ValidationError(message="Custom Meal - wrong type for price.")
 
+        rows = []
+        grams = []
         for ingredient in ingredients:
             ingredient_id = ingredient.get("id")
             weight = ingredient.get("weight")
@@ -276,18 +313,20 @@ def validate_custom_meal(custom_meals, min_blend=0):
                 raise ValidationError(message=f"Custom Meal - wrong type for ingredient id. Received ({type(ingredient_id)})")
             if not isinstance(weight, (int, float)):
                 raise ValidationError(message=f"Custom Meal - wrong type for ingredient id. Received ({type(weight)})")
-
-            ingredient_obj = all_ingredients_map.get(ingredient_id)
-            if not ingredient_obj:
+            if ingredient_id not in matrix:
                 raise ValidationError(message="Custom Meal - wrong ingredient id.")
 
-            if weight > ingredient_obj.max_order or weight < ingredient_obj.min_order:
-                raise ValidationError(message=f"Custom Meal - wrong weight for ingredient, received {weight}, "
-                                              f"allowed {ingredient_obj.min_order} - {ingredient_obj.max_order}.")
+            rows.append(matrix.index[ingredient_id])
+            grams.append(weight)
+
+        wrong_weight = matrix.get_wrong_weights(rows, grams)
+        if wrong_weight:
+            row, weight = rows[wrong_weight[0]], grams[wrong_weight[0]]
+            raise ValidationError(message=f"Custom Meal - wrong weight for ingredient, received {weight}, "
+                                          f"allowed {round(matrix.min_order[row])} - {round(matrix.max_order[row])}.")
 
-            product_price += ingredient_obj.get_selling_price_for_weight(weight)
-            meal_weight += weight
-            ingredients_set.add(ingredient_obj)
+        product_price = float(matrix.get_prices(rows, grams).sum())
+        meal_weight = sum(grams)
 
         if do_blend and meal_weight < min_blend:
             raise ValidationError(message=f"Custom Meal - weight is less than minimum allowed for blend, min is {min_blend}g.")
@@ -297,19 +336,43 @@ def validate_custom_meal(custom_meals, min_blend=0):
 
         total_price += product_price * amount
         total_weight += meal_weight * amount
+        cart_rows.extend(rows)
+        cart_grams.extend(weight * amount for weight in grams)
+        for ingredient, weight in zip(ingredients, grams):
+            total_grams[ingredient["id"]] = total_grams.get(ingredient["id"], 0) + weight * amount
 
-    return {"total_price": total_price, "ingredients": ingredients_set, "weight": total_weight}
+    weights = {ingredient.get("id"): ingredient.get("weight") for meal in custom_meals for ingredient in meal.get("ingredients", [])}
+    return {"total_price": total_price, "ingredients": set(weights), "weights": weights, "grams": total_grams, "weight": total_weight,
+            "nutrition": matrix.get_nutrition(cart_rows, cart_grams)}
 
 
-def validate_ingredient_availability(ingredients: set):
-    unavailable = Ingredient.objects.filter(id__in=[ing.id for ing in ingredients], is_available=False).values_list('name', flat=True)
+def validate_ingredient_availability(ingredient_ids: set, weights=None):
+    """ :param weights: {ingredient id: grams} - the substitutes of unavailable ingredients are offered for these weights """
+    unavailable = dict(Ingredient.objects.filter(id__in=ingredient_ids, is_available=False).values_list('id', 'name'))
     if unavailable:
-        raise ValidationError(f"We're sorry to tell you that following ingredients are not available: {', '.join(unavailable)}.")
-    not_menu = Ingredient.objects.filter(id__in=[ing.id for ing in ingredients], is_menu=False).values_list('name', flat=True)
+        raise UnavailableIngredientsError(
+            f"We're sorry to tell you that following ingredients are not available: {', '.join(unavailable.values())}.",
+            get_substitutes(unavailable, weights))
+    not_menu = Ingredient.objects.filter(id__in=ingredient_ids, is_menu=False).values_list('name', flat=True)
     if not_menu:
         raise ValidationError(f"Following ingredients are not allowed to be ordered: {', '.join(not_menu)}.")
 
 
+def validate_availability_data(data):
+    """
+    :param data: {"ingredients": [ids], "is_available": bool} - without "is_available" every ingredient is toggled
+    :return: ingredient ids, is_available or None
+    """
+    ingredient_ids = data.get("ingredients")
+    is_available = data.get("is_available")
+    if not isinstance(ingredient_ids, list) or not ingredient_ids \
+            or not all(isinstance(ingredient_id, int) for ingredient_id in ingredient_ids):
+        raise ValidationError(message="Availability - ingredients are required.")
+    if is_available is not None and not isinstance(is_available, bool):
+        raise ValidationError(message="Availability - wrong type for is_available.")
+    return set(ingredient_ids), is_available
+
+
 def validate_price_difference(p1, p2, allowed_difference=0.1):
     """it doesn't matter divide difference to p1 or p2
     :param allowed_difference: in %, default 0.1%
@@ -323,18 +386,15 @@ def validate_price_difference(p1, p2, allowed_difference=0.1):
 def validate_nutritional_summary(nutritional_summary):
     if not nutritional_summary:
         raise ValidationError(f"Missing nutritions")
-    # Get all fields
-    model_fields = get_nutritional_value_fields()
-
     # Check if all required fields are present
-    missing_fields = set(model_fields) - set(nutritional_summary.keys())
+    missing_fields = [field for field in NUTRIENT_FIELDS if field not in nutritional_summary]
     if missing_fields:
         raise ValidationError(f"Missing required nutritional values: {', '.join(missing_fields)}")
 
     # Validate each provided value
     for key, value in nutritional_summary.items():
         # Check if field exists in model
-        if key not in model_fields:
+        if key not in NUTRIENT_FIELDS:
             raise ValidationError(f"Invalid field '{key}' in nutritional values")
 
         # Check if value is a number
@@ -350,16 +410,6 @@ def validate_nutritional_summary(nutritional_summary):
             raise ValidationError(f"Value for '{key}' exceeds maximum limit of 100,000 (current value: {value})")
 
 
-def get_nutritional_value_fields():
-    global NUTRITIONAL_VALUE_FIELDS
-    if NUTRITIONAL_VALUE_FIELDS is None:
-        NUTRITIONAL_VALUE_FIELDS = set(
-            field.name for field in NutritionalValue._meta.get_fields()
-            if not field.auto_created
-        )
-    return NUTRITIONAL_VALUE_FIELDS
-
-
 @transaction.atomic
 def process_official_meal(official_meals, order: Order):
     # Get all official products we need
@@ -389,17 +439,21 @@ def process_official_meal(official_meals, order: Order):
             product = existing_products.get(name)
 
             if not product:
-                weight_product = round(meal.get("weight"))
+                product_ingredients = official_product.productingredient_set.order_by("id")
+                composition = Product.get_grid_composition((product_ingredient.ingredient_id, product_ingredient.weight_grams)
+                                                           for product_ingredient in product_ingredients)
+                point = official_product.get_calorie_point(calories, composition)
+                weight_product = round(point["weight"] if point else meal.get("weight"))
                 coefficient = calories / official_product.nutritional_value.calories
 
                 product = Product.objects.create(name=name, description=official_product.description, image=official_product.image,
-                                                 is_menu=False, is_official=True, product_type=official_product.product_type,
+                                                 image_widths=official_product.image_widths, is_menu=False, is_official=True, product_type=official_product.product_type,
                                                  weight=weight_product)
 
-                # Collect required ingredients
-                for original_ingredient in official_product.productingredient_set.all():
-                    weight = round(original_ingredient.weight_grams * coefficient, 1)
-                    ProductIngredient.objects.create(product=product, ingredient=original_ingredient.ingredient, weight_grams=weight)
+                # Collect required ingredients, one row for an ingredient that is in the dish twice
+                for ingredient_key, grams in composition.items():
+                    weight = point["ingredients"][ingredient_key] if point else round(grams * coefficient, 1)
+                    ProductIngredient.objects.create(product=product, ingredient_id=int(ingredient_key), weight_grams=weight)
                 product.save()
 
             # Add OrderProduct to the list
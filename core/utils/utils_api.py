@@ -1,13 +1,48 @@
 from datetime import timedelta, datetime
 
+from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django.utils import timezone
 from django.utils.dateparse import parse_date, parse_datetime
 
-from core.models import Ingredient, Order, DaySetting, PromoUsage
+from core.models import Ingredient, Order, Setting, DaySetting, PromoUsage, ProductIngredient, NUTRIENT_FIELDS, recompute_products
+from core.utils import images
 
+NUTRIENT_PRESETS = {
+    "macros": ("calories", "proteins", "fats", "carbohydrates"),
+    "none": (),
+}
 
-def get_all_products(products: list):
+
+def get_nutrients_param(request):
+    """
+    ?nutrients=calories,proteins,... or a preset from NUTRIENT_PRESETS - NutritionalValue fields to load & send.
+    :return: tuple of the fields in NUTRIENT_FIELDS order, all of them if nothing is asked
+    """
+    value = request.GET.get("nutrients")
+    if not value:
+        return NUTRIENT_FIELDS
+    if value in NUTRIENT_PRESETS:
+        return NUTRIENT_PRESETS[value]
+    asked = set(value.split(","))
+    unknown = asked.difference(NUTRIENT_FIELDS)
+    if unknown:
+        raise ValidationError(f"Unknown nutrients: {', '.join(sorted(unknown))}")
+    return tuple(field for field in NUTRIENT_FIELDS if field in asked)
+
+
+def only_nutrients(queryset, nutrients=NUTRIENT_FIELDS, prefix="nutritional_value__"):
+    """ Defers NutritionalValue fields that are not asked, queryset has to select_related them by the prefix """
+    deferred = [prefix + field for field in NUTRIENT_FIELDS if field not in nutrients]
+    return queryset.defer(*deferred) if deferred else queryset
+
+
+def get_nutrients_dict(nutritional_value, nutrients=NUTRIENT_FIELDS):
+    """ NutritionalValue.to_dict() for the asked fields only, deferred ones are never touched """
+    return {field: getattr(nutritional_value, field) for field in nutrients}
+
+
+def get_all_products(products: list, nutrients=NUTRIENT_FIELDS):
     """ Uses to make orders by Customers"""
     data = []
     for product in products:
@@ -16,27 +51,72 @@ def get_all_products(products: list):
                         "name": product.name,
                         "description": product.description,
                         "image": product.image.url if product.image else "/static/icons/manage/no_image.png",
+                        "images": images.get_srcset(product.image.name, product.image_widths),
                         "weight": product.weight,
-                        "price": product.get_selling_price(),
+                        "price": product.effective_price,
                         "ingredients": [],
-                        "nutritional_value": product.nutritional_value.to_dict()}
+                        "nutritional_value": get_nutrients_dict(product.nutritional_value, nutrients)}
         for pi in product.productingredient_set.all():
             ingredient_info = {"id": pi.ingredient.id,
                                "name": pi.ingredient.name,
                                "weight_grams": pi.weight_grams,
-                               "nutritional_value": pi.ingredient.nutritional_value.to_dict(),
-                               "price": pi.ingredient.get_selling_price()}
+                               "nutritional_value": get_nutrients_dict(pi.ingredient.nutritional_value, nutrients),
+                               "price": pi.ingredient.effective_price}
             product_info.get("ingredients").append(ingredient_info)
         data.append(product_info)
     return data
 
 
+def get_menu(products, extra_ingredient_ids=(), nutrients=NUTRIENT_FIELDS):
+    """ Uses to make orders by Customers. Normalized version of get_all_products (format 2):
+    every ingredient is sent once, products refer to it as [id, weight_grams], nutrition goes as arrays ordered by "nutrients"
+    :param extra_ingredient_ids: ingredients to add to the lookup even if none of the products use them
+    :param nutrients: NutritionalValue fields to load & send, see get_nutrients_param
+    """
+    products = list(only_nutrients(products.select_related("nutritional_value"), nutrients))
+    product_ingredients = ProductIngredient.objects.filter(product__in=products).values_list("product_id", "ingredient_id", "weight_grams")
+
+    composition = {}
+    for product_id, ingredient_id, weight_grams in product_ingredients:
+        composition.setdefault(product_id, []).append([ingredient_id, weight_grams])
+
+    ingredient_ids = {ingredient_id for items in composition.values() for ingredient_id, _ in items}
+    ingredient_ids.update(extra_ingredient_ids)
+    ingredients = only_nutrients(Ingredient.objects.filter(id__in=ingredient_ids).select_related("nutritional_value"), nutrients)
+
+    return {
+        "format": 2,
+        "nutrients": nutrients,
+        "ingredients": {ingredient.id: {"name": ingredient.name,
+                                        "price": ingredient.effective_price,
+                                        "nutritional_value": get_nutrients_list(ingredient.nutritional_value, nutrients)}
+                        for ingredient in ingredients},
+        "products": [{"id": product.id,
+                      "product_type": product.product_type,
+                      "name": product.name,
+                      "description": product.description,
+                      "image": product.image.url if product.image else "/static/icons/manage/no_image.png",
+                      "images": images.get_srcset(product.image.name, product.image_widths),
+                      "weight": product.weight,
+                      "price": product.effective_price,
+                      "is_available": product.is_available,
+                      "ingredients": composition.get(product.id, []),
+                      "nutritional_value": get_nutrients_list(product.nutritional_value, nutrients)}
+                     for product in products],
+    }
+
+
+def get_nutrients_list(nutritional_value, nutrients=NUTRIENT_FIELDS):
+    return [getattr(nutritional_value, field) for field in nutrients]
+
+
 def get_products_data(product, is_full=False, is_admin=False):
     """ Uses in Control Panel"""
     data = {
         "id": product.id,
         "name": product.name,
         "image": product.image.url if product.image else "/static/icons/manage/no_image.png",
+        "images": images.get_srcset(product.image.name, product.image_widths),
         "product_type": product.product_type,
         "is_menu": product.is_menu,
         "is_official": product.is_official,
@@ -59,40 +139,56 @@ def get_products_data(product, is_full=False, is_admin=False):
 
         if product.lack_of_ingredients.exists():
             for ingredient in product.lack_of_ingredients.all():
-                ingredient_data = {"name": ingredient.name}
+                ingredient_data = {"id": ingredient.id, "name": ingredient.name}
                 data["lack_of_ingredients"].append(ingredient_data)
 
     if is_admin:
         if not product.price:
-            product.save()
+            recompute_products([product.id])
+            product.refresh_from_db(fields=["price"])
         data["ingredients_price"] = product.price
     return data
 
 
-def get_ingredient_data(ingredient: Ingredient):
+def get_ingredient_data(ingredient: Ingredient, nutrients_list=False, nutrients=NUTRIENT_FIELDS):
     """ Uses to make orders by Customers"""
+    nutritional_value = ingredient.nutritional_value
+    if nutritional_value:
+        if nutrients_list:
+            nutritional_value = get_nutrients_list(nutritional_value, nutrients)
+        else:
+            nutritional_value = get_nutrients_dict(nutritional_value, nutrients)
     return {
         "id": ingredient.id,
         "name": ingredient.name,
         "description": ingredient.description,
         "image": ingredient.image.url,
+        "images": images.get_srcset(ingredient.image.name, ingredient.image_widths),
         "ingredient_type": ingredient.ingredient_type,
         "step": ingredient.step,
         "min_order": ingredient.min_order,
         "max_order": ingredient.max_order,
         "is_available": ingredient.is_available,
-        "price": ingredient.selling_price if ingredient.selling_price else ingredient.purchase_price * ingredient.price_multiplier,
+        "price": ingredient.effective_price,
         "is_dish_ingredient": ingredient.is_dish_ingredient,
-        "nutritional_value": ingredient.nutritional_value.to_dict() if ingredient.nutritional_value else None,
+        "nutritional_value": nutritional_value,
     }
 
 
+def get_ingredients_catalog(ingredients, nutrients=NUTRIENT_FIELDS):
+    """ Uses to make orders by Customers, format 2 of get_ingredient_data for a list of ingredients """
+    return {"format": 2,
+            "nutrients": nutrients,
+            "ingredients": [get_ingredient_data(ingredient, nutrients_list=True, nutrients=nutrients) for ingredient in ingredients]}
+
+
 def get_ingredient_data_lite(ingredient: Ingredient, admin=False):
     """ Uses to show base info on Control Panel"""
     data = {
         "id": ingredient.id,
         "name": ingredient.name,
         "image": ingredient.image.url if ingredient.image else "/static/icons/manage/no_image.png",
+        "images": images.get_srcset(ingredient.image.name, ingredient.image_widths),
         "ingredient_type": ingredient.ingredient_type,
         "is_available": ingredient.is_available,
     }
@@ -102,7 +198,7 @@ def get_ingredient_data_lite(ingredient: Ingredient, admin=False):
     return data
 
 
-def get_ingredient_data_full(ingredient: Ingredient):
+def get_ingredient_data_full(ingredient: Ingredient, nutrients=NUTRIENT_FIELDS):
     """ Uses to show Full info on Control Panel"""
     return {
         "id": ingredient.id,
@@ -118,7 +214,7 @@ def get_ingredient_data_full(ingredient: Ingredient):
         "is_menu": ingredient.is_menu,
         "purchase_price": ingredient.purchase_price,
         "selling_price": ingredient.selling_price,
-        "nutritional_value": ingredient.nutritional_value.to_dict() if ingredient.nutritional_value else None,
+        "nutritional_value": get_nutrients_dict(ingredient.nutritional_value, nutrients) if ingredient.nutritional_value else None,
     }
 
 
@@ -150,7 +246,7 @@ def get_orders_general(orders):
     return [get_order_general(order) for order in orders]
 
 
-def get_order_full(order):
+def get_order_full(order, nutrients=NUTRIENT_FIELDS):
     data_to_send = {
         "id": order.id,
         "user_role": order.user.role,
@@ -171,7 +267,7 @@ def get_order_full(order):
         "refunded_at": order.refunded_at,
         "public_note": order.public_note,
         "private_note": order.private_note,
-        "nutritional_value": order.nutritional_value.to_dict(),
+        "nutritional_value": get_nutrients_dict(order.nutritional_value, nutrients),
         "products": [],
     }
 
@@ -195,7 +291,7 @@ def get_order_full(order):
             "amount": order_product.amount,
             "is_official": product.is_official,
             "do_blend": order_product.do_blend,
-            "nutritional_value": product.nutritional_value.to_dict() if product.nutritional_value else None,
+            "nutritional_value": get_nutrients_dict(product.nutritional_value, nutrients) if product.nutritional_value else None,
             "ingredients": [],
         }
 
@@ -240,6 +336,16 @@ def get_order_last(order: Order):
     return data_to_send
 
 
+def get_settings_data():
+    """ Settings the customer needs before checkout: prices, limits & opening hours """
+    settings = Setting.objects.values("tax", "service", "can_order", "close_kitchen_before", "minimum_order_amount",
+                                      "maximum_order_amount", "maximum_order_weight", "minimum_blend_weight", "timezone").first()
+    if settings is None:
+        return None
+    settings["opening_hours"] = list(DaySetting.objects.order_by("day").values("day", "is_open", "open_hours", "close_hours"))
+    return settings
+
+
 def get_order_for_kitchen(order: Order):
     data_to_send = {
         "id": order.id,
@@ -386,6 +492,9 @@ def filter_orders(request, orders):
     return orders
 
 
+PRODUCT_SORT_FIELDS = {"price": "effective_price", "name": "name", "id": "id"}
+
+
 def filter_products(request, products):
     # Get filter parameters from request.GET
     search = request.GET.get("search", "").lower()
@@ -396,6 +505,7 @@ def filter_products(request, products):
     is_enabled = request.GET.get("enabled") == "true"
     is_official = request.GET.get("official") == "true"
     is_menu = request.GET.get("menu") == "true"
+    sort = request.GET.get("sort", "")
 
     # Search filter
     if search:
@@ -415,6 +525,11 @@ def filter_products(request, products):
     if is_menu:
         products = products.filter(is_menu=True)
 
+    # Sorting: ?sort=price / -price (the selling price), name, id - in SQL, before the list is cut
+    sort_field = PRODUCT_SORT_FIELDS.get(sort.lstrip("-"))
+    if sort_field:
+        products = products.order_by(f"-{sort_field}" if sort.startswith("-") else sort_field, "id")
+
     return products
 
 
@@ -5,11 +5,24 @@ import * as utils from './utils.js';
 
 let currentDiscount = 0;
 let maxDiscount = 0;
+// Replaced with the real settings as soon as they are loaded
+let serviceChargeRate = 0.01;
+let taxRate = 0.07;
 
 document.addEventListener('DOMContentLoaded', function () {
     updateCartUI();
     utils.updateOrderSummary();
 
+    utils.loadSettings()
+        .then(settings => {
+            if (settings) {
+                serviceChargeRate = settings.service / 100;
+                taxRate = settings.tax / 100;
+                updateCartUI();
+            }
+        })
+        .catch(error => console.error('Error:', error));
+
     document.getElementById('checkoutButton').addEventListener('click', handleCheckout);
     document.getElementById('checkPromoButton').addEventListener('click', handlePromoCheck);
 });
@@ -58,10 +71,6 @@ function updateCartUI() {
             total += item.product.price * item.amount;
         });
 
-        // Calculate tax and service charge
-        const serviceChargeRate = 0.01; // 1% service charge
-        const taxRate = 0.07; // 7% tax rate
-
         // Новый расчет скидки с учетом максимального значения
         let discountAmount = total * currentDiscount;
         if (maxDiscount > 0 && discountAmount > maxDiscount) {
@@ -208,8 +217,8 @@ function handleCheckout() {
 
     const rawPrice = storage.getRawPrice();
     const discountedPrice = rawPrice * (1 - currentDiscount);
-    const serviceCharge = discountedPrice * 0.01;
-    const tax = (discountedPrice + serviceCharge) * 0.07;
+    const serviceCharge = discountedPrice * serviceChargeRate;
+    const tax = (discountedPrice + serviceCharge) * taxRate;
     const totalPrice = discountedPrice + serviceCharge + tax;
 
     const cartData = {
@@ -256,11 +265,24 @@ function handleCheckout() {
                 if (data.messages) {
                     MessageManager.handleAjaxMessages(data.messages)
                 }
+                if (data.substitutes) {
+                    showSubstitutes(data.substitutes);
+                }
             }
         })
         .catch(error => console.error('Error:', error));
 }
 
+// Unavailable ingredients of the cart - the closest ones by nutrition, for the same calories
+function showSubstitutes(substitutes) {
+    Object.values(substitutes).forEach(suggestions => {
+        if (suggestions.length > 0) {
+            const names = suggestions.map(sub => sub.weight ? `${sub.name} (${utils.formatNumber(sub.weight)}g)` : sub.name).join(', ');
+            MessageManager.showToast(`You can replace it with: ${names}`, 'info');
+        }
+    });
+}
+
 function updateCartControls() {
     const paymentTypeSelect = document.getElementById('paymentType');
     const promoCodeContainer = document.getElementById('promoCodeContainer');
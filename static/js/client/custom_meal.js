@@ -15,8 +15,27 @@ document.addEventListener('DOMContentLoaded', function () {
     });
 
     document.getElementById('addToOrderBtn').addEventListener('click', addToOrder);
+    document.getElementById('fitTargetsBtn').addEventListener('click', fitTargets);
+    document.querySelectorAll('.target-input').forEach(input => input.addEventListener('change', fitTargets));
+
+    utils.subscribeEvents({availability: updateAvailability});
 });
 
+function updateAvailability(event) {
+    const customMealDraft = utils.getCustomMealDraft();
+    const chosen = customMealDraft && customMealDraft.product ? customMealDraft.product.ingredients : [];
+
+    Object.entries(event.ingredients).forEach(([id, isAvailable]) => {
+        document.querySelectorAll(`.ingredient-card[data-ingredient-id="${id}"]`)
+            .forEach(card => card.classList.toggle('opacity-50', !isAvailable));
+
+        const ingredient = chosen.find(ingredient => String(ingredient.id) === id);
+        if (ingredient && !isAvailable) {
+            MessageManager.showToast(`${ingredient.name} is not available now, please choose another ingredient.`, 'warning');
+        }
+    });
+}
+
 function loadIngredients(sortBy = 'protein') {
     const validSortOptions = {
         protein: 'proteins',
@@ -28,19 +47,14 @@ function loadIngredients(sortBy = 'protein') {
 
     const nutrientKey = validSortOptions[sortBy] || 'proteins';
 
-    fetch(`/api/get/ingredients/`)
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('Error fetching ingredients.');
-            }
-            return response.json();
-        }).then(data => {
+    utils.loadIngredientsCatalog()
+        .then(data => {
 
             if (data.messages) {
                 MessageManager.handleAjaxMessages(data.messages)
             }
 
-            const ingredients = data.ingredients;
+            const ingredients = utils.unpackIngredients(data);
             ingredients.sort((a, b) => {
                 const aValue = a.nutritional_value[nutrientKey] || 0;
                 const bValue = b.nutritional_value[nutrientKey] || 0;
@@ -54,7 +68,7 @@ function loadIngredients(sortBy = 'protein') {
                 const card = document.createElement('div');
                 card.className = 'col-md-4 mb-4';
                 card.innerHTML = `
-                    <div class="card h-100 ingredient-card" data-ingredient-id="${ingredient.id}">
+                    <div class="card h-100 ingredient-card ${ingredient.is_available === false ? 'opacity-50' : ''}" data-ingredient-id="${ingredient.id}">
                         <div class="card-body">
                             <div class="row">
                                 <div class="col-8">
@@ -63,7 +77,7 @@ function loadIngredients(sortBy = 'protein') {
                                     <p class="card-text">${ingredient.price} IDR / g</p>
                                 </div>
                                 <div class="col-4 d-flex align-items-center justify-content-center">
-                                    <img src="${ingredient.image}" alt="${ingredient.name}" class="img-fluid" style="max-height: 100px; object-fit: cover;">
+                                    ${utils.imageTag(ingredient, 'img-fluid ingredient-thumb', '100px')}
                                 </div>
                             </div>
                         </div>
@@ -111,6 +125,42 @@ function addToOrder() {
     window.location.href = '/';
 }
 
+function getTargets() {
+    const targets = {};
+    document.querySelectorAll('.target-input').forEach(input => {
+        if (input.value === '') {
+            return;
+        }
+        const value = parseFloat(input.value);
+        const bound = input.dataset.bound;
+        targets[input.dataset.nutrient] = bound === 'min' ? [value, null] : bound === 'max' ? [null, value] : value;
+    });
+    return targets;
+}
+
+async function fitTargets() {
+    const customMealDraft = utils.getCustomMealDraft();
+    const ingredients = customMealDraft.product.ingredients;
+    const targets = getTargets();
+    if (ingredients.length === 0 || Object.keys(targets).length === 0) {
+        return;
+    }
+
+    const solution = await utils.solveCustomMeal(
+        ingredients.map(ingredient => ingredient.id),
+        ingredients.map(ingredient => ingredient.weight_grams),
+        targets
+    );
+    if (!solution) {
+        return;
+    }
+
+    ingredients.forEach((ingredient, index) => ingredient.weight_grams = solution.weights[index]);
+    utils.recalculateCustomMealSummary(customMealDraft);
+    showChosenIngredients();
+    utils.updateCustomMealSummary();
+}
+
 export function showChosenIngredients() {
     const customMealDraft = utils.getCustomMealDraft();
     const selectedIngredientsBody = document.getElementById('selectedIngredientsBody');
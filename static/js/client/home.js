@@ -3,27 +3,50 @@
 import storage from './storage.js';
 import * as utils from './utils.js';
 
+const productsById = new Map();
+let similarDishes = {};     // product id -> ids of similar available dishes, best first
+
 document.addEventListener('DOMContentLoaded', function () {
     const dishesList = document.getElementById('dishesList');
     const drinksList = document.getElementById('drinksList');
 
     // Загрузка продуктов с сервера
-    fetch('/api/get/products/')
-        .then(response => response.json())
+    utils.loadMenu()
         .then(data => {
-            data.products.forEach(product => {
+            similarDishes = data.similar || {};
+            utils.unpackMenu(data).forEach(product => {
+                productsById.set(product.id, product);
                 const productElement = createProductElement(product);
                 if (product.product_type === 'dish') {
                     dishesList.appendChild(productElement);
                 } else if (product.product_type === 'drink') {
                     drinksList.appendChild(productElement);
                 }
+                showAvailability(product);
             });
         });
 
+    utils.subscribeEvents({availability: updateAvailability});
     utils.updateOrderSummary();
 });
 
+function updateAvailability(event) {
+    Object.entries(event.products).forEach(([id, isAvailable]) => {
+        const product = productsById.get(parseInt(id));
+        if (product) {
+            product.is_available = isAvailable;
+            showAvailability(product);
+        }
+    });
+}
+
+function showAvailability(product) {
+    const available = product.is_available !== false;
+    document.querySelectorAll(`.product-card[data-product-id="${product.id}"]`)
+        .forEach(card => card.classList.toggle('opacity-50', !available));
+    document.querySelectorAll(`.add-to-cart[data-product-id="${product.id}"]`).forEach(button => button.disabled = !available);
+}
+
 function createProductElement(product) {
     if (product.product_type === 'drink') {
         return createDrinkElement(product);
@@ -32,7 +55,7 @@ function createProductElement(product) {
     productDiv.className = 'col-md-4 mb-4';
     productDiv.innerHTML = `
         <div class="card h-100 product-card" data-product-id="${product.id}">
-            <img src="${product.image}" class="card-img-top product-image" alt="${product.name}">
+            ${utils.imageTag(product, 'card-img-top product-image', '(min-width: 768px) 33vw, 100vw')}
             <div class="card-body">
                 <h5 class="card-title">${product.name}</h5>
                 <p class="card-text">${product.description}</p>
@@ -67,7 +90,7 @@ function createDrinkElement(product) {
     }
     drinkDiv.innerHTML = `
         <div class="col-md-3">
-            <img src="${product.image}" class="img-fluid" alt="${product.name}">
+            ${utils.imageTag(product, 'img-fluid', '(min-width: 768px) 25vw, 100vw')}
         </div>
         <div class="col-md-9">
             <h5>${product.name}</h5>
@@ -117,7 +140,7 @@ function showDishDetails(product, modalBody, modal) {
                 <p>${product.description}</p>
             </div>
             <div class="col-md-4">
-                <img src="${product.image}" class="img-fluid" alt="${product.name}">
+                ${utils.imageTag(product, 'img-fluid', '(min-width: 768px) 33vw, 100vw')}
             </div>
         </div>
         <table class="table table-bordered">
@@ -144,53 +167,66 @@ function showDishDetails(product, modalBody, modal) {
             <button id="addToCart" class="btn btn-primary">Add to Cart</button>
         </div>
     `;
+    showSimilarDishes(product, modalBody, modal);
 
     const nutritionalValueBody = modalBody.querySelector('#nutritional_value');
     const addToCartButton = modalBody.querySelector('#addToCart');
+    addToCartButton.disabled = product.is_available === false;
     const editButton = modalBody.querySelector('#editButton');
 
+    let grid = null;
+    const getSelectedCalories = () => {
+        const checked = modalBody.querySelector('input[name="calorieOption"]:checked');
+        return checked ? parseInt(checked.value) : null;
+    };
+
     editButton.addEventListener('click', () => {
-        const selectedCalories = parseInt(modalBody.querySelector('input[name="calorieOption"]:checked').value);
-        editDish(product, selectedCalories);
+        const selectedCalories = getSelectedCalories();
+        if (selectedCalories) editDish(product, selectedCalories, grid);
     });
 
     const nutritional_value = product.nutritional_value;
     if (nutritional_value) {
         const baseCalories = nutritional_value.calories;
-        const calorieOptions = [400, 500, 600, 800];
-
-        calorieOptions.forEach((calories, index) => {
-            const multiplier = calories / baseCalories;
-            const row = nutritionalValueBody.insertRow();
-            row.innerHTML = `
-                <td>${calories}</td>
-<!--                <td>${(product.weight * multiplier).toFixed(0)}</td>-->
-                <td>${utils.formatNumber(product.weight * multiplier)}</td>
-                <td>${utils.formatNumber(nutritional_value.fats * multiplier)}</td>
-                <td>${utils.formatNumber(nutritional_value.saturated_fats * multiplier)}</td>
-                <td>${utils.formatNumber(nutritional_value.carbohydrates * multiplier)}</td>
-                <td>${utils.formatNumber(nutritional_value.sugars * multiplier)}</td>
-                <td>${utils.formatNumber(nutritional_value.fiber * multiplier)}</td>
-                <td>${utils.formatNumber(nutritional_value.proteins * multiplier)}</td>
-                <td>${(product.price * multiplier).toFixed(0)} IDR</td>
-                <td>
-                    <input type="radio" name="calorieOption" value="${calories}" ${index === 0 ? 'checked' : ''}>
-                </td>
-            `;
+        // Numbers come from the calorie grid (the same checkout uses), scaled here only if there's no grid
+        utils.loadCalorieGrid(product.id).then(calorieGrid => {
+            grid = calorieGrid;
+            utils.getCalorieOptions(grid, [400, 500, 600, 800]).forEach((calories, index) => {
+                const multiplier = calories / baseCalories;
+                const point = utils.getCaloriePoint(grid, calories);
+                const nutrient = name => point ? point.nutrients[grid.nutrients.indexOf(name)] : nutritional_value[name] * multiplier;
+                const row = nutritionalValueBody.insertRow();
+                row.innerHTML = `
+                    <td>${calories}</td>
+                    <td>${utils.formatNumber(point ? point.weight : product.weight * multiplier)}</td>
+                    <td>${utils.formatNumber(nutrient('fats'))}</td>
+                    <td>${utils.formatNumber(nutrient('saturated_fats'))}</td>
+                    <td>${utils.formatNumber(nutrient('carbohydrates'))}</td>
+                    <td>${utils.formatNumber(nutrient('sugars'))}</td>
+                    <td>${utils.formatNumber(nutrient('fiber'))}</td>
+                    <td>${utils.formatNumber(nutrient('proteins'))}</td>
+                    <td>${(point ? point.price : product.price * multiplier).toFixed(0)} IDR</td>
+                    <td>
+                        <input type="radio" name="calorieOption" value="${calories}" ${index === 0 ? 'checked' : ''}>
+                    </td>
+                `;
+            });
         });
     }
 
     addToCartButton.addEventListener('click', () => {
-        const selectedCalories = parseInt(modalBody.querySelector('input[name="calorieOption"]:checked').value);
+        const selectedCalories = getSelectedCalories();
+        if (!selectedCalories) return;
         const multiplier = selectedCalories / nutritional_value.calories;
+        const point = utils.getCaloriePoint(grid, selectedCalories);
         const customProduct = {
             ...product,
             selectedCalories: selectedCalories,
             nutritional_value: Object.fromEntries(
                 Object.entries(nutritional_value).map(([key, value]) => [key, typeof value === 'number' ? value * multiplier : value])
             ),
-            price: product.price * multiplier,
-            weight: product.weight * multiplier
+            price: point ? point.price : product.price * multiplier,
+            weight: point ? point.weight : product.weight * multiplier
         };
         addToCart(customProduct, 1);
         utils.updateOrderSummary();
@@ -198,11 +234,30 @@ function showDishDetails(product, modalBody, modal) {
     });
 }
 
-function editDish(product, selectedCalories) {
+function showSimilarDishes(product, modalBody, modal) {
+    const similar = (similarDishes[product.id] || []).map(id => productsById.get(id)).filter(Boolean);
+    if (similar.length === 0) {
+        return;
+    }
+
+    const similarDiv = document.createElement('div');
+    similarDiv.className = 'mt-3';
+    similarDiv.innerHTML = `
+        <h6>${product.is_available === false ? 'This dish is not available now, try:' : 'Similar dishes:'}</h6>
+        ${similar.map(dish => `<button class="btn btn-sm btn-outline-secondary me-2 mb-2 similar-dish" data-id="${dish.id}">${dish.name}</button>`).join('')}
+    `;
+    similarDiv.querySelectorAll('.similar-dish').forEach(button => {
+        button.addEventListener('click', () => showDishDetails(productsById.get(parseInt(button.dataset.id)), modalBody, modal));
+    });
+    modalBody.appendChild(similarDiv);
+}
+
+function editDish(product, selectedCalories, grid) {
     storage.clearCustomMealDraft();
 
     const baseCalories = product.nutritional_value.calories;
     const multiplier = selectedCalories / baseCalories;
+    const point = utils.getCaloriePoint(grid, selectedCalories);
 
     const customMealDraft = {
         product: {
@@ -213,9 +268,12 @@ function editDish(product, selectedCalories) {
             selectedCalories: 0,
             nutritional_value: {},
             price: 0,
+            // The grid has the grams of an ingredient (summed if it's in the dish twice) - its rows get their share
             ingredients: product.ingredients.map(ingredient => ({
                 ...ingredient,
-                weight_grams: (parseFloat((ingredient.weight_grams * multiplier).toFixed(1)))
+                weight_grams: point && grid.composition[ingredient.id]
+                    ? parseFloat((point.ingredients[ingredient.id] * ingredient.weight_grams / grid.composition[ingredient.id]).toFixed(1))
+                    : parseFloat((ingredient.weight_grams * multiplier).toFixed(1))
             }))
         },
         amount: 1
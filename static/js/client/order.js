@@ -2,13 +2,25 @@
 
 import * as utils from './utils.js';
 
+let shownOrderId = null;
+
 document.addEventListener('DOMContentLoaded', function() {
     fetchOrderDetails();
     utils.updateOrderSummary(false)
+    utils.subscribeEvents({order: updateOrderStatus});
 });
 
+// Pushed by the server when the order changes, instead of reloading the page
+function updateOrderStatus(order) {
+    if (order.id !== shownOrderId) {
+        return;
+    }
+    document.getElementById('order-status').textContent = order.order_status;
+    showPaidStatus(order);
+}
+
 function fetchOrderDetails() {
-    fetch('/api/get/order/last/')
+    utils.cachedFetch('/api/get/order/last/')
         .then(async response => {
             const data = await response.json()
 
@@ -25,16 +37,29 @@ function fetchOrderDetails() {
 
 function displayOrderDetails(order) {
     // Display the order ID and status
+    shownOrderId = order.id;
     document.getElementById('order-id').textContent = order.id;
     document.getElementById('order-status').textContent = order.order_status;
+    showPaidStatus(order);
+
+    // Display the list of products and nutritional value details
+    displayProducts(order.products);
+    displayNutritionalValue(order.nutritional_value);
+
+    // Display the total price of the order
+    console.log(order)
+    document.getElementById('total-price').textContent = `${order.total_price}`;
+}
 
+function showPaidStatus(order) {
     // Determine the payment status based on order.is_paid
     const paidStatus = order.is_paid ? 'Paid' : 'Not Paid';
     const paidStatusElement = document.getElementById('order-paid-status');
     paidStatusElement.textContent = paidStatus;
 
     // Add appropriate background color class based on the payment status
-    paidStatusElement.classList.add(order.is_paid ? 'bg-success' : 'bg-danger');
+    paidStatusElement.classList.toggle('bg-success', order.is_paid);
+    paidStatusElement.classList.toggle('bg-danger', !order.is_paid);
 
     // Set the text color based on the payment status in another element
     const paymentStatusElement = document.getElementById('payment-status');
@@ -47,14 +72,6 @@ function displayOrderDetails(order) {
     } else {
         paymentTimeElement.textContent = `Ordered: ${new Date(order.created_at).toLocaleString()}`;
     }
-
-    // Display the list of products and nutritional value details
-    displayProducts(order.products);
-    displayNutritionalValue(order.nutritional_value);
-
-    // Display the total price of the order
-    console.log(order)
-    document.getElementById('total-price').textContent = `${order.total_price}`;
 }
 
 function displayProducts(products) {
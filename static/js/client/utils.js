@@ -1,6 +1,9 @@
 // utils.js
 
 import storage from './storage.js';
+import {cachedFetch} from '../common/utils.js';
+
+export {cachedFetch, subscribeEvents} from '../common/utils.js';
 
 export function formatNumber(number, fixed=1) {
     if (number === undefined) {
@@ -68,6 +71,192 @@ export function updateOrderSummary(update_nutrition_block = true) {
     }
 }
 
+///////////////////////////
+// API format 2
+///////////////////////////
+
+// Nutrition comes as an array ordered by "nutrients" field of the response
+export function unpackNutrients(nutrients, values) {
+    return Object.fromEntries(nutrients.map((key, index) => [key, values[index]]));
+}
+
+// Products refer to ingredients as [id, weight_grams] - put ingredients back into products
+export function unpackMenu(data) {
+    return data.products.map(product => ({
+        ...product,
+        nutritional_value: unpackNutrients(data.nutrients, product.nutritional_value),
+        ingredients: product.ingredients.map(([id, weightGrams]) => {
+            const ingredient = data.ingredients[id];
+            return {
+                id: id,
+                name: ingredient.name,
+                weight_grams: weightGrams,
+                nutritional_value: unpackNutrients(data.nutrients, ingredient.nutritional_value),
+                price: ingredient.price
+            };
+        })
+    }));
+}
+
+// Calorie grid of a dish: price, weight, macros & ingredients for every step. Checkout accepts only its points
+const calorieGrids = new Map();
+
+export function loadCalorieGrid(productId) {
+    if (!calorieGrids.has(productId)) {
+        calorieGrids.set(productId, cachedFetch(`/api/get/product/${productId}/calorie-grid/`)
+            .then(async response => response.ok ? (await response.json()).calorie_grid : null)
+            .catch(() => null));
+    }
+    return calorieGrids.get(productId);
+}
+
+// null if there's no grid or the calories are not on it - then the numbers are scaled from the dish
+export function getCaloriePoint(grid, calories) {
+    return grid ? grid.points[String(calories)] || null : null;
+}
+
+// Every dish has its own range (its ingredients' allowed weights) - the offered calories are moved into it
+export function getCalorieOptions(grid, defaults) {
+    if (!grid) return defaults;
+    const options = defaults.map(calories => Math.min(Math.max(Math.round(calories / grid.step) * grid.step, grid.min), grid.max));
+    return [...new Set(options)];
+}
+
+// Weights of the chosen ingredients for the targets ({calories: 600, proteins: [40, null], ...}), in their order.
+// Current weights are the start point, so the sliders move as little as needed
+export async function solveCustomMeal(ingredientIds, weights, targets) {
+    const response = await fetch('/api/custom-meal/solve/', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value,
+        },
+        body: JSON.stringify({ingredients: ingredientIds, weights: weights, targets: targets}),
+    });
+    const data = await response.json();
+    if (!response.ok) {
+        if (data.messages) {
+            MessageManager.handleAjaxMessages(data.messages)
+        }
+        return null;
+    }
+    return data;
+}
+
+// Resized WebP/JPEG versions if the server has them (item.images), the original image otherwise
+export function imageTag(item, className, sizes) {
+    if (!item.images) {
+        return `<img src="${item.image}" class="${className}" alt="${item.name}" loading="lazy">`;
+    }
+    return `<picture>
+        <source type="image/webp" srcset="${item.images.webp}" sizes="${sizes}">
+        <img src="${item.image}" srcset="${item.images.jpeg}" sizes="${sizes}" class="${className}" alt="${item.name}" loading="lazy">
+    </picture>`;
+}
+
+// Menu & ingredients are kept with their catalog version, next time only the changes since that version are loaded
+const MENU_KEY = 'catalogMenu';
+const INGREDIENTS_KEY = 'catalogIngredients';
+const SETTINGS_KEY = 'settings';
+
+let bootstrapPromise = null;
+
+// Cold start: menu, ingredients, settings & the last order come in 1 request, saved for the next pages
+export function loadBootstrap() {
+    if (!bootstrapPromise) {
+        bootstrapPromise = fetch('/api/get/bootstrap/')
+            .then(async response => {
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error('Error fetching bootstrap data.');
+                }
+                if (data.menu.version) saveCatalog(MENU_KEY, data.menu);
+                if (data.ingredients.version) saveCatalog(INGREDIENTS_KEY, data.ingredients);
+                if (data.settings) sessionStorage.setItem(SETTINGS_KEY, JSON.stringify(data.settings));
+                return data;
+            })
+            .catch(error => {
+                bootstrapPromise = null;
+                throw error;
+            });
+    }
+    return bootstrapPromise;
+}
+
+export function loadMenu() {
+    return loadCatalog(MENU_KEY, 'menu', applyMenuDelta);
+}
+
+export function loadIngredientsCatalog() {
+    return loadCatalog(INGREDIENTS_KEY, 'ingredients', applyIngredientsDelta);
+}
+
+// Settings (tax, service, limits, opening hours) are kept for the session only
+export async function loadSettings() {
+    const saved = JSON.parse(sessionStorage.getItem(SETTINGS_KEY));
+    if (saved) {
+        return saved;
+    }
+    return (await loadBootstrap()).settings;
+}
+
+async function loadCatalog(storageKey, bootstrapKey, applyDelta) {
+    const saved = JSON.parse(localStorage.getItem(storageKey));
+
+    if (saved && saved.version) {
+        const response = await fetch(`/api/get/catalog/delta/?since=${saved.version}`);
+        const delta = response.ok ? await response.json() : {full: true};
+
+        if (!delta.full && delta.nutrients.join() === saved.nutrients.join()) {
+            applyDelta(saved, delta);
+            saved.version = delta.version;
+            saveCatalog(storageKey, saved);
+            return saved;
+        }
+    }
+
+    const data = (await loadBootstrap())[bootstrapKey];
+    if (!data.version) {
+        localStorage.removeItem(storageKey);
+    }
+    return data;
+}
+
+function saveCatalog(storageKey, data) {
+    try {
+        localStorage.setItem(storageKey, JSON.stringify(data));
+    } catch (error) {
+        localStorage.removeItem(storageKey);    // storage is full - load everything next time
+    }
+}
+
+function applyMenuDelta(menu, delta) {
+    const skip = new Set([...delta.removed.products, ...delta.menu.products.map(product => product.id)]);
+    menu.products = menu.products
+        .filter(product => !skip.has(product.id))
+        .concat(delta.menu.products)
+        .sort((a, b) => a.id - b.id);
+    Object.assign(menu.ingredients, delta.menu.ingredients);
+    if (delta.menu.similar) {
+        menu.similar = delta.menu.similar;  // a change of one dish can change the similar dishes of the others
+    }
+}
+
+function applyIngredientsDelta(catalog, delta) {
+    const skip = new Set([...delta.removed.ingredients, ...delta.ingredients.map(ingredient => ingredient.id)]);
+    catalog.ingredients = catalog.ingredients
+        .filter(ingredient => !skip.has(ingredient.id))
+        .concat(delta.ingredients)
+        .sort((a, b) => a.id - b.id);
+}
+
+export function unpackIngredients(data) {
+    return data.ingredients.map(ingredient => ({
+        ...ingredient,
+        nutritional_value: ingredient.nutritional_value ? unpackNutrients(data.nutrients, ingredient.nutritional_value) : null
+    }));
+}
+
 ///////////////////////////
 // custom_meal & custom_add
 ///////////////////////////
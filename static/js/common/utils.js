@@ -0,0 +1,46 @@
+// utils.js - shared by the client and manage pages
+
+// GET with the ETag of the copy we already have: on 304 the copy is returned as a regular 200 response
+export async function cachedFetch(url) {
+    const key = `etag:${url}`;
+    const cached = JSON.parse(sessionStorage.getItem(key));
+    const response = await fetch(url, {headers: cached ? {'If-None-Match': cached.etag} : {}});
+
+    if (response.status === 304 && cached) {
+        return new Response(cached.body, {status: 200, headers: {'Content-Type': 'application/json'}});
+    }
+
+    const etag = response.headers.get('ETag');
+    if (response.ok && etag) {
+        try {
+            sessionStorage.setItem(key, JSON.stringify({etag: etag, body: await response.clone().text()}));
+        } catch (error) {
+            sessionStorage.removeItem(key);     // storage is full - just don't keep this one
+        }
+    }
+    return response;
+}
+
+// Server pushes (see api.get_events), one connection per page. onReconnect - events could be missed, load everything again
+// :return: false if the browser can't receive them - poll instead
+let eventSource = null;
+
+export function subscribeEvents(handlers, onReconnect = null) {
+    if (!window.EventSource) {
+        return false;
+    }
+    if (!eventSource) {
+        eventSource = new EventSource('/api/events/');
+    }
+    Object.entries(handlers).forEach(([name, handler]) => {
+        eventSource.addEventListener(name, event => handler(JSON.parse(event.data)));
+    });
+    if (onReconnect) {
+        let opened = false;
+        eventSource.addEventListener('open', () => {
+            if (opened) onReconnect();
+            opened = true;
+        });
+    }
+    return true;
+}
@@ -1,10 +1,12 @@
 // history.js
 
+import {cachedFetch} from "./utils.js";
+
 let orders = [];
 
 async function loadOrders() {
     try {
-        const response = await fetch('/api/control/get/orders/history/');
+        const response = await cachedFetch('/api/control/get/orders/history/');
         orders = await response.json();
         displayOrders(orders);
     } catch (error) {
@@ -48,7 +50,7 @@ function getStatusColor(status) {
 
 window.showOrderHistory = async function (orderId) {
     try {
-        const response = await fetch(`/api/control/get/order/history/${orderId}/`);
+        const response = await cachedFetch(`/api/control/get/order/history/${orderId}/`);
         const history = await response.json();
 
         const historyContent = document.getElementById('historyContent');
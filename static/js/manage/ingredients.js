@@ -1,6 +1,6 @@
 // ingredients.js
 
-import {getCookie, getUserRole} from "./utils.js";
+import {cachedFetch, getCookie, getUserRole} from "./utils.js";
 
 let data = [];
 const is_admin = getUserRole() === 'owner' || getUserRole() === 'administrator';
@@ -70,7 +70,7 @@ function initializeAdminFeatures() {
 
 async function loadIngredients() {
     try {
-        const response = await fetch('/api/control/get/ingredients/');
+        const response = await cachedFetch('/api/control/get/ingredients/');
         const responseData = await response.json();
 
         if (responseData.messages) {
@@ -88,7 +88,7 @@ async function loadIngredients() {
 
 async function loadIngredientDetails(ingredientId) {
     try {
-        const response = await fetch(`/api/control/get/ingredient/${ingredientId}/`);
+        const response = await cachedFetch(`/api/control/get/ingredient/${ingredientId}/`);
         const data = await response.json();
 
         if (data.messages) {
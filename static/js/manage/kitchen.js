@@ -1,12 +1,15 @@
 // kitchen.js
 
-import {REFRESH_INTERVAL, getCookie} from "./utils.js";
+import {REFRESH_INTERVAL, cachedFetch, getCookie, subscribeEvents} from "./utils.js";
 
 document.addEventListener('DOMContentLoaded', function () {
     // DOM Elements
     const ordersSection = document.getElementById('ordersSection');
     const orderModal = document.getElementById('orderModal');
 
+    // Orders in cooking, by id - kept up to date by the server's pushes
+    const ordersById = new Map();
+
     // Modal Close Handling
     window.onclick = (event) => {
         if (event.target === orderModal) {
@@ -131,20 +134,37 @@ document.addEventListener('DOMContentLoaded', function () {
     // API Functions
     async function fetchOrders() {
         try {
-            const response = await fetch('/api/control/get/orders/');
+            const response = await cachedFetch('/api/control/get/orders/');
             const data = await response.json();
 
             if (data.messages) {
                 MessageManager.handleAjaxMessages(data.messages);
             }
 
-            renderOrders(data.orders);
+            ordersById.clear();
+            data.orders.forEach(order => ordersById.set(order.id, order));
+            renderKitchenOrders();
         } catch (error) {
             console.error('Error fetching orders:', error);
             MessageManager.handleAjaxMessages([{level: 'error', message: 'No connection.'}]);
         }
     }
 
+    // Oldest payment first, as the server sorts them
+    function renderKitchenOrders() {
+        renderOrders([...ordersById.values()].sort((a, b) => new Date(a.paid_at) - new Date(b.paid_at)));
+    }
+
+    // Pushed when any order changes: it's shown while it's cooking
+    function updateOrder(event) {
+        if (event.kitchen) {
+            ordersById.set(event.id, event.kitchen);
+        } else if (!ordersById.delete(event.id)) {
+            return;
+        }
+        renderKitchenOrders();
+    }
+
     function getTimeSincePayment(paidAt) {
         const paid = new Date(paidAt);
         const now = new Date();
@@ -177,7 +197,8 @@ document.addEventListener('DOMContentLoaded', function () {
 
             if (response.ok) {
                 orderModal.style.display = 'none';
-                fetchOrders();
+                ordersById.delete(orderId);
+                renderKitchenOrders();
             }
         } catch (error) {
             console.error('Error updating order:', error);
@@ -185,13 +206,14 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     }
 
-    // Initial load
+    // Initial load, then the changes are pushed - the list is loaded again only after a reconnect
     fetchOrders();
+    const pushed = subscribeEvents({staff_order: updateOrder}, fetchOrders);
 
-    // Auto-refresh
+    // Auto-refresh: "paid N minutes ago" from the kept orders, the whole list only if there are no pushes
     setInterval(() => {
         if (ordersSection.classList.contains('active')) {
-            fetchOrders();
+            pushed ? renderKitchenOrders() : fetchOrders();
         }
     }, REFRESH_INTERVAL);
 });
\ No newline at end of file
@@ -6,6 +6,7 @@ const is_admin = utils.getUserRole() === 'owner' || utils.getUserRole() === 'adm
 
 document.addEventListener('DOMContentLoaded', function () {
     loadAllOrders();
+    document.addEventListener('orderUpdated', loadAllOrders);
 
     // Event listeners for search, filters, and sorting
     document.getElementById('searchInput').addEventListener('input', filterOrders);
@@ -36,7 +37,7 @@ export function loadAllOrders() {
         url += '?limit=100';
     }
 
-    fetch(url)
+    utils.cachedFetch(url)
         .then(async response => {
             const data = await response.json();
 
@@ -101,7 +102,7 @@ function filterOrders() {
         }
     }
 
-    fetch(`/api/control/get/orders/?${params.toString()}`)
+    utils.cachedFetch(`/api/control/get/orders/?${params.toString()}`)
         .then(response => response.json())
         .then(data => {
             if (data.messages) {
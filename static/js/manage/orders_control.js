@@ -2,24 +2,45 @@
 
 import * as utils from "./utils.js";
 
+const ordersById = new Map();
+
 document.addEventListener('DOMContentLoaded', function () {
     loadControlOrders();
+    document.addEventListener('orderUpdated', loadControlOrders);
 
     // Event listener for updating order status
     document.getElementById('updateOrderBtn').addEventListener('click', utils.updateOrderStatus);
 
-    setInterval(() => {
-        loadControlOrders();
-    }, utils.REFRESH_INTERVAL);
+    // Changed orders are pushed by the server, the list is loaded again only after a reconnect
+    if (!utils.subscribeEvents({staff_order: updateOrder}, loadControlOrders)) {
+        setInterval(() => {
+            loadControlOrders();
+        }, utils.REFRESH_INTERVAL);
+    }
 });
 
 export function loadControlOrders() {
     utils.fetchOrders((data) => {
-        displayPendingOrders(data);
-        displayReadyOrders(data);
+        ordersById.clear();
+        data.forEach(order => ordersById.set(order.id, order));
+        displayOrders();
     });
 }
 
+function updateOrder(event) {
+    ordersById.set(event.id, event.order);
+    displayOrders();
+    if (event.changes.includes('created')) {
+        MessageManager.showToast(`New order #${event.id}`, 'info');
+    }
+}
+
+function displayOrders() {
+    const orders = [...ordersById.values()].sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+    displayPendingOrders(orders);
+    displayReadyOrders(orders);
+}
+
 function displayPendingOrders(orders) {
     const pendingOrders = orders.filter(order => order.order_status === 'pending');
     const pendingOrdersContainer = document.getElementById('pendingOrders');
@@ -1,6 +1,6 @@
 // products.js
 
-import {getCookie, getUserRole} from "./utils.js";
+import {cachedFetch, getCookie, getUserRole} from "./utils.js";
 
 let productsData = [];
 const isAdmin = getUserRole() === 'owner' || getUserRole() === 'administrator';
@@ -67,7 +67,7 @@ async function loadProducts(filters = {}) {
 
         const url = `/api/control/get/products/${queryParams.toString() ? '?' + queryParams.toString() : ''}`;
 
-        const response = await fetch(url);
+        const response = await cachedFetch(url);
         const data = await response.json();
 
         if (data.messages) {
@@ -157,7 +157,7 @@ function createProductCard(product) {
 
 async function showProductModal(productId) {
     try {
-        const response = await fetch(`/api/control/get/product/${productId}/`);
+        const response = await cachedFetch(`/api/control/get/product/${productId}/`);
         const data = await response.json();
 
         if (data.messages) {
@@ -207,7 +207,10 @@ function populateModal(product) {
     // Fourth row - Lack of ingredients warning
     const warningElement = document.getElementById('lackOfIngredientsWarning');
     if (product.lack_of_ingredients && product.lack_of_ingredients.length > 0) {
-        const ingredientNames = product.lack_of_ingredients.map(ing => ing.name).join(', ');
+        const ingredientNames = product.lack_of_ingredients.map(ing => {
+            const substitutes = (ing.substitutes || []).map(sub => `${sub.name} ${sub.weight}g`).join(' / ');
+            return substitutes ? `${ing.name} (try ${substitutes})` : ing.name;
+        }).join(', ');
         warningElement.textContent = `Lack of ingredients: ${ingredientNames}`;
         warningElement.style.display = 'block';
     } else {
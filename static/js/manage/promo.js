@@ -1,6 +1,6 @@
 // promo.js
 
-import {getCookie} from "./utils.js";
+import {cachedFetch, getCookie} from "./utils.js";
 
 let data = [];
 let activeFilters = {
@@ -53,7 +53,7 @@ function toggleFilter(e) {
 
 async function loadPromos() {
     try {
-        const response = await fetch('/api/control/get/promos/');
+        const response = await cachedFetch('/api/control/get/promos/');
         const responseData = await response.json();
 
         if (responseData.messages) {
@@ -69,7 +69,7 @@ async function loadPromos() {
 
 async function loadPromoDetails(promoId) {
     try {
-        const response = await fetch(`/api/control/get/promo/${promoId}/`);
+        const response = await cachedFetch(`/api/control/get/promo/${promoId}/`);
         const data = await response.json();
 
         if (data.messages) {
@@ -1,6 +1,6 @@
 // purchase.js
 
-import {getCookie} from './utils.js';
+import {cachedFetch, getCookie} from './utils.js';
 
 let purchases = [];
 
@@ -39,7 +39,7 @@ function setupEventListeners() {
 
 async function loadPurchases() {
     try {
-        const response = await fetch('/api/control/get/purchases/');
+        const response = await cachedFetch('/api/control/get/purchases/');
         const data = await response.json();
 
         purchases = data.purchases || [];
@@ -1,9 +1,13 @@
 // utils.js
 
+import {cachedFetch} from '../common/utils.js';
+
+export {cachedFetch, subscribeEvents} from '../common/utils.js';
+
 export const REFRESH_INTERVAL = 10000;
 
 export function fetchOrders(callback) {
-    fetch('/api/control/get/orders/')
+    cachedFetch('/api/control/get/orders/')
         .then(async response => {
             const data = await response.json();
 
@@ -110,7 +114,7 @@ export function formatTime(dateString) {
 }
 
 export function displayOrderDetails(orderId) {
-    fetch(`/api/control/get/order/${orderId}/`)
+    cachedFetch(`/api/control/get/order/${orderId}/?nutrients=none`)
         .then(async response => {
             const data = await response.json()
 
@@ -339,12 +343,8 @@ export function updateOrderStatus() {
                 const modal = bootstrap.Modal.getInstance(document.getElementById('orderModal'));
                 modal.hide();
 
-                // Обновляем список заказов на текущей странице
-                if (window.location.pathname.includes('all')) {
-                    import('./orders_all.js').then(module => module.loadAllOrders());
-                } else {
-                    import('./orders_control.js').then(module => module.loadControlOrders());
-                }
+                // Обновляем список заказов на текущей странице (orders_all.js / orders_control.js слушают событие)
+                document.dispatchEvent(new CustomEvent('orderUpdated'));
             }
         })
         .catch(error => {